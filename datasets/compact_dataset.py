@@ -0,0 +1,212 @@
+import os
+import json
+import numpy as np
+import ants
+
+import datasets.utils as utils
+
+# channels of the images array
+CHANNELS = ("flair", "dwi")
+
+def create(output_dir: str, names: list[str], shape: tuple[int, int, int]):
+    """
+    Creates an empty compact dataset: uncompressed `images.npy` (float16, shape (subjects, 2, *shape)),
+    `labels.npy` (uint8, shape (subjects, *shape)) and `index.json` with subject names.
+    Subjects are then written to their slots by `write_subject` (also from several processes)
+    and their spatial metadata are saved by `write_index`. The same layout is used by the training pool
+    (`training_dataset.build_volume_pool`), which adds only `foreground.npy`.
+
+    Parameters:
+        output_dir (str): Folder of the dataset.
+        names (list[str]): Names of the subjects in the order of slots.
+        shape (tuple[int, int, int]): Shape of all preprocessed volumes.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    np.lib.format.open_memmap(os.path.join(output_dir, "images.npy"), mode="w+", dtype=utils.IMAGE_AT_REST_DTYPE, shape=(len(names), len(CHANNELS), *shape))
+    np.lib.format.open_memmap(os.path.join(output_dir, "labels.npy"), mode="w+", dtype=utils.LABEL_DTYPE, shape=(len(names), *shape))
+    write_index(output_dir, [None] * len(names), names, shape)
+
+def encode_subject(subj) -> tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Converts a loaded and preprocessed subject to the stored form. Images are stored in float16
+    (relative precision about 0.05 %) and labels in uint8.
+
+    Parameters:
+        subj (dataset_loaders.Subject): Loaded subject.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, dict]: Images with shape (2, *shape) (FLAIR, DWI) in float16, label in uint8
+            and spatial metadata of the subject (name, origin, spacing, direction).
+    """
+    images = np.stack([subj.flair.numpy(), subj.dwi.numpy()]).astype(utils.IMAGE_AT_REST_DTYPE)
+    for channel in range(len(CHANNELS)):
+        assert np.isfinite(images[channel]).all(), f"Subject {subj.name}: intensities of {CHANNELS[channel]} overflow float16"
+    label = (subj.label.numpy() != 0).astype(utils.LABEL_DTYPE)
+    metadata = {
+        "name": subj.name,
+        "origin": list(subj.flair.origin),
+        "spacing": list(subj.flair.spacing),
+        "direction": subj.flair.direction.tolist()
+    }
+    return images, label, metadata
+
+def write_slot(output_dir: str, slot: int, images: np.ndarray, label: np.ndarray):
+    """
+    Writes encoded images and label (see `encode_subject`) to the slot of the dataset.
+
+    Parameters:
+        output_dir (str): Folder of the dataset created by `create`.
+        slot (int): Index of the slot.
+        images (np.ndarray): Images with shape (2, *shape) in float16.
+        label (np.ndarray): Label in uint8.
+    """
+    dataset_images = np.lib.format.open_memmap(os.path.join(output_dir, "images.npy"), mode="r+")
+    dataset_labels = np.lib.format.open_memmap(os.path.join(output_dir, "labels.npy"), mode="r+")
+    dataset_images[slot] = images
+    dataset_labels[slot] = label
+    dataset_images.flush()
+    dataset_labels.flush()
+
+def write_subject(output_dir: str, subj) -> dict:
+    """
+    Writes a loaded and preprocessed subject to its slot in the compact dataset.
+
+    Parameters:
+        output_dir (str): Folder of the dataset created by `create`.
+        subj (dataset_loaders.Subject): Loaded subject, its FLAIR, DWI and label must have the dataset shape.
+
+    Returns:
+        dict: Spatial metadata of the subject (name, origin, spacing, direction), which are saved by `write_index`.
+    """
+    with open(os.path.join(output_dir, "index.json")) as f:
+        slot = json.load(f)["names"].index(subj.name)
+
+    images, label, metadata = encode_subject(subj)
+    write_slot(output_dir, slot, images, label)
+    return metadata
+
+def write_index(output_dir: str, subjects: list[dict], names: list[str] = None, shape: tuple[int, int, int] = None, **fields):
+    """
+    Saves metadata of written subjects to `index.json`. Subjects without metadata (None) are treated as missing.
+
+    Parameters:
+        output_dir (str): Folder of the dataset.
+        subjects (list[dict]): Metadata returned by `write_subject` (or None) in the order of slots.
+        names (list[str], optional): Names of the subjects. Defaults to the names in the existing index.
+        shape (tuple[int, int, int], optional): Shape of the volumes. Defaults to the shape in the existing index.
+        **fields: Additional fields of the index (e.g. normalization of the training pool), fields of the existing index are kept.
+    """
+    index_file = os.path.join(output_dir, "index.json")
+    index = {}
+    if names is None or shape is None:
+        with open(index_file) as f:
+            index = json.load(f)
+        names, shape = index["names"], index["shape"]
+
+    index.update(fields)
+    index.update({"names": list(names), "shape": list(shape), "channels": list(CHANNELS), "subjects": subjects})
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+
+class CompactDataset():
+    """
+    Reader of the compact dataset. Arrays are memory-mapped, so reading a slice or a patch
+    reads only the pages which contain it and no volume is decompressed.
+    """
+    def __init__(self, dataset_dir: str):
+        """
+        Parameters:
+            dataset_dir (str): Folder of the dataset.
+        """
+        self.dataset_dir = dataset_dir
+        with open(os.path.join(dataset_dir, "index.json")) as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.metadata = {s["name"]: s for s in index["subjects"] if s is not None}
+        self._slots = {name: i for i, name in enumerate(index["names"])}
+        self._images = np.load(os.path.join(dataset_dir, "images.npy"), mmap_mode="r")
+        self._labels = np.load(os.path.join(dataset_dir, "labels.npy"), mmap_mode="r")
+
+    @property
+    def names(self) -> list[str]:
+        """
+        Returns:
+            list[str]: Names of the written subjects.
+        """
+        return list(self.metadata)
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.metadata
+
+    def images(self, name: str) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Read-only memory-mapped float16 array with shape (2, *shape) with FLAIR and DWI of the subject.
+        """
+        return self._images[self._slot(name)]
+
+    def label(self, name: str) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Read-only memory-mapped uint8 label of the subject.
+        """
+        return self._labels[self._slot(name)]
+
+    def slice(self, name: str, axis: int, position: int, channel: str = "flair") -> np.ndarray:
+        """
+        Reads one 2D slice of the subject.
+
+        Parameters:
+            name (str): Name of the subject.
+            axis (int): Axis perpendicular to the slice (0, 1 or 2).
+            position (int): Index of the slice along the axis.
+            channel (str, optional): "flair", "dwi" or "label". Defaults to "flair".
+
+        Returns:
+            np.ndarray: The slice (float32 for images, uint8 for label).
+        """
+        volume = self.label(name) if channel == "label" else self.images(name)[CHANNELS.index(channel)]
+        data = np.take(volume, position, axis=axis)
+        return np.array(data, dtype=np.uint8 if channel == "label" else np.float32)
+
+    def patch(self, name: str, start: tuple[int, int, int], size: tuple[int, int, int]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Reads a 3D patch of the subject.
+
+        Parameters:
+            name (str): Name of the subject.
+            start (tuple[int, int, int]): Corner of the patch in voxels.
+            size (tuple[int, int, int]): Size of the patch in voxels.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Images with shape (2, *size) in float32 and label in uint8.
+        """
+        region = tuple(slice(s, s + p) for s, p in zip(start, size))
+        images = np.array(self.images(name)[(slice(None),) + region], dtype=np.float32)
+        label = np.array(self.label(name)[region], dtype=np.uint8)
+        return images, label
+
+    def to_ants(self, name: str) -> dict[str, ants.ants_image.ANTsImage]:
+        """
+        Converts the subject back to ANTs images with the original spatial metadata (e.g. for NIfTI export).
+
+        Parameters:
+            name (str): Name of the subject.
+
+        Returns:
+            dict[str, ants.ants_image.ANTsImage]: Images with keys "flair", "dwi" (float32) and "label" (uint8).
+        """
+        metadata = self.metadata[name]
+        volumes = {channel: np.array(data, dtype=np.float32) for channel, data in zip(CHANNELS, self.images(name))}
+        volumes["label"] = np.array(self.label(name), dtype=np.uint8)
+        return {key: ants.from_numpy(data, origin=metadata["origin"], spacing=metadata["spacing"], direction=np.array(metadata["direction"]))
+                for key, data in volumes.items()}
+
+    def _slot(self, name: str) -> int:
+        assert name in self.metadata, f"Subject {name} is not in the dataset"
+        return self._slots[name]
@@ -0,0 +1,213 @@
+import os
+import json
+import argparse
+import functools
+import numpy as np
+import nibabel as nib
+from collections.abc import Callable
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.parallel as parallel
+import datasets.utils as utils
+import datasets.volume_cache as volume_cache
+
+def file_record(path: str, hash_contents: bool = False) -> dict:
+    """
+    Computes the fingerprint of a file.
+
+    Parameters:
+        path (str): Path to the file.
+        hash_contents (bool, optional): Whether to compute SHA-1 of the contents. Defaults to False.
+
+    Returns:
+        dict: Size, modification time and optionally SHA-1 of the file, None if the file does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    record = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if hash_contents:
+        record["sha1"] = volume_cache.VolumeCache(hash_contents=True).file_fingerprint(path)[1]
+    return record
+
+def header_record(path: str) -> dict:
+    """
+    Reads the image header (see `utils.read_header`) in JSON serializable form.
+
+    Parameters:
+        path (str): Path to the image.
+
+    Returns:
+        dict: Shape, spacing, origin, direction and orientation, None if the file does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    header = utils.read_header(path)
+    header["direction"] = header["direction"].tolist()
+    return header
+
+def label_nonempty(path: str) -> bool:
+    """
+    Checks whether the label contains any lesion voxel. NIfTI labels are decoded by nibabel without ITK,
+    for NRRD segmentations both FLAIR and DWI layers are checked.
+
+    Parameters:
+        path (str): Path to the label.
+
+    Returns:
+        bool: True if the label is not empty, None if the file does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    if ".nrrd" in path:
+        return any(np.count_nonzero(label.numpy()) > 0 for label in utils.load_nrrd(path))
+    return bool(np.asanyarray(nib.load(path).dataobj).any())
+
+def index_subject(subj: dataset_loaders.Subject, hash_contents: bool = False) -> dict:
+    """
+    Creates the index record of a subject from file headers.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject, it must not be loaded.
+        hash_contents (bool, optional): Whether to compute SHA-1 of the files. Defaults to False.
+
+    Returns:
+        dict: Paths, fingerprints and headers of images, availability of transformations and label non-emptiness.
+    """
+    images = {"flair": subj.flair, "dwi": subj.dwi, "label": subj.label, "BETmask": subj.BETmask}
+    warp, affine = subj.transform_flair_to_mni
+    transforms = {
+        "dwi_to_flair": subj.transform_dwi_to_flair,
+        "flair_to_mni_warp": warp,
+        "flair_to_mni_affine": affine,
+        "mni_inverse_warp": utils.inverse_warp_file(warp)
+    }
+    return {
+        "name": subj.name,
+        "labeled_modality": subj.labeled_modality,
+        "paths": images,
+        "files": {key: file_record(path, hash_contents) for key, path in images.items()},
+        "headers": {key: header_record(path) for key, path in images.items()},
+        "transforms": {key: os.path.exists(path) for key, path in transforms.items()},
+        "transform_files": {key: file_record(path) for key, path in transforms.items()},
+        "label_nonempty": label_nonempty(subj.label)
+    }
+
+def is_up_to_date(record: dict, subj: dataset_loaders.Subject) -> bool:
+    """
+    Checks whether the index record of the subject matches its current files (paths, sizes and modification times).
+    """
+    images = {"flair": subj.flair, "dwi": subj.dwi, "label": subj.label, "BETmask": subj.BETmask}
+    if record["paths"] != images:
+        return False
+    for key, path in images.items():
+        current = file_record(path)
+        previous = record["files"][key]
+        if (current is None) != (previous is None):
+            return False
+        if current is not None and (current["size"], current["mtime_ns"]) != (previous["size"], previous["mtime_ns"]):
+            return False
+    warp, affine = subj.transform_flair_to_mni
+    transforms = [subj.transform_dwi_to_flair, warp, affine, utils.inverse_warp_file(warp)]
+    return [file_record(path) for path in transforms] == list(record["transform_files"].values())
+
+def build_index(dataset: list[dataset_loaders.Subject],
+                index_file: str = "datasets/index.json",
+                n_workers: int = 1,
+                hash_contents: bool = False) -> list[dict]:
+    """
+    Builds the index of the dataset from file headers and saves it. Records of subjects whose files
+    did not change since the last run are reused, other subjects are indexed in a pool of worker processes.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): Subjects to index.
+        index_file (str, optional): The JSON index file. Defaults to "datasets/index.json".
+        n_workers (int, optional): Number of worker processes. Defaults to 1.
+        hash_contents (bool, optional): Whether to compute SHA-1 of the image files. Defaults to False.
+
+    Returns:
+        list[dict]: Records of the subjects in the dataset order.
+    """
+    previous = {record["name"]: record for record in load_index(index_file)} if os.path.exists(index_file) else {}
+    records = {}
+    todo = []
+    for subj in dataset:
+        record = previous.get(subj.name)
+        if record is not None and is_up_to_date(record, subj) and (not hash_contents or all(
+                f is None or "sha1" in f for f in record["files"].values())):
+            records[subj.name] = record
+        else:
+            todo.append(subj)
+
+    print(f"Indexing {len(todo)} subjects ({len(records)} up to date)...")
+    job = functools.partial(index_subject, hash_contents=hash_contents)
+    for result in parallel.imap_jobs(job, todo, n_workers, ordered=False):
+        if result.ok:
+            records[result.item.name] = result.result
+        else:
+            print(f"Failed {result.item.name}:\n{result.error}")
+
+    records = [records[subj.name] for subj in dataset if subj.name in records]
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"subjects": records}, f)
+    os.replace(tmp_file, index_file)
+    return records
+
+def load_index(index_file: str = "datasets/index.json") -> list[dict]:
+    """
+    Loads the index saved by `build_index`.
+
+    Parameters:
+        index_file (str, optional): The JSON index file. Defaults to "datasets/index.json".
+
+    Returns:
+        list[dict]: Records of the subjects.
+    """
+    with open(index_file) as f:
+        return json.load(f)["subjects"]
+
+def is_complete(record: dict) -> bool:
+    """
+    Checks whether the subject has FLAIR, DWI, label and DWI to FLAIR transformation.
+    """
+    return all(record["files"][key] is not None for key in ("flair", "dwi", "label")) and record["transforms"]["dwi_to_flair"]
+
+def subjects_from_index(records: list[dict],
+                        where: Callable[[dict], bool] = is_complete,
+                        cache: volume_cache.VolumeCache = None) -> list[dataset_loaders.Subject]:
+    """
+    Creates subjects from index records which satisfy the condition, no image is read.
+
+    Example:
+        subjects_from_index(load_index(), lambda r: is_complete(r) and r["headers"]["dwi"]["spacing"] == [2.0, 2.0, 2.0])
+
+    Parameters:
+        records (list[dict]): Records of the index.
+        where (Callable[[dict], bool], optional): Condition on records. Defaults to subjects with all files (`is_complete`).
+        cache (volume_cache.VolumeCache, optional): The cache for loaded subject data. Defaults to None.
+
+    Returns:
+        list[dataset_loaders.Subject]: Selected subjects.
+    """
+    return [dataset_loaders.Subject(name=record["name"],
+                                    flair=record["paths"]["flair"],
+                                    dwi=record["paths"]["dwi"],
+                                    label=record["paths"]["label"],
+                                    labeled_modality=record["labeled_modality"],
+                                    BETmask=record["paths"]["BETmask"],
+                                    cache=cache)
+            for record in records if where(record)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="datasets/index.json", help="Output index file")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--hash", action="store_true", help="Compute SHA-1 of the image files")
+    args = parser.parse_args()
+
+    records = build_index(dataset_loaders.ISLES2022(discover=True), args.output, args.workers, args.hash)
+    complete = [record for record in records if is_complete(record)]
+    print(f"Indexed {len(records)} subjects, {len(complete)} complete, "
+          f"{sum(record['label_nonempty'] is False for record in records)} with empty label, "
+          f"{sum(not record['transforms']['flair_to_mni_warp'] for record in records)} without MNI transformation")
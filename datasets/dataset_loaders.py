@@ -3,31 +3,160 @@ import ants
 import numpy as np
 from dataclasses import dataclass
 import datasets.utils as utils
+import datasets.volume_cache as volume_cache
+import datasets.normalization as normalization
+
+@dataclass(slots=True)
+class SubjectPaths():
+    flair: str
+    dwi: str
+    label: str
+    BETmask: str = None
+
+@dataclass(slots=True)
+class SubjectImages():
+    flair: ants.ants_image.ANTsImage = None
+    dwi: ants.ants_image.ANTsImage = None
+    label: ants.ants_image.ANTsImage = None
+    BETmask: ants.ants_image.ANTsImage = None
+
+def _subject_attribute(name: str, cast) -> property:
+    """
+    Creates the attribute of the subject which returns the loaded image or the path if the image is not loaded.
+    Assigned images are converted by the dtype policy (`utils.as_image` or `utils.as_label`), assigned strings are paths.
+    """
+    def getter(self):
+        image = getattr(self.images, name)
+        return image if image is not None else getattr(self.paths, name)
+
+    def setter(self, value):
+        if isinstance(value, ants.ants_image.ANTsImage):
+            setattr(self.images, name, cast(value))
+        else:
+            setattr(self.paths, name, value)
+            setattr(self.images, name, None)
+
+    return property(getter, setter)
 
-@dataclass
 class Subject():
-    name: str
-    flair: str | ants.ants_image.ANTsImage
-    dwi: str | ants.ants_image.ANTsImage
-    label: str | ants.ants_image.ANTsImage
-    labeled_modality: str = "flair"
-    BETmask: str | ants.ants_image.ANTsImage = None
+    """
+    Subject with FLAIR, DWI, label and BET mask. Paths (`paths`) and loaded images (`images`) are stored separately,
+    attributes `flair`, `dwi`, `label` and `BETmask` return the loaded image or the path if the image is not loaded.
+    Loaded images follow the dtype policy of `datasets/utils.py`: FLAIR and DWI are float32, label and BET mask are uint8.
+    """
+    __slots__ = ("name", "paths", "images", "labeled_modality", "cache", "transform_flair_to_mni", "transform_dwi_to_flair")
+
+    flair = _subject_attribute("flair", utils.as_image)
+    dwi = _subject_attribute("dwi", utils.as_image)
+    label = _subject_attribute("label", utils.as_label)
+    BETmask = _subject_attribute("BETmask", utils.as_label)
 
-    def load_data(self, load_label=True, transform_to_flair=True):
+    def __init__(self, name: str, flair: str, dwi: str, label: str, labeled_modality: str = "flair",
+                 BETmask: str = None, cache: volume_cache.VolumeCache = None):
+        """
+        Sets up paths of the images and transformation paths for FLAIR images.
+
+        Parameters:
+            name (str): Name of the subject.
+            flair (str): Path to the FLAIR image.
+            dwi (str): Path to the DWI image.
+            label (str): Path to the label (NIfTI or nrrd segmentation).
+            labeled_modality (str, optional): Modality on which the label is drawn ("flair" or "dwi"). Defaults to "flair".
+            BETmask (str, optional): Path to the brain mask. Defaults to non-zero FLAIR voxels.
+            cache (volume_cache.VolumeCache, optional): The cache for loaded subject data. Defaults to None.
+        """
+        self.name = name
+        self.paths = SubjectPaths(flair, dwi, label, BETmask)
+        self.images = SubjectImages()
+        self.labeled_modality = labeled_modality
+        self.cache = cache
+
+        flair_folder = os.path.dirname(flair)
+        transform_flair_to_mni_folder = os.path.join(flair_folder, "flair_brain_to_mni")
+        self.transform_flair_to_mni = [os.path.join(transform_flair_to_mni_folder, "warp.nii.gz"), os.path.join(transform_flair_to_mni_folder, "affine.mat")]
+        self.transform_dwi_to_flair = os.path.join(flair_folder, "dwi_to_flair_affine.mat")
+
+    def __repr__(self) -> str:
+        return f"Subject(name={self.name!r}, paths={self.paths!r}, loaded={self.is_loaded()})"
+
+    def load_data(self, load_label=True, transform_to_flair=True, crop_to_brain=False, crop_margin=2):
         """
         Loads the subject data from file paths.
+        If the subject has a cache, co-registered images are read from the cache when they are available
+        and they are saved to the cache after loading otherwise.
+
+        With `crop_to_brain`, FLAIR and BET mask are cropped to the bounding box of the BET mask first,
+        so DWI and labels are transformed and resampled only inside the brain region instead of the whole FLAIR grid.
+        Cropped images keep their physical space, thus results of `resample_to_target` are the same.
 
         Parameters:
             load_label (bool): Whether to load the label. Defaults to True.
             transform_to_flair (bool): Whether to transform the DWI to FLAIR space. Defaults to True.
+            crop_to_brain (bool): Whether to crop the FLAIR grid to the brain before loading other images. Defaults to False.
+            crop_margin (int): Margin of the brain bounding box in voxels. Defaults to 2.
         """
         assert not self.is_loaded(), f"Subject {self.name} is already loaded"
 
-        # save paths
-        self._subj_paths = [self.flair, self.dwi, self.label, self.BETmask]
-
+        if self.cache is not None:
+            key = self._cache_key(load_label, transform_to_flair, crop_margin if crop_to_brain else None)
+            images = self.cache.get(key)
+            if images is not None:
+                self.flair = images["flair"]
+                self.dwi = images["dwi"]
+                self.BETmask = images["BETmask"]
+                if load_label:
+                    self.label = images["label"]
+                return
+
+        self._load_data(load_label, transform_to_flair, crop_margin if crop_to_brain else None)
+
+        if self.cache is not None:
+            images = {"flair": self.flair, "dwi": self.dwi, "BETmask": self.BETmask}
+            if load_label:
+                images["label"] = self.label
+            self.cache.put(key, images)
+
+    def _cache_key(self, load_label: bool, transform_to_flair: bool, crop_margin: int = None) -> str:
+        """
+        Computes the key of the loaded data in the cache from the source files and loading options.
+        """
+        files = [self.flair, self.dwi]
+        if load_label:
+            files.append(self.label)
+        if self.BETmask:
+            files.append(self.BETmask)
+        if transform_to_flair:
+            files.append(self.transform_dwi_to_flair)
+        options = {
+            "step": "load_data",
+            "load_label": load_label,
+            "transform_to_flair": transform_to_flair,
+            "labeled_modality": self.labeled_modality
+        }
+        if crop_margin is not None:
+            options["crop_margin"] = crop_margin
+        return self.cache.make_key(files, options)
+
+    def _load_data(self, load_label: bool, transform_to_flair: bool, crop_margin: int = None):
+        """
+        Loads and co-registers the subject data from file paths. If `crop_margin` is not None,
+        the FLAIR grid is cropped to the brain bounding box with the margin first.
+        """
         # load images
         self.flair = ants.image_read(self.flair)
+        if self.BETmask:
+            self.BETmask = ants.image_read(self.BETmask)
+        else:
+            self.BETmask = self.flair.new_image_like((self.flair.numpy() != 0).astype(utils.LABEL_DTYPE))
+
+        # images in the original FLAIR grid are cropped, other images are resampled directly to the cropped grid
+        crop = lambda image: image
+        if crop_margin is not None:
+            lower, upper = utils.bounding_box(self.BETmask, crop_margin)
+            crop = lambda image: utils.crop_to_bounding_box(image, lower, upper)
+            self.flair = crop(self.flair)
+            self.BETmask = crop(self.BETmask)
+
         self.dwi = ants.image_read(self.dwi) 
         
         if transform_to_flair:
@@ -38,30 +167,37 @@ class Subject():
             if ".nrrd" in self.label:
                 label_flair, label_dwi = utils.load_nrrd(self.label)
 
-                # resample flair label to flair
+                # resample flair and dwi labels (they share the nrrd grid) to flair
                 if label_flair.shape != self.flair.shape:
-                    label_flair = utils.resample_label_to_target(label_flair, self.flair)
-
-                # resample dwi label to flair
-                if label_dwi.shape != self.flair.shape:
-                    label_dwi = utils.resample_label_to_target(label_dwi, self.flair)
+                    label_flair, label_dwi = utils.resample_labels_to_target([label_flair, label_dwi], self.flair)
                 
                 # apply transforms to label
                 if transform_to_flair:
                     label_dwi = utils.apply_transform_to_label(label_dwi, transform, self.flair)
  
-                label_union = np.logical_or(label_flair.numpy(), label_dwi.numpy()).astype(np.uint32)
+                label_union = np.logical_or(label_flair.numpy(), label_dwi.numpy()).astype(utils.LABEL_DTYPE)
                 self.label = label_flair.new_image_like(label_union)
 
             else:
-                self.label = ants.image_read(self.label).astype("uint32")
+                self.label = ants.image_read(self.label)
                 if transform_to_flair and self.labeled_modality == "dwi":
                     self.label = utils.apply_transform_to_label(self.label, transform, self.flair)
+                elif self.labeled_modality == "flair":
+                    self.label = crop(self.label)
 
-        if self.BETmask:
-            self.BETmask = ants.image_read(self.BETmask).astype("uint32")
-        else:
-            self.BETmask = self.flair.new_image_like((self.flair.numpy() != 0).astype("uint32"))
+    def transform_to_flair(self):
+        """
+        Transforms the DWI (and the label if it is labeled on DWI) to FLAIR space.
+        It is used for data loaded by `load_data(transform_to_flair=False)`, so the native images
+        can be inspected first and they do not have to be read again.
+        """
+        assert self.is_loaded(), f"Subject {self.name} is not loaded"
+        assert ".nrrd" not in self.paths.label, f"Subject {self.name}: labels from nrrd have to be transformed in load_data"
+
+        transform = ants.read_transform(self.transform_dwi_to_flair)
+        self.dwi = transform.apply_to_image(self.dwi, self.flair)
+        if isinstance(self.label, ants.ants_image.ANTsImage) and self.labeled_modality == "dwi":
+            self.label = utils.apply_transform_to_label(self.label, transform, self.flair)
 
     def extract_brain(self):
         """
@@ -72,20 +208,68 @@ class Subject():
 
         self.flair = ants.mask_image(self.flair, self.BETmask.astype("float32"))
         self.dwi = ants.mask_image(self.dwi, self.BETmask.astype("float32"))
-        self.label = ants.mask_image(self.label, self.BETmask.astype("float32")).astype("uint32")
+        self.label = ants.mask_image(self.label, self.BETmask.astype("float32"))
+
+    def statistics_key(self, modality: str, statistics_cache: normalization.StatisticsCache, cache_options: dict = None) -> str:
+        """
+        Computes the key of the intensity statistics of the modality in the statistics cache, the subject does not have to be loaded.
+
+        Parameters:
+            modality (str): "flair" or "dwi".
+            statistics_cache (normalization.StatisticsCache): Store of intensity statistics.
+            cache_options (dict, optional): Preprocessing applied before the normalization (e.g. the target shape). Defaults to None.
 
-    def normalize(self):
+        Returns:
+            str: The key.
         """
-        Normalizes the FLAIR and DWI images of the subject by subtracting the mean and dividing by the standard deviation.
+        files = [path for path in (self.paths.flair, self.paths.dwi, self.paths.BETmask, self.transform_dwi_to_flair) if path and os.path.exists(path)]
+        return statistics_cache.make_key(files, {"step": "intensity_statistics", "modality": modality, **(cache_options or {})})
+
+    def intensity_statistics(self, statistics_cache: normalization.StatisticsCache = None, cache_options: dict = None) -> dict[str, dict]:
+        """
+        Computes statistics of FLAIR and DWI intensities inside the BET mask (see `normalization.intensity_statistics`).
+
+        Parameters:
+            statistics_cache (normalization.StatisticsCache, optional): Store of intensity statistics, statistics are computed
+                only if they are not stored yet. Defaults to None.
+            cache_options (dict, optional): Preprocessing applied before the normalization (e.g. the target shape),
+                it is a part of the key of the stored statistics. Defaults to None.
+
+        Returns:
+            dict[str, dict]: Statistics with keys "flair" and "dwi".
         """
         assert self.is_loaded(), f"Subject {self.name} is not loaded"
 
-        data = self.flair.numpy()
-        self.flair = self.flair.new_image_like((data-np.mean(data)) / np.std(data))
+        statistics = {}
+        for modality in ("flair", "dwi"):
+            key = self.statistics_key(modality, statistics_cache, cache_options) if statistics_cache is not None else None
+            statistics[modality] = statistics_cache.get(key) if statistics_cache is not None else None
+            if statistics[modality] is None:
+                statistics[modality] = normalization.intensity_statistics(getattr(self.images, modality), self.BETmask)
+                if statistics_cache is not None:
+                    statistics_cache.put(key, statistics[modality])
+        return statistics
+
+    def normalize(self, mode: str = "zscore", statistics_cache: normalization.StatisticsCache = None,
+                  cache_options: dict = None, reference_landmarks: dict[str, np.ndarray] = None):
+        """
+        Normalizes the FLAIR and DWI images of the subject in place using statistics of voxels inside the BET mask,
+        voxels outside of the mask are set to zero (see `normalization.normalize_image`).
+
+        Parameters:
+            mode (str, optional): The normalization mode ("zscore", "percentile" or "histogram"). Defaults to "zscore".
+            statistics_cache (normalization.StatisticsCache, optional): Store of intensity statistics, statistics are computed
+                only if they are not stored yet. Defaults to None.
+            cache_options (dict, optional): Preprocessing applied before the normalization (e.g. the target shape),
+                it is a part of the key of the stored statistics. Defaults to None.
+            reference_landmarks (dict[str, np.ndarray], optional): Landmarks of the "histogram" mode for "flair" and "dwi"
+                (see `normalization.standard_landmarks`). Defaults to the fixed linear reference.
+        """
+        statistics = self.intensity_statistics(statistics_cache, cache_options)
+        for modality in ("flair", "dwi"):
+            landmarks = reference_landmarks[modality] if reference_landmarks is not None else None
+            normalization.normalize_image(getattr(self.images, modality), self.BETmask, mode, statistics[modality], landmarks)
 
-        data = self.dwi.numpy()
-        self.dwi = self.dwi.new_image_like((data-np.mean(data)) / np.std(data))
-    
     def resample_to_target(self, target_shape=(200, 200, 200), target_spacing=(1.0, 1.0, 1.0)):
         """
         Resamples the subject to the target shape and spacing.
@@ -100,6 +284,7 @@ class Subject():
         self.flair = ants.crop_image(self.flair, self.BETmask)
         self.dwi = ants.crop_image(self.dwi, self.BETmask)
         self.label = ants.crop_image(self.label, self.BETmask)
+        self.BETmask = ants.crop_image(self.BETmask, self.BETmask)
 
         # resample flair to desired shape
         self.flair = ants.resample_image(self.flair, target_spacing, use_voxels=False)
@@ -107,26 +292,37 @@ class Subject():
 
         # resample other images to flair
         self.dwi = ants.resample_image_to_target(self.dwi, self.flair)
-        self.label = utils.resample_label_to_target(self.label, self.flair)
-        self.BETmask = utils.resample_label_to_target(self.BETmask, self.flair)
+        self.label, self.BETmask = utils.resample_labels_to_target([self.label, self.BETmask], self.flair)
 
         # check shapes
         assert self.flair.shape == target_shape, f"Shape mismatch: FLAIR: {self.flair.shape}, target: {target_shape}"
         assert self.flair.spacing == target_spacing, f"Spacing mismatch: FLAIR: {self.flair.spacing}, target: {target_spacing}"
 
-    def apply_transform_to_mni(self, template_mni="datasets/template_flair_mni.nii.gz"):
+    def apply_transform_to_mni(self, template_mni="datasets/template_flair_mni.nii.gz", composite=False):
         """
         Applies the transformation from the FLAIR space of the subject to the MNI template space.
         Transformation is applied to the FLAIR, DWI, label and BET images.
 
         The transformation is computed from the displacement field and affine transform files.
+        In composite mode the affine transform and the displacement field are composed into one displacement field,
+        which is computed once and used for all images, so each image is resampled only once.
         
         Parameters:
             template_mni (str): The path to the MNI template image. Default is "datasets/template_flair_mni.nii.gz".
+            composite (bool): Whether to apply the composed transformation in a single resampling. Default is False.
         """
         assert self.is_loaded(), f"Subject {self.name} is not loaded"
 
-        template_mni = ants.image_read(template_mni)
+        template_mni = utils.load_template(template_mni)
+
+        if composite:
+            transform = utils.compose_transforms(template_mni, self.transform_flair_to_mni)
+            self.flair = transform.apply_to_image(self.flair, template_mni)
+            self.dwi = transform.apply_to_image(self.dwi, template_mni)
+            self.BETmask = utils.apply_transform_to_label(self.BETmask, transform, template_mni)
+            self.label = utils.apply_transform_to_label(self.label, transform, template_mni)
+            return
+
         warp = ants.transform_from_displacement_field(ants.image_read(self.transform_flair_to_mni[0]))
         affine = ants.read_transform(self.transform_flair_to_mni[1])
 
@@ -184,45 +380,40 @@ class Subject():
 
     def free_data(self):
         """
-        Frees the data by reassigning paths to attributes: flair, dwi, label, and BETmask.
+        Frees the loaded images, attributes flair, dwi, label, and BETmask return paths again.
         """
         assert self.is_loaded(), f"Subject {self.name} is not loaded"
 
-        self.flair = self._subj_paths[0]
-        self.dwi = self._subj_paths[1]
-        self.label = self._subj_paths[2]
-        self.BETmask = self._subj_paths[3]
+        self.images = SubjectImages()
 
     def is_loaded(self) -> bool:
         """
-        Checks if the subject data is loaded. I.e. if the flair attribute is an ANTs image.
+        Checks if the subject data is loaded. I.e. if the FLAIR image is loaded.
         
         Returns:
             bool: True if the subject is loaded, False otherwise.
         """
-        return isinstance(self.flair, ants.ants_image.ANTsImage)
-
-    def __post_init__(self):
-        """
-        Sets up transformation paths for FLAIR images.
-        """
-        flair_folder = os.path.dirname(self.flair)
-        transform_flair_to_mni_folder = os.path.join(flair_folder, "flair_brain_to_mni")
-        self.transform_flair_to_mni = [os.path.join(transform_flair_to_mni_folder, "warp.nii.gz"), os.path.join(transform_flair_to_mni_folder, "affine.mat")]
-        self.transform_dwi_to_flair = os.path.join(flair_folder, "dwi_to_flair_affine.mat")
+        return self.images.flair is not None
 
-def ISLES2022(dataset_folder = "datasets/ISLES-2022/") -> list[Subject]:
+def ISLES2022(dataset_folder = "datasets/ISLES-2022/", cache: volume_cache.VolumeCache = None, discover: bool = False) -> list[Subject]:
     """
     Generates a list of Subject objects for the ISLES 2022 dataset based on the provided dataset folder.
     
     Parameters:
         dataset_folder: str, default is "datasets/ISLES-2022/", the folder path containing the dataset
+        cache: volume_cache.VolumeCache, default is None, the cache for loaded subject data
+        discover: bool, default is False, whether to scan the dataset folder for subjects instead of using
+            sub-strokecase0001 to sub-strokecase0250, only subjects with existing FLAIR, DWI and label are returned
     
     Returns:
         list (Subject): a list of Subject objects, each representing a patient in the dataset with their associated FLAIR, DWI, and label paths
     """
     subjects = []
-    sub_strokecases = [f"sub-strokecase{i:04d}" for i in range(1,251)]
+    if discover:
+        with os.scandir(dataset_folder) as entries:
+            sub_strokecases = sorted(entry.name for entry in entries if entry.is_dir() and entry.name.startswith("sub-strokecase"))
+    else:
+        sub_strokecases = [f"sub-strokecase{i:04d}" for i in range(1,251)]
     for sub_strokecase in sub_strokecases:
         subjects.append(
             Subject(
@@ -232,7 +423,10 @@ def ISLES2022(dataset_folder = "datasets/ISLES-2022/") -> list[Subject]:
                 #label = fr"C:/Users/Carlo/Documents/GitHub/MRI-ischemic-stroke-segmentation-main/output_ensamble/{sub_strokecase}.nii.gz",
                 
                 label = f"{dataset_folder}/derivatives/{sub_strokecase}/ses-0001/{sub_strokecase}_ses-0001_msk.nii.gz",
-                labeled_modality = "dwi"
+                labeled_modality = "dwi",
+                cache = cache
             )
         )
+    if discover:
+        subjects = [subj for subj in subjects if all(os.path.exists(path) for path in (subj.flair, subj.dwi, subj.label))]
     return subjects
\ No newline at end of file
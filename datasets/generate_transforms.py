@@ -2,29 +2,82 @@ import ants
 import shutil
 import multiprocessing
 import os
-import dataset_loaders as dataset_loaders
+import time
+import argparse
+import functools
+import pandas as pd
+import datasets.dataset_loaders as dataset_loaders
+import datasets.parallel as parallel
+import datasets.utils as utils
 
-def registration_SyN(fixed: ants.ants_image.ANTsImage, moving: ants.ants_image.ANTsImage, output_files: list[str]):
+# keyword arguments of ants.registration for SyN registration of FLAIR to MNI template
+SYN_PRESETS = {
+    # ANTs defaults
+    "default": {"type_of_transform": "SyN"},
+    # half of SyN and affine iterations (ANTsPy defaults are (40, 20, 0) and (2100, 1200, 1200, 10))
+    "reduced": {"type_of_transform": "SyN", "reg_iterations": (20, 10, 0),
+                "aff_iterations": (1050, 600, 600, 5)},
+    # affine stage on coarser pyramid with fewer sampled points
+    "downsampled": {"type_of_transform": "SyN", "aff_shrink_factors": (8, 4, 2, 1),
+                    "aff_smoothing_sigmas": (4, 2, 1, 0), "aff_random_sampling_rate": 0.1},
+    # reduced iterations, coarser pyramid and fewer sampled points
+    "fast": {"type_of_transform": "SyN", "reg_iterations": (20, 10, 0),
+             "aff_iterations": (1000, 500, 250, 0), "aff_shrink_factors": (8, 4, 2, 1),
+             "aff_smoothing_sigmas": (4, 2, 1, 0), "aff_random_sampling_rate": 0.1},
+    # rigid + affine + SyN with the reduced schedule of antsRegistrationSyNQuick.sh
+    "synra-quick": {"type_of_transform": "antsRegistrationSyNQuick[s]"},
+}
+
+# keyword arguments of ants.registration for Rigid registration of DWI to FLAIR
+RIGID_PRESETS = {
+    # ANTs defaults
+    "default": {"type_of_transform": "Rigid"},
+    # reduced iterations, coarser pyramid and fewer sampled points
+    "fast": {"type_of_transform": "Rigid", "aff_iterations": (1000, 500, 250, 0),
+             "aff_shrink_factors": (8, 4, 2, 1), "aff_smoothing_sigmas": (4, 2, 1, 0),
+             "aff_random_sampling_rate": 0.1},
+}
+
+def atomic_move(src: str, dst: str):
+    """
+    Moves a file so that `dst` never contains a partially written file. The file is first copied
+    next to the destination under a temporary name and then atomically renamed.
+
+    Parameters:
+        src (str): The source file.
+        dst (str): The destination file.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.tmp{os.getpid()}"
+    shutil.move(src, tmp)
+    os.replace(tmp, dst)
+
+def registration_SyN(fixed: ants.ants_image.ANTsImage, moving: ants.ants_image.ANTsImage, output_files: list[str], preset: str = "default"):
     """
     Perform SyN registration between two ANTs images and save the resulting transforms.
 
     Parameters:
         fixed (ants.ants_image.ANTsImage): The fixed image for registration.
         moving (ants.ants_image.ANTsImage): The moving image for registration.
-        output_files (list[str]): List of output file paths to save the transforms.
+        output_files (list[str]): List of output file paths to save the transforms (warp and affine).
+            The inverse warp is saved next to the warp as `inverse_warp.nii.gz`.
+        preset (str, optional): Name of the registration preset from SYN_PRESETS. Defaults to "default".
 
     Returns:
         None
     """
     # apply registration
-    mytx = ants.registration(fixed=fixed, moving=moving, type_of_transform="SyN")
+    mytx = ants.registration(fixed=fixed, moving=moving, **SYN_PRESETS[preset])
 
     # save transform
-    os.makedirs(os.path.dirname(output_files[0]), exist_ok=True)
-    shutil.move(mytx['fwdtransforms'][0], output_files[0])
-    shutil.move(mytx['fwdtransforms'][1], output_files[1])
+    atomic_move(mytx['fwdtransforms'][0], output_files[0])
+    atomic_move(mytx['fwdtransforms'][1], output_files[1])
+    inverse_file = utils.inverse_warp_file(output_files[0])
+    atomic_move(mytx['invtransforms'][1], inverse_file)
+    # the inverse must not be older than the warp, otherwise it is considered stale (`utils._load_inverse_transforms`)
+    os.utime(inverse_file)
 
-def registration_Rigid(fixed: ants.ants_image.ANTsImage, moving: ants.ants_image.ANTsImage, output_file: str):
+def registration_Rigid(fixed: ants.ants_image.ANTsImage, moving: ants.ants_image.ANTsImage, output_file: str, preset: str = "default"):
     """
     Perform Rigid registration between two ANTs images and save the resulting transform.
 
@@ -32,43 +85,150 @@ def registration_Rigid(fixed: ants.ants_image.ANTsImage, moving: ants.ants_image
         fixed (ants.ants_image.ANTsImage): The fixed image for registration.
         moving (ants.ants_image.ANTsImage): The moving image for registration.
         output_file (str): The output file path to save the transform.
+        preset (str, optional): Name of the registration preset from RIGID_PRESETS. Defaults to "default".
 
     Returns:
         None
     """
     # apply registration
-    mytx = ants.registration(fixed=fixed, moving=moving, type_of_transform="Rigid")
+    mytx = ants.registration(fixed=fixed, moving=moving, **RIGID_PRESETS[preset])
 
     # save transform
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    shutil.move(mytx['fwdtransforms'][0], output_file)
+    atomic_move(mytx['fwdtransforms'][0], output_file)
 
-def registration(dataset: list[dataset_loaders.Subject], template_mni: ants.ants_image.ANTsImage):
+def is_up_to_date(outputs: list[str], inputs: list[str]) -> bool:
+    """
+    Checks whether all outputs exist and are newer than all inputs.
+
+    Parameters:
+        outputs (list[str]): Output files.
+        inputs (list[str]): Input files.
+
+    Returns:
+        bool: True if outputs do not need to be generated again.
+    """
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    newest_input = max(os.path.getmtime(file) for file in inputs)
+    return min(os.path.getmtime(output) for output in outputs) >= newest_input
+
+def register_subject(subj: dataset_loaders.Subject, template_mni: str, force: bool = False,
+                     syn_preset: str = "default", rigid_preset: str = "default") -> dict:
+    """
+    Perform SyN registration of the brain extracted FLAIR to MNI template and Rigid registration of DWI to FLAIR for one subject.
+    Registrations whose transforms already exist and are newer than their inputs are skipped.
+    Outdated transforms are removed before registration, so an interrupted job never leaves inconsistent transforms.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject to register.
+        template_mni (str): The path to the template image for registration to MNI space.
+        force (bool, optional): Whether to register even if the transforms are up to date. Defaults to False.
+        syn_preset (str, optional): Name of the SyN registration preset. Defaults to "default".
+        rigid_preset (str, optional): Name of the Rigid registration preset. Defaults to "default".
+
+    Returns:
+        dict: Name of the subject, status and duration of each registration in seconds (None if skipped).
+    """
+    flair_inputs = [subj.flair, template_mni] + ([subj.BETmask] if subj.BETmask else [])
+    syn_todo = force or not is_up_to_date(subj.transform_flair_to_mni, flair_inputs)
+    rigid_todo = force or not is_up_to_date([subj.transform_dwi_to_flair], [subj.flair, subj.dwi])
+    stats = {"name": subj.name, "status": "skipped", "syn_s": None, "rigid_s": None}
+    if not syn_todo and not rigid_todo:
+        return stats
+
+    subj.load_data(load_label=False, transform_to_flair=False)
+
+    if syn_todo:
+        for file in subj.transform_flair_to_mni + [utils.inverse_warp_file(subj.transform_flair_to_mni[0])]:
+            if os.path.exists(file):
+                os.remove(file)
+        start = time.time()
+        flair_masked = ants.mask_image(subj.flair, subj.BETmask.astype("float32"))
+        registration_SyN(utils.load_template(template_mni), flair_masked, subj.transform_flair_to_mni, syn_preset)
+        stats["syn_s"] = time.time() - start
+
+    if rigid_todo:
+        start = time.time()
+        registration_Rigid(subj.flair, subj.dwi, subj.transform_dwi_to_flair, rigid_preset)
+        stats["rigid_s"] = time.time() - start
+
+    subj.free_data()
+    stats["status"] = "registered"
+    return stats
+
+def registration(dataset: list[dataset_loaders.Subject], template_mni: str, force: bool = False,
+                 syn_preset: str = "default", rigid_preset: str = "default"):
     """
     Perform registration of the dataset for each subject using SyN and Affine transformations.
     
     Parameters:
         dataset (list[dataset_loaders.Subject]): List of subjects with MRI data.
-        template_mni (ants.ants_image.ANTsImage): The template image for registration to MNI space.
+        template_mni (str): The path to the template image for registration to MNI space.
+        force (bool, optional): Whether to register subjects with up to date transforms. Defaults to False.
+        syn_preset (str, optional): Name of the SyN registration preset. Defaults to "default".
+        rigid_preset (str, optional): Name of the Rigid registration preset. Defaults to "default".
     
     Returns:
         None
     """
     for i, subj in enumerate(dataset):
         print(f"Processing {subj.name} ({i+1}/{len(dataset)})...")
+        register_subject(subj, template_mni, force, syn_preset, rigid_preset)
 
-        subj.load_data(load_label=False, transform_to_flair=False)
-        flair_masked = ants.mask_image(subj.flair, subj.BETmask.astype("float32"))
+def registration_parallel(dataset: list[dataset_loaders.Subject], template_mni: str, n_workers: int = None,
+                          itk_threads: int = None, force: bool = False, timings_file: str = None,
+                          syn_preset: str = "default", rigid_preset: str = "default") -> pd.DataFrame:
+    """
+    Perform registration of the dataset with subjects running concurrently in a pool of worker processes.
+    Subjects with up to date transforms are skipped and failed subjects do not stop the run.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): List of subjects with MRI data.
+        template_mni (str): The path to the template image for registration to MNI space.
+        n_workers (int, optional): Number of concurrent registrations. Defaults to number of CPUs.
+        itk_threads (int, optional): Number of ITK threads of each registration. Defaults to CPUs divided by workers.
+        force (bool, optional): Whether to register subjects with up to date transforms. Defaults to False.
+        timings_file (str, optional): The csv file where timings of each subject are saved. Defaults to None.
+        syn_preset (str, optional): Name of the SyN registration preset. Defaults to "default".
+        rigid_preset (str, optional): Name of the Rigid registration preset. Defaults to "default".
 
-        registration_SyN(template_mni, flair_masked, subj.transform_flair_to_mni)
-        registration_Rigid(subj.flair, subj.dwi, subj.transform_dwi_to_flair)
+    Returns:
+        pd.DataFrame: Status and timings of each subject.
+    """
+    job = functools.partial(register_subject, template_mni=template_mni, force=force, syn_preset=syn_preset, rigid_preset=rigid_preset)
+    rows = []
+    for i, result in enumerate(parallel.imap_jobs(job, dataset, n_workers, itk_threads, ordered=False)):
+        if result.ok:
+            row = result.result
+        else:
+            row = {"name": result.item.name, "status": "failed", "syn_s": None, "rigid_s": None}
+            print(result.error)
+        row["total_s"] = result.duration
+        rows.append(row)
+        print(f"{row['status'].capitalize()} {result.item.name} ({i+1}/{len(dataset)}) in {result.duration:.1f} s")
 
-        subj.free_data()
+        # save timings after each subject, so they are available for interrupted runs
+        if timings_file:
+            pd.DataFrame(rows).to_csv(timings_file, index=False)
+    return pd.DataFrame(rows)
 
 if __name__ == "__main__":
-    template_mni = ants.image_read(r"C:\Users\Carlo\Documents\GitHub\MRI-ischemic-stroke-segmentation-main\datasets\template_flair_mni.nii.gz")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", type=str, default="datasets/template_flair_mni.nii.gz", help="MNI template")
+    parser.add_argument("--workers", type=int, default=1, help="Number of subjects registered concurrently")
+    parser.add_argument("--itk-threads", type=int, default=None, help="Number of ITK threads per registration (default: CPUs / workers)")
+    parser.add_argument("--force", action="store_true", help="Register also subjects with up to date transforms")
+    parser.add_argument("--timings", type=str, default=None, help="Output csv file with timings of each subject")
+    parser.add_argument("--syn-preset", type=str, default="default", choices=SYN_PRESETS.keys(), help="Preset of SyN registration to MNI")
+    parser.add_argument("--rigid-preset", type=str, default="default", choices=RIGID_PRESETS.keys(), help="Preset of Rigid registration of DWI to FLAIR")
+    args = parser.parse_args()
 
     dataset = dataset_loaders.ISLES2022()
-    p_ISLES22 = multiprocessing.Process(target=registration, args=(dataset, template_mni))
-    p_ISLES22.start()
-    p_ISLES22.join()
+    if args.workers > 1:
+        registration_parallel(dataset, args.template, args.workers, args.itk_threads, args.force, args.timings,
+                              args.syn_preset, args.rigid_preset)
+    else:
+        p_ISLES22 = multiprocessing.Process(target=registration, args=(dataset, args.template, args.force,
+                                                                       args.syn_preset, args.rigid_preset))
+        p_ISLES22.start()
+        p_ISLES22.join()
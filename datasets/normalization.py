@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+import ants
+
+import datasets.volume_cache as volume_cache
+
+MODES = ("zscore", "percentile", "histogram")
+
+# clipping range of the "percentile" mode
+CLIP_PERCENTILES = (0.5, 99.5)
+# landmarks of the "histogram" mode (Nyul et al., "New variants of a method of MRI scale standardization", 2000)
+LANDMARK_PERCENTILES = (1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 99)
+
+def intensity_statistics(image: ants.ants_image.ANTsImage, mask: ants.ants_image.ANTsImage,
+                         percentiles: tuple[float] = CLIP_PERCENTILES + LANDMARK_PERCENTILES) -> dict:
+    """
+    Computes statistics of intensities inside the brain mask. Mask voxels are gathered once
+    from the image buffer and all statistics are computed from them, background voxels are never read again.
+
+    Parameters:
+        image (ants.ants_image.ANTsImage): The image.
+        mask (ants.ants_image.ANTsImage): The brain mask in the grid of the image.
+        percentiles (tuple[float], optional): Percentiles to compute. Defaults to the clipping range and histogram landmarks.
+
+    Returns:
+        dict: Number of mask voxels, mean, standard deviation and percentiles (keys formatted by `f"{p:g}"`), JSON serializable.
+    """
+    assert image.shape == mask.shape, f"Shape mismatch: {image.shape} != {mask.shape}"
+    values = image.view()[mask.view() != 0]
+    assert values.size > 0, "Brain mask is empty"
+    return {
+        "voxels": int(values.size),
+        "mean": float(np.mean(values, dtype=np.float64)),
+        "std": float(np.std(values, dtype=np.float64)),
+        "percentiles": {f"{p:g}": float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))}
+    }
+
+def percentile_values(statistics: dict, percentiles: tuple[float]) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: Values of the percentiles from statistics computed by `intensity_statistics`.
+    """
+    return np.array([statistics["percentiles"][f"{p:g}"] for p in percentiles])
+
+def standard_landmarks(statistics: list[dict]) -> np.ndarray:
+    """
+    Learns the standard histogram landmarks from statistics of training subjects: landmarks of each subject
+    are linearly mapped so the first and the last landmark are 0 and 1 and the mapped landmarks are averaged.
+
+    Parameters:
+        statistics (list[dict]): Statistics of subjects computed by `intensity_statistics`.
+
+    Returns:
+        np.ndarray: Standard landmarks for `LANDMARK_PERCENTILES`.
+    """
+    landmarks = np.array([percentile_values(s, LANDMARK_PERCENTILES) for s in statistics])
+    scaled = (landmarks - landmarks[:, :1]) / np.maximum(landmarks[:, -1:] - landmarks[:, :1], 1e-8)
+    return scaled.mean(axis=0)
+
+def normalize_image(image: ants.ants_image.ANTsImage, mask: ants.ants_image.ANTsImage, mode: str = "zscore",
+                    statistics: dict = None, reference_landmarks: np.ndarray = None, chunk_size: int = 1 << 22) -> ants.ants_image.ANTsImage:
+    """
+    Normalizes the float32 image in place in its ANTs buffer using statistics of voxels inside the brain mask,
+    voxels outside of the mask are set to zero. Modes:
+    - "zscore" - subtracts the mean and divides by the standard deviation,
+    - "percentile" - clips to `CLIP_PERCENTILES` and rescales the range to [0, 1],
+    - "histogram" - piecewise linear mapping of `LANDMARK_PERCENTILES` to the reference landmarks (see `standard_landmarks`),
+      values outside of the first and the last landmark are mapped by the first and the last segment, so hyperintense
+      lesions above the last landmark are not clamped.
+
+    Parameters:
+        image (ants.ants_image.ANTsImage): The float32 image (see `utils.as_image`), it is modified.
+        mask (ants.ants_image.ANTsImage): The brain mask in the grid of the image.
+        mode (str, optional): The normalization mode. Defaults to "zscore".
+        statistics (dict, optional): Precomputed statistics of the image (`intensity_statistics`). Defaults to None (computed).
+        reference_landmarks (np.ndarray, optional): Landmarks of the "histogram" mode. Defaults to `LANDMARK_PERCENTILES` / 100.
+        chunk_size (int, optional): Number of voxels mapped at once in the "histogram" mode. Defaults to 4M.
+
+    Returns:
+        ants.ants_image.ANTsImage: The same image.
+    """
+    assert mode in MODES, f"Unknown normalization mode: {mode}"
+    assert image.pixeltype == "float", f"Only float32 images are normalized in place, got {image.pixeltype}"
+    statistics = statistics or intensity_statistics(image, mask)
+    data = image.view()
+
+    if mode == "zscore":
+        np.subtract(data, np.float32(statistics["mean"]), out=data)
+        np.multiply(data, np.float32(1 / max(statistics["std"], 1e-8)), out=data)
+    elif mode == "percentile":
+        low, high = percentile_values(statistics, CLIP_PERCENTILES).astype(np.float32)
+        np.clip(data, low, high, out=data)
+        np.subtract(data, low, out=data)
+        np.multiply(data, np.float32(1 / max(high - low, 1e-8)), out=data)
+    else:
+        landmarks = percentile_values(statistics, LANDMARK_PERCENTILES)
+        reference = np.asarray(LANDMARK_PERCENTILES) / 100 if reference_landmarks is None else np.asarray(reference_landmarks)
+        # flat view of the buffer (ANTs views are Fortran ordered), only one chunk is mapped out of place
+        buffer = data.reshape(-1, order="F" if data.flags.f_contiguous else "C")
+        assert np.shares_memory(buffer, data), "Image buffer is not contiguous"
+        # slopes of the end segments used beyond the first and the last landmark
+        low_slope = (reference[1] - reference[0]) / max(landmarks[1] - landmarks[0], 1e-8)
+        high_slope = (reference[-1] - reference[-2]) / max(landmarks[-1] - landmarks[-2], 1e-8)
+        for start in range(0, buffer.size, chunk_size):
+            chunk = buffer[start:start + chunk_size]
+            mapped = np.interp(chunk, landmarks, reference)
+            below, above = chunk < landmarks[0], chunk > landmarks[-1]
+            mapped[below] = reference[0] + (chunk[below] - landmarks[0]) * low_slope
+            mapped[above] = reference[-1] + (chunk[above] - landmarks[-1]) * high_slope
+            # values above the last landmark must stay above it after mapping
+            assert not above.any() or mapped[above].min() > reference[-1], "Values above the last landmark are clamped"
+            chunk[:] = mapped
+
+    np.copyto(data, 0, where=mask.view() == 0)
+    return image
+
+class StatisticsCache(volume_cache.VolumeCache):
+    """
+    Persistent store of per-subject intensity statistics (`intensity_statistics`). Entries are keyed as in `VolumeCache`
+    by the source files and preprocessing options, each entry is a folder with the manifest containing the statistics.
+    """
+    def __init__(self, cache_dir: str = "datasets/cache_stats/", max_size_gb: float = 1.0, hash_contents: bool = False):
+        """
+        Parameters:
+            cache_dir (str, optional): Folder with the statistics. Defaults to "datasets/cache_stats/".
+            max_size_gb (float, optional): Maximal size of the store in GB. Defaults to 1.
+            hash_contents (bool, optional): Whether to fingerprint source files by SHA-1 of their contents. Defaults to False.
+        """
+        super().__init__(cache_dir, max_size_gb, hash_contents)
+
+    def get(self, key: str) -> dict | None:
+        """
+        Loads the statistics and marks the entry as recently used.
+
+        Parameters:
+            key (str): Key of the entry.
+
+        Returns:
+            dict | None: The statistics or None if the entry does not exist.
+        """
+        manifest_file = os.path.join(self.cache_dir, key, "manifest.json")
+        try:
+            with open(manifest_file) as f:
+                statistics = json.load(f)["statistics"]
+            os.utime(manifest_file)
+        except (OSError, ValueError, KeyError):
+            return None
+        return statistics
+
+    def put(self, key: str, statistics: dict):
+        """
+        Saves the statistics as a new entry.
+
+        Parameters:
+            key (str): Key of the entry.
+            statistics (dict): The statistics.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+        try:
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as f:
+                json.dump({"created": time.time(), "statistics": statistics}, f)
+            os.replace(tmp_entry, os.path.join(self.cache_dir, key))
+        except OSError:
+            # entry has been already written by another process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
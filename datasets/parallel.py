@@ -0,0 +1,95 @@
+import os
+import time
+import traceback
+import multiprocessing
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from typing import Any
+
+@dataclass
+class JobResult():
+    index: int
+    item: Any
+    result: Any = None
+    error: str = None
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+def default_itk_threads(n_workers: int) -> int:
+    """
+    Computes the number of ITK threads per worker so that the pool does not oversubscribe the CPU.
+
+    Parameters:
+        n_workers (int): Number of worker processes.
+
+    Returns:
+        int: Number of ITK threads for each worker (at least 1).
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+def limit_itk_threads(n_threads: int):
+    """
+    Limits the number of threads used by ITK (and therefore ANTs) in the current process.
+    It has to be called before the first ITK filter is executed.
+
+    Parameters:
+        n_threads (int): Number of threads.
+    """
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(n_threads)
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+
+def _run_job(args: tuple) -> JobResult:
+    func, index, item = args
+    start = time.time()
+    try:
+        return JobResult(index, item, result=func(item), duration=time.time() - start)
+    except Exception:
+        return JobResult(index, item, error=traceback.format_exc(), duration=time.time() - start)
+
+def imap_jobs(func: Callable, items: Iterable, n_workers: int = None, itk_threads: int = None, ordered: bool = True) -> Iterator[JobResult]:
+    """
+    Runs `func` for each item in a pool of worker processes and yields the results.
+    Exceptions raised by `func` are caught and returned in `JobResult.error`, so one failing item does not stop the others.
+
+    Parameters:
+        func (Callable): Function applied to each item. It has to be defined on module level (picklable).
+        items (Iterable): Items to process, e.g. list of subjects.
+        n_workers (int, optional): Number of worker processes. Defaults to number of CPUs.
+            If it is 1, items are processed in the current process.
+        itk_threads (int, optional): Number of ITK threads per worker. Defaults to CPUs divided by workers.
+        ordered (bool, optional): Whether to yield results in the input order. Otherwise they are yielded as they finish. Defaults to True.
+
+    Returns:
+        Iterator[JobResult]: Results of the jobs.
+    """
+    items = list(items)
+    n_workers = min(n_workers or os.cpu_count() or 1, max(1, len(items)))
+    itk_threads = itk_threads or default_itk_threads(n_workers)
+    jobs = [(func, i, item) for i, item in enumerate(items)]
+
+    if n_workers == 1:
+        limit_itk_threads(itk_threads)
+        for job in jobs:
+            yield _run_job(job)
+        return
+
+    # each worker is restarted after one job, because ANTs does not release all memory between subjects
+    with multiprocessing.Pool(n_workers, initializer=limit_itk_threads, initargs=(itk_threads,), maxtasksperchild=1) as pool:
+        results = pool.imap(_run_job, jobs) if ordered else pool.imap_unordered(_run_job, jobs)
+        yield from results
+
+def write_failures(failures: list[JobResult], output_file: str):
+    """
+    Writes a report of failed jobs to a text file. Each failure contains the item and the traceback.
+
+    Parameters:
+        failures (list[JobResult]): Failed jobs.
+        output_file (str): Path to the report.
+    """
+    with open(output_file, "w") as f:
+        for failure in failures:
+            name = getattr(failure.item, "name", failure.item)
+            f.write(f"=== {name} ===\n{failure.error}\n")
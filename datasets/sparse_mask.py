@@ -0,0 +1,336 @@
+import os
+import ants
+import argparse
+import numpy as np
+
+import datasets.utils as utils
+
+class SparseMask():
+    """
+    Binary 3D mask stored as runs of foreground voxels along the last axis. Runs are kept sorted by the flat
+    (C order) index of their first voxel, they never cross a row of the last axis and two runs of the same row
+    never touch, so each mask has exactly one representation. Lesions are a few ml in a volume of a few million
+    voxels, so counting, set operations, Dice and connected components cost time proportional to the number
+    of runs instead of the number of voxels. The mask keeps the spatial metadata of the ANTs image.
+    """
+    def __init__(self, shape: tuple[int, int, int], starts: np.ndarray, lengths: np.ndarray,
+                 spacing: tuple[float, float, float] = (1.0, 1.0, 1.0), origin: tuple[float, float, float] = (0.0, 0.0, 0.0),
+                 direction: np.ndarray = None):
+        """
+        Parameters:
+            shape (tuple[int, int, int]): Shape of the volume.
+            starts (np.ndarray): Flat indices of the first voxels of the runs (in the canonical form described above).
+            lengths (np.ndarray): Lengths of the runs.
+            spacing (tuple[float, float, float], optional): Spacing of the volume. Defaults to (1, 1, 1).
+            origin (tuple[float, float, float], optional): Origin of the volume. Defaults to (0, 0, 0).
+            direction (np.ndarray, optional): Direction matrix of the volume. Defaults to identity.
+        """
+        assert len(shape) == 3, f"Only 3D masks are supported, got shape {shape}"
+        self.shape = tuple(int(s) for s in shape)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.spacing = tuple(float(s) for s in spacing)
+        self.origin = tuple(float(o) for o in origin)
+        self.direction = np.eye(3) if direction is None else np.asarray(direction, dtype=np.float64)
+
+    @property
+    def ends(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Flat indices after the last voxels of the runs.
+        """
+        return self.starts + self.lengths
+
+    @classmethod
+    def from_numpy(cls, mask: np.ndarray, spacing: tuple[float, float, float] = (1.0, 1.0, 1.0),
+                   origin: tuple[float, float, float] = (0.0, 0.0, 0.0), direction: np.ndarray = None) -> "SparseMask":
+        """
+        Creates the sparse mask from non-zero voxels of the array in one pass.
+
+        Parameters:
+            mask (np.ndarray): The 3D array.
+            spacing, origin, direction: Spatial metadata, see `SparseMask`.
+
+        Returns:
+            SparseMask: The sparse mask.
+        """
+        # run boundaries are the voxels where the mask changes (padded by background on both ends)
+        edges = np.flatnonzero(np.diff(np.ravel(mask) != 0, prepend=False, append=False))
+        empty = cls(mask.shape, [], [], spacing, origin, direction)
+        return empty._with_runs(edges[0::2], edges[1::2])
+
+    @classmethod
+    def from_ants(cls, image: ants.ants_image.ANTsImage) -> "SparseMask":
+        """
+        Creates the sparse mask from non-zero voxels of the ANTs image.
+
+        Parameters:
+            image (ants.ants_image.ANTsImage): The label, mask or prediction.
+
+        Returns:
+            SparseMask: The sparse mask with the spatial metadata of the image.
+        """
+        return cls.from_numpy(image.numpy(), image.spacing, image.origin, image.direction)
+
+    @classmethod
+    def from_indices(cls, indices: np.ndarray, shape: tuple[int, int, int], spacing: tuple[float, float, float] = (1.0, 1.0, 1.0),
+                     origin: tuple[float, float, float] = (0.0, 0.0, 0.0), direction: np.ndarray = None) -> "SparseMask":
+        """
+        Creates the sparse mask from flat (C order) indices of foreground voxels.
+
+        Parameters:
+            indices (np.ndarray): Flat indices, they do not have to be sorted or unique.
+            shape (tuple[int, int, int]): Shape of the volume.
+            spacing, origin, direction: Spatial metadata, see `SparseMask`.
+
+        Returns:
+            SparseMask: The sparse mask.
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        empty = cls(shape, [], [], spacing, origin, direction)
+        if len(indices) == 0:
+            return empty
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        return empty._with_runs(indices[np.concatenate(([0], breaks))], indices[np.concatenate((breaks, [len(indices)])) - 1] + 1)
+
+    def _with_runs(self, starts: np.ndarray, ends: np.ndarray) -> "SparseMask":
+        """
+        Creates the mask with the same grid from sorted disjoint runs [starts, ends). Runs crossing rows
+        are split and runs which touch inside a row are joined, so the result is in the canonical form.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        width = self.shape[-1]
+
+        if len(starts) > 1:
+            join = (ends[:-1] == starts[1:]) & (starts[1:] % width != 0)
+            starts, ends = starts[np.concatenate(([True], ~join))], ends[np.concatenate((~join, [True]))]
+
+        pieces = (ends - 1) // width - starts // width + 1
+        if np.any(pieces > 1):
+            # split runs at row boundaries, k-th piece of a run lies in the k-th row after its first row
+            k = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+            row = np.repeat(starts // width, pieces) + k
+            starts = np.maximum(np.repeat(starts, pieces), row * width)
+            ends = np.minimum(np.repeat(ends, pieces), (row + 1) * width)
+
+        return SparseMask(self.shape, starts, ends - starts, self.spacing, self.origin, self.direction)
+
+    def indices(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Sorted flat (C order) indices of foreground voxels.
+        """
+        return np.arange(self.count()) + np.repeat(self.starts - (np.cumsum(self.lengths) - self.lengths), self.lengths)
+
+    def coordinates(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Voxel indices of foreground voxels with shape (voxels, 3).
+        """
+        return np.stack(np.unravel_index(self.indices(), self.shape), axis=1)
+
+    def to_numpy(self, dtype: np.dtype = utils.LABEL_DTYPE) -> np.ndarray:
+        """
+        Parameters:
+            dtype (np.dtype, optional): Data type of the array. Defaults to LABEL_DTYPE (uint8).
+
+        Returns:
+            np.ndarray: Dense array with ones in foreground voxels.
+        """
+        mask = np.zeros(int(np.prod(self.shape)), dtype=dtype)
+        mask[self.indices()] = 1
+        return mask.reshape(self.shape)
+
+    def to_ants(self) -> ants.ants_image.ANTsImage:
+        """
+        Returns:
+            ants.ants_image.ANTsImage: Dense uint8 image with the spatial metadata of the mask.
+        """
+        return ants.from_numpy(self.to_numpy(), origin=self.origin, spacing=self.spacing, direction=self.direction)
+
+    def count(self) -> int:
+        """
+        Returns:
+            int: Number of foreground voxels.
+        """
+        return int(self.lengths.sum())
+
+    def volume_ml(self) -> float:
+        """
+        Returns:
+            float: Volume of the foreground in ml.
+        """
+        return utils.voxel_count_to_volume_ml(self.count(), self.spacing)
+
+    def __bool__(self) -> bool:
+        return len(self.starts) > 0
+
+    def __repr__(self) -> str:
+        return f"SparseMask(shape={self.shape}, runs={len(self.starts)}, voxels={self.count()})"
+
+    def _combine(self, other: "SparseMask", keep) -> "SparseMask":
+        """
+        Combines runs of two masks in one sweep over their boundaries. Each voxel gets a code
+        (1 - only in self, 2 - only in other, 3 - in both) and segments with the codes selected by `keep` are returned.
+        """
+        assert self.shape == other.shape, f"Shape mismatch: {self.shape} != {other.shape}"
+        positions = np.concatenate([self.starts, self.ends, other.starts, other.ends])
+        deltas = np.repeat([1, -1, 2, -2], [len(self.starts), len(self.starts), len(other.starts), len(other.starts)])
+        boundaries, inverse = np.unique(positions, return_inverse=True)
+        code = np.cumsum(np.bincount(inverse, weights=deltas, minlength=len(boundaries))).round().astype(np.int64)
+        selected = keep(code[:-1])
+        return self._with_runs(boundaries[:-1][selected], boundaries[1:][selected])
+
+    def union(self, other: "SparseMask") -> "SparseMask":
+        return self._combine(other, lambda code: code != 0)
+
+    def intersection(self, other: "SparseMask") -> "SparseMask":
+        return self._combine(other, lambda code: code == 3)
+
+    def difference(self, other: "SparseMask") -> "SparseMask":
+        return self._combine(other, lambda code: code == 1)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def dice(self, other: "SparseMask") -> float:
+        """
+        Computes the Dice coefficient with the same convention as `utils.dice_coefficient` (1 for two empty masks).
+
+        Parameters:
+            other (SparseMask): The other mask in the same grid.
+
+        Returns:
+            float: The Dice coefficient.
+        """
+        total = self.count() + other.count()
+        if total == 0:
+            return 1
+        return 2 * self.intersection(other).count() / total
+
+    def components(self, connectivity: int = 26) -> list["SparseMask"]:
+        """
+        Computes connected components from runs. Runs in neighbouring rows are connected if they overlap
+        along the last axis (touch diagonally for 18 and 26 connectivity), components are labelled
+        by propagating the minimal run index over the connections.
+
+        Parameters:
+            connectivity (int, optional): Connectivity of voxels (6, 18 or 26) as in `cc3d`. Defaults to 26.
+
+        Returns:
+            list[SparseMask]: Components ordered by their first voxel.
+        """
+        assert connectivity in (6, 18, 26), f"Unsupported connectivity: {connectivity}"
+        n_runs = len(self.starts)
+        if n_runs == 0:
+            return []
+
+        width = self.shape[-1]
+        ends = self.ends
+        i, j = np.divmod(self.starts // width, self.shape[1])
+        x0, x1 = self.starts % width, ends - (self.starts // width) * width
+
+        # neighbouring rows in one half of the neighbourhood, the other half is covered by symmetry
+        sources, targets = [], []
+        for di, dj in [(0, 1), (1, 0), (1, -1), (1, 1)]:
+            face = abs(di) + abs(dj) == 1
+            if not face and connectivity == 6:
+                continue
+            expand = 1 if connectivity == 26 or (face and connectivity == 18) else 0
+            ti, tj = i + di, j + dj
+            valid = (ti < self.shape[0]) & (tj >= 0) & (tj < self.shape[1])
+            row_start = (ti * self.shape[1] + tj) * width
+            lower = row_start + np.maximum(x0 - expand, 0)
+            upper = row_start + np.minimum(x1 + expand, width)
+            # overlapping runs of the target row form a contiguous range of the sorted runs
+            first = np.searchsorted(ends, lower, side="right")
+            last = np.searchsorted(self.starts, upper, side="left")
+            counts = np.where(valid, np.maximum(last - first, 0), 0)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            sources.append(np.repeat(np.arange(n_runs), counts))
+            targets.append(np.repeat(first, counts) + offsets)
+        sources, targets = np.concatenate(sources), np.concatenate(targets)
+
+        labels = np.arange(n_runs)
+        while True:
+            minimum = np.minimum(labels[sources], labels[targets])
+            new_labels = labels.copy()
+            np.minimum.at(new_labels, sources, minimum)
+            np.minimum.at(new_labels, targets, minimum)
+            new_labels = new_labels[new_labels]
+            if np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+
+        roots, component = np.unique(labels, return_inverse=True)
+        order = np.argsort(component, kind="stable")
+        splits = np.cumsum(np.bincount(component, minlength=len(roots)))[:-1]
+        return [SparseMask(self.shape, self.starts[runs], self.lengths[runs], self.spacing, self.origin, self.direction)
+                for runs in np.split(order, splits)]
+
+    def save(self, output_file: str):
+        """
+        Saves the mask to a `.npz` file (runs and spatial metadata).
+
+        Parameters:
+            output_file (str): The output file.
+        """
+        np.savez(output_file, shape=np.array(self.shape), starts=self.starts, lengths=self.lengths.astype(np.uint32),
+                 spacing=np.array(self.spacing), origin=np.array(self.origin), direction=self.direction)
+
+    @classmethod
+    def load(cls, input_file: str) -> "SparseMask":
+        """
+        Loads the mask saved by `save`.
+
+        Parameters:
+            input_file (str): The `.npz` file.
+
+        Returns:
+            SparseMask: The mask.
+        """
+        with np.load(input_file) as data:
+            return cls(tuple(data["shape"]), data["starts"], data["lengths"], tuple(data["spacing"]), tuple(data["origin"]), data["direction"])
+
+def read_mask(path: str) -> SparseMask:
+    """
+    Reads a mask saved by `SparseMask.save` (`.npz`) or any image readable by ANTs.
+
+    Parameters:
+        path (str): Path to the mask.
+
+    Returns:
+        SparseMask: The mask.
+    """
+    if path.endswith(".npz"):
+        return SparseMask.load(path)
+    return SparseMask.from_ants(ants.image_read(path))
+
+def read_image(path: str) -> ants.ants_image.ANTsImage:
+    """
+    Reads an image, masks saved by `SparseMask.save` (`.npz`) are converted to uint8 ANTs images.
+
+    Parameters:
+        path (str): Path to the image.
+
+    Returns:
+        ants.ants_image.ANTsImage: The image.
+    """
+    if path.endswith(".npz"):
+        return SparseMask.load(path).to_ants()
+    return ants.image_read(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts binary segmentations (e.g. predictions) from NIfTI to sparse `.npz` masks")
+    parser.add_argument("input_folder", type=str, help="Folder with .nii.gz segmentations")
+    parser.add_argument("output_folder", type=str, help="Output folder")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    for filename in sorted(os.listdir(args.input_folder)):
+        if filename.endswith(".nii.gz"):
+            mask = read_mask(os.path.join(args.input_folder, filename))
+            mask.save(os.path.join(args.output_folder, filename.replace(".nii.gz", ".npz")))
+            print(f"{filename}: {mask}")
@@ -0,0 +1,340 @@
+import os
+import json
+import argparse
+import functools
+import numpy as np
+import torch
+
+import datasets.compact_dataset as compact_dataset
+import datasets.dataset_loaders as dataset_loaders
+import datasets.normalization as normalization
+import datasets.parallel as parallel
+
+# number of sampled lesion voxels per subject used for foreground patch sampling
+N_FOREGROUND = 1000
+
+def _load_resampled(subj: dataset_loaders.Subject, target_shape: tuple[int, int, int]):
+    """
+    Loads the subject, extracts the brain and resamples it to the target shape.
+    """
+    subj.load_data()
+    subj.extract_brain()
+    subj.resample_to_target(target_shape)
+    subj.space_integrity_check()
+
+def subject_statistics(subj: dataset_loaders.Subject, target_shape: tuple[int, int, int] = (200, 200, 200),
+                       statistics_cache: normalization.StatisticsCache = None) -> dict[str, dict]:
+    """
+    Computes intensity statistics of the preprocessed subject (see `Subject.intensity_statistics`).
+    The subject is loaded only if its statistics are not in the cache.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject, it must not be loaded.
+        target_shape (tuple[int, int, int], optional): Shape of the preprocessed volumes. Defaults to (200, 200, 200).
+        statistics_cache (normalization.StatisticsCache, optional): Store of intensity statistics. Defaults to None.
+
+    Returns:
+        dict[str, dict]: Statistics with keys "flair" and "dwi".
+    """
+    cache_options = {"target_shape": list(target_shape)}
+    if statistics_cache is not None:
+        statistics = {modality: statistics_cache.get(subj.statistics_key(modality, statistics_cache, cache_options)) for modality in ("flair", "dwi")}
+        if all(s is not None for s in statistics.values()):
+            return statistics
+
+    _load_resampled(subj, target_shape)
+    statistics = subj.intensity_statistics(statistics_cache, cache_options)
+    subj.free_data()
+    return statistics
+
+def learn_landmarks(dataset: list[dataset_loaders.Subject], target_shape: tuple[int, int, int] = (200, 200, 200),
+                    statistics_cache: normalization.StatisticsCache = None, n_workers: int = 1, itk_threads: int = None) -> dict[str, list[float]]:
+    """
+    Learns the standard histogram landmarks of FLAIR and DWI (`normalization.standard_landmarks`) from the training subjects.
+    With `statistics_cache`, statistics are computed only once and the following normalization reads them from the cache.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): Training subjects.
+        target_shape (tuple[int, int, int], optional): Shape of the preprocessed volumes. Defaults to (200, 200, 200).
+        statistics_cache (normalization.StatisticsCache, optional): Store of intensity statistics. Defaults to None.
+        n_workers (int, optional): Number of worker processes. Defaults to 1.
+        itk_threads (int, optional): Number of ITK threads per worker. Defaults to CPUs divided by workers.
+
+    Returns:
+        dict[str, list[float]]: Landmarks with keys "flair" and "dwi".
+    """
+    statistics = []
+    job = functools.partial(subject_statistics, target_shape=target_shape, statistics_cache=statistics_cache)
+    for result in parallel.imap_jobs(job, dataset, n_workers, itk_threads, ordered=False):
+        if result.ok:
+            statistics.append(result.result)
+        else:
+            print(f"Statistics of {result.item.name} failed:\n{result.error}")
+    assert statistics, "No subject statistics for learning landmarks"
+    return {modality: normalization.standard_landmarks([s[modality] for s in statistics]).tolist() for modality in ("flair", "dwi")}
+
+def preprocess_for_training(subj: dataset_loaders.Subject, target_shape: tuple[int, int, int] = (200, 200, 200),
+                            normalization_mode: str = "zscore", statistics_cache: normalization.StatisticsCache = None,
+                            reference_landmarks: dict[str, list[float]] = None) -> tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Loads and preprocesses one subject for training: brain extraction, resampling to the target shape and normalization.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject, it must not be loaded.
+        target_shape (tuple[int, int, int], optional): Shape of the preprocessed volumes. Defaults to (200, 200, 200).
+        normalization_mode (str, optional): The normalization mode (see `normalization.MODES`). Defaults to "zscore".
+        statistics_cache (normalization.StatisticsCache, optional): Store of intensity statistics. Defaults to None.
+        reference_landmarks (dict[str, list[float]], optional): Landmarks of the "histogram" mode (see `learn_landmarks`).
+            Defaults to the fixed linear reference.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, dict]: Images with shape (2, *target_shape) (FLAIR, DWI) in float16,
+            label in uint8 and spatial metadata of the preprocessed volumes.
+    """
+    _load_resampled(subj, target_shape)
+    subj.normalize(normalization_mode, statistics_cache, {"target_shape": list(target_shape)}, reference_landmarks)
+
+    images, label, metadata = compact_dataset.encode_subject(subj)
+    subj.free_data()
+    return images, label, metadata
+
+def sample_foreground(label: np.ndarray, seed: int) -> tuple[np.ndarray, int]:
+    """
+    Samples lesion voxels of the label once, so patch sampling does not have to search the label.
+
+    Parameters:
+        label (np.ndarray): The label.
+        seed (int): Seed of the sampling.
+
+    Returns:
+        tuple[np.ndarray, int]: Coordinates of `N_FOREGROUND` sampled lesion voxels (int16, zeros for empty label)
+            and the number of lesion voxels.
+    """
+    foreground = np.argwhere(label)
+    samples = np.zeros((N_FOREGROUND, 3), dtype=np.int16)
+    if len(foreground):
+        samples[:] = foreground[np.random.default_rng(seed).integers(0, len(foreground), N_FOREGROUND)]
+    return samples, int(len(foreground))
+
+def _write_pool_subject(job: tuple[int, dataset_loaders.Subject], pool_dir: str, target_shape: tuple[int, int, int],
+                        normalization_mode: str = "zscore", statistics_cache: normalization.StatisticsCache = None,
+                        reference_landmarks: dict[str, list[float]] = None) -> dict:
+    """
+    Preprocesses one subject and writes it directly to its slot in the pool, so volumes are not sent between processes.
+    """
+    index, subj = job
+    images, label, metadata = preprocess_for_training(subj, target_shape, normalization_mode, statistics_cache, reference_landmarks)
+
+    compact_dataset.write_slot(pool_dir, index, images, label)
+
+    pool_foreground = np.load(os.path.join(pool_dir, "foreground.npy"), mmap_mode="r+")
+    pool_foreground[index], metadata["n_foreground"] = sample_foreground(label, index)
+    pool_foreground.flush()
+    return metadata
+
+def build_volume_pool(dataset: list[dataset_loaders.Subject],
+                      pool_dir: str = "datasets/pool/",
+                      target_shape: tuple[int, int, int] = (200, 200, 200),
+                      n_workers: int = 1,
+                      itk_threads: int = None,
+                      normalization_mode: str = "zscore",
+                      statistics_cache: normalization.StatisticsCache = None,
+                      reference_landmarks: dict[str, list[float]] = None):
+    """
+    Preprocesses the dataset into a pool of memory-mappable arrays for training. The pool is a compact dataset
+    (`compact_dataset.create`, readable by `compact_dataset.CompactDataset`) with one more array:
+    - `images.npy` - float16 array with shape (subjects, 2, *target_shape) with FLAIR and DWI,
+    - `labels.npy` - uint8 array with shape (subjects, *target_shape),
+    - `foreground.npy` - int16 array with sampled lesion voxel coordinates of each subject,
+    - `index.json` - names and spatial metadata of the subjects.
+
+    With the "histogram" normalization, standard landmarks are learned from the dataset first (`learn_landmarks`)
+    unless `reference_landmarks` are given, they are saved in `index.json` for normalization of new subjects.
+
+    A pool of 250 subjects of shape 200x200x200 takes about 12 GB. When `pool_dir` is in `/dev/shm`,
+    the pool is kept in shared memory, otherwise the page cache is shared by all processes which read it.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): Subjects to preprocess.
+        pool_dir (str, optional): Output folder of the pool. Defaults to "datasets/pool/".
+        target_shape (tuple[int, int, int], optional): Shape of the preprocessed volumes. Defaults to (200, 200, 200).
+        n_workers (int, optional): Number of worker processes. Defaults to 1.
+        itk_threads (int, optional): Number of ITK threads per worker. Defaults to CPUs divided by workers.
+        normalization_mode (str, optional): The normalization mode (see `normalization.MODES`). Defaults to "zscore".
+        statistics_cache (normalization.StatisticsCache, optional): Store of intensity statistics. Defaults to None.
+        reference_landmarks (dict[str, list[float]], optional): Landmarks of the "histogram" mode. Defaults to landmarks learned from the dataset.
+    """
+    if normalization_mode == "histogram" and reference_landmarks is None:
+        print("Learning histogram landmarks...")
+        reference_landmarks = learn_landmarks(dataset, target_shape, statistics_cache, n_workers, itk_threads)
+
+    N = len(dataset)
+    compact_dataset.create(pool_dir, [subj.name for subj in dataset], target_shape)
+    np.lib.format.open_memmap(os.path.join(pool_dir, "foreground.npy"), mode="w+", dtype=np.int16, shape=(N, N_FOREGROUND, 3))
+
+    subjects = [None] * N
+    failures = []
+    job = functools.partial(_write_pool_subject, pool_dir=pool_dir, target_shape=target_shape,
+                            normalization_mode=normalization_mode, statistics_cache=statistics_cache,
+                            reference_landmarks=reference_landmarks)
+    for i, result in enumerate(parallel.imap_jobs(job, list(enumerate(dataset)), n_workers, itk_threads)):
+        index, subj = result.item
+        if result.ok:
+            subjects[index] = result.result
+        else:
+            failures.append(result)
+        status = "done" if result.ok else "FAILED"
+        print(f"Processed {subj.name} ({i+1}/{N}) in {result.duration:.1f} s: {status}")
+
+    # failed subjects keep their slot, but they are not listed in the index
+    compact_dataset.write_index(pool_dir, subjects, normalization=normalization_mode, reference_landmarks=reference_landmarks)
+
+    if failures:
+        parallel.write_failures(failures, os.path.join(pool_dir, "failures.txt"))
+        print(f"{len(failures)}/{N} subjects failed: {', '.join(f.item[1].name for f in failures)}")
+
+class VolumePoolDataset(torch.utils.data.Dataset):
+    """
+    PyTorch dataset of preprocessed subjects from a pool created by `build_volume_pool`.
+
+    Volumes are memory-mapped in each DataLoader worker, so all workers read the same pages without copying
+    whole volumes. Compact datasets (`compact_dataset.py`) can be read too, their lesion voxels are sampled when the dataset
+    is created, but they hold raw intensities (a warning is printed). With `in_memory=True` the pool is loaded to torch shared memory in the main process
+    and workers get only handles to it. Each item is a random patch (or the whole volume if `patch_size` is None)
+    converted to float32, with `foreground_probability` the patch is centered on a lesion voxel.
+    """
+    def __init__(self, pool_dir: str = "datasets/pool/",
+                 patch_size: tuple[int, int, int] = (96, 96, 96),
+                 samples_per_volume: int = 1,
+                 foreground_probability: float = 0.5,
+                 subjects: list[str] = None,
+                 in_memory: bool = False):
+        """
+        Parameters:
+            pool_dir (str, optional): Folder with the pool. Defaults to "datasets/pool/".
+            patch_size (tuple[int, int, int], optional): Size of sampled patches, None for whole volumes. Defaults to (96, 96, 96).
+            samples_per_volume (int, optional): Number of patches sampled from each subject in one epoch. Defaults to 1.
+            foreground_probability (float, optional): Probability that the patch is centered on a lesion. Defaults to 0.5.
+            subjects (list[str], optional): Names of subjects to use (e.g. one fold). Defaults to all subjects in the pool.
+            in_memory (bool, optional): Whether to load the pool to shared memory. Defaults to False.
+        """
+        self.pool_dir = pool_dir
+        self.patch_size = patch_size
+        self.samples_per_volume = samples_per_volume
+        self.foreground_probability = foreground_probability
+
+        with open(os.path.join(pool_dir, "index.json")) as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.normalization = index.get("normalization")
+        if self.normalization is None:
+            print(f"Warning: intensities in {pool_dir} are not normalized, use a pool created by `build_volume_pool` for training")
+        available = {s["name"]: (i, s) for i, s in enumerate(index["subjects"]) if s is not None}
+        subjects = subjects if subjects is not None else list(available)
+        missing = [name for name in subjects if name not in available]
+        assert not missing, f"Subjects are not in the pool: {missing}"
+        self.indices = [available[name][0] for name in subjects]
+        self.metadata = [available[name][1] for name in subjects]
+
+        # sampled lesion voxels are small, they are kept in memory of each process
+        foreground_file = os.path.join(pool_dir, "foreground.npy")
+        if os.path.exists(foreground_file):
+            self.foreground = np.load(foreground_file)
+            self.n_foreground = [metadata["n_foreground"] for metadata in self.metadata]
+        else:
+            labels = np.load(os.path.join(pool_dir, "labels.npy"), mmap_mode="r")
+            self.foreground = np.zeros((len(index["subjects"]), N_FOREGROUND, 3), dtype=np.int16)
+            self.n_foreground = []
+            for i in self.indices:
+                self.foreground[i], n_foreground = sample_foreground(labels[i], i)
+                self.n_foreground.append(n_foreground)
+
+        self._shared = None
+        if in_memory:
+            self._shared = [torch.from_numpy(np.load(os.path.join(pool_dir, f"{name}.npy"))).share_memory_()
+                            for name in ("images", "labels")]
+        self._arrays = None
+        self._rng = None
+
+    def __len__(self) -> int:
+        return len(self.indices) * self.samples_per_volume
+
+    def __getitem__(self, i: int) -> dict:
+        images, labels = self._pool()
+        subject = i // self.samples_per_volume
+        index = self.indices[subject]
+
+        if self.patch_size is None:
+            image_patch = images[index]
+            label_patch = labels[index]
+        else:
+            start = self._patch_start(self.foreground[index], self.n_foreground[subject])
+            region = tuple(slice(s, s + p) for s, p in zip(start, self.patch_size))
+            image_patch = images[(index, slice(None)) + region]
+            label_patch = labels[(index,) + region]
+
+        return {
+            "name": self.metadata[subject]["name"],
+            "image": torch.from_numpy(np.asarray(image_patch, dtype=np.float32)),
+            "label": torch.from_numpy(np.array(label_patch, dtype=np.uint8)[None])
+        }
+
+    def _patch_start(self, foreground: np.ndarray, n_foreground: int) -> np.ndarray:
+        """
+        Samples the corner of a patch, either around a random lesion voxel or uniformly in the volume.
+        """
+        rng = self._generator()
+        shape = np.array(self.shape)
+        patch = np.array(self.patch_size)
+        if n_foreground > 0 and rng.random() < self.foreground_probability:
+            center = foreground[rng.integers(0, len(foreground))].astype(np.int64)
+            start = center - patch // 2
+        else:
+            start = rng.integers(0, shape - patch + 1)
+        return np.clip(start, 0, shape - patch)
+
+    def _generator(self) -> np.random.Generator:
+        """
+        Returns random generator of the current process. It is seeded from torch, so DataLoader workers get different seeds.
+        """
+        if self._rng is None:
+            self._rng = np.random.default_rng(torch.initial_seed() % 2**32)
+        return self._rng
+
+    def _pool(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the pool arrays, they are opened on the first access in each process.
+        """
+        if self._arrays is None:
+            if self._shared is not None:
+                self._arrays = tuple(tensor.numpy() for tensor in self._shared)
+            else:
+                self._arrays = tuple(np.load(os.path.join(self.pool_dir, f"{name}.npy"), mmap_mode="r")
+                                     for name in ("images", "labels"))
+        return self._arrays
+
+    def __getstate__(self) -> dict:
+        # memory maps and random generator are created again in each worker
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        state["_rng"] = None
+        return state
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="datasets/pool/", help="Output folder of the pool (use /dev/shm/... to keep it in shared memory)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--itk-threads", type=int, default=None, help="Number of ITK threads per worker (default: CPUs / workers)")
+    parser.add_argument("--normalization", type=str, default="zscore", choices=normalization.MODES, help="Normalization of intensities inside the brain mask")
+    parser.add_argument("--stats-cache", action="store_true", help="Store intensity statistics in datasets/cache_stats/ and reuse them")
+    parser.add_argument("--landmarks-from", type=str, default=None, help="Pool whose histogram landmarks are used instead of learning them (e.g. the training pool for test data)")
+    args = parser.parse_args()
+
+    statistics_cache = normalization.StatisticsCache() if args.stats_cache else None
+    reference_landmarks = None
+    if args.landmarks_from:
+        with open(os.path.join(args.landmarks_from, "index.json")) as f:
+            reference_landmarks = json.load(f)["reference_landmarks"]
+    build_volume_pool(dataset_loaders.ISLES2022(), args.output, n_workers=args.workers, itk_threads=args.itk_threads,
+                      normalization_mode=args.normalization, statistics_cache=statistics_cache,
+                      reference_landmarks=reference_landmarks)
@@ -1,6 +1,45 @@
+import os
+import zlib
+import hashlib
+import functools
+import tempfile
 import numpy as np
 import ants
 import nrrd
+import nibabel as nib
+
+# dtype policy: labels and masks are uint8, images are float32 in memory and float16 at rest (compact dataset, training pool)
+LABEL_DTYPE = np.uint8
+IMAGE_DTYPE = np.float32
+IMAGE_AT_REST_DTYPE = np.float16
+
+def as_label(image: ants.ants_image.ANTsImage) -> ants.ants_image.ANTsImage:
+    """
+    Converts the label or mask to the label dtype of the policy (uint8), the image is returned unchanged if it already has it.
+
+    Parameters:
+        image (ants.ants_image.ANTsImage): The label or mask.
+
+    Returns:
+        ants.ants_image.ANTsImage: The uint8 label.
+    """
+    if image.pixeltype == "unsigned char":
+        return image
+    return image.new_image_like(np.rint(image.numpy()).astype(LABEL_DTYPE))
+
+def as_image(image: ants.ants_image.ANTsImage) -> ants.ants_image.ANTsImage:
+    """
+    Converts the intensity image to the image dtype of the policy (float32), the image is returned unchanged if it already has it.
+
+    Parameters:
+        image (ants.ants_image.ANTsImage): The intensity image.
+
+    Returns:
+        ants.ants_image.ANTsImage: The float32 image.
+    """
+    if image.pixeltype == "float":
+        return image
+    return image.astype("float32")
 
 def subtract_masks(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     """
@@ -46,23 +85,65 @@ def voxel_count_to_volume_ml(voxel_count: int, voxel_zooms: tuple[float, float,
     """
     return voxel_count * np.prod(voxel_zooms) / 1000
 
-def load_nrrd(nrrd_path: str) -> list[ants.ants_image.ANTsImage]:
+def read_header(image_path: str) -> dict:
     """
-    Load an nrrd file from Motol dataset and extract FLAIR and DWI segmentations. 
+    Reads spatial metadata of a NIfTI or NRRD image from its header without decoding the voxel data.
+    Origin and direction are in the ITK (LPS) convention, so they are the same as in the image loaded by ANTs.
+
+    Parameters:
+        image_path (str): The path to the image.
+
+    Returns:
+        dict: Shape, spacing, origin, direction (3x3 matrix) and orientation (axis codes, e.g. "RAS") of the image.
+    """
+    if image_path.endswith(".nrrd"):
+        header = nrrd.read_header(image_path)
+        # segmentations have the non-spatial (layer) axis first, its space direction is not defined
+        spatial = [i for i, d in enumerate(header["space directions"]) if d is not None and not np.isnan(d).any()]
+        axes = np.array([header["space directions"][i] for i in spatial], dtype=np.float64).T
+        shape = tuple(int(header["sizes"][i]) for i in spatial)
+        origin = np.asarray(header["space origin"], dtype=np.float64)
+        spacing = np.linalg.norm(axes, axis=0)
+    else:
+        image = nib.load(image_path)
+        shape = image.header.get_data_shape()
+        spacing = np.asarray(image.header.get_zooms()[:3], dtype=np.float64)
+        # RAS affine of NIfTI to LPS of ITK
+        axes = np.diag([-1.0, -1.0, 1.0]) @ image.affine[:3, :3]
+        origin = np.diag([-1.0, -1.0, 1.0]) @ image.affine[:3, 3]
+
+    ras = np.eye(4)
+    ras[:3, :3] = np.diag([-1.0, -1.0, 1.0]) @ axes
+    return {
+        "shape": tuple(int(s) for s in shape),
+        "spacing": tuple(float(s) for s in spacing),
+        "origin": tuple(float(o) for o in origin),
+        "direction": axes / spacing,
+        "orientation": "".join(nib.aff2axcodes(ras))
+    }
+
+# numpy types of NRRD "type" field (segmentations are usually unsigned char or short)
+NRRD_TYPES = {
+    "signed char": "i1", "int8": "i1", "int8_t": "i1",
+    "uchar": "u1", "unsigned char": "u1", "uint8": "u1", "uint8_t": "u1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4"
+}
+
+def nrrd_segments(header: dict, nrrd_path: str = "") -> tuple[tuple[int, int], tuple[int, int]]:
+    """
+    Finds layers and label values of the FLAIR and DWI segments in the header of a segmentation nrrd file.
     Check that there is exactly one FLAIR and one DWI segmentation in the header.
-    Create ANTs images from the extracted masks. 
 
     Parameters:
-        nrrd_path (str): The file path to the nrrd file.
+        header (dict): The nrrd header.
+        nrrd_path (str, optional): The file path used in error messages.
 
     Returns:
-        list (ants.ants_image.ANTsImage): Two ANTs images representing the FLAIR and DWI segmentations.
+        tuple[tuple[int, int], tuple[int, int]]: (layer, label value) of the FLAIR and of the DWI segment.
     """
-    # load nrrd
-    data, header = nrrd.read(nrrd_path)
-    assert header["space"] == "left-posterior-superior", f"Space should be 'left-posterior-superior', but it is {header['space']}"
-    
-    # find the FLAIR and DWI segmentations
     dwi = 0
     flair = 0
     for key, value in header.items():
@@ -73,19 +154,133 @@ def load_nrrd(nrrd_path: str) -> list[ants.ants_image.ANTsImage]:
             dwi_segment = key.split("_")[0]
             dwi += 1
     assert flair == 1 and dwi == 1, f"{nrrd_path}: There should be exactly one FLAIR and one DWI segmentation, but there are {flair} FLAIR segmentations and {dwi} DWI segmentations"
-    
-    flair_layer = header[flair_segment + "_Layer"]
-    flair_value = header[flair_segment + "_LabelValue"]
-    
-    dwi_layer = header[dwi_segment + "_Layer"]
-    dwi_value = header[dwi_segment + "_LabelValue"]
 
-    # extract masks from nrrd
-    flair_mask = np.where(data == int(flair_value), 1, 0)[int(flair_layer), :, :, :].astype(np.uint32)
-    dwi_mask = np.where(data == int(dwi_value), 1, 0)[int(dwi_layer), :, :, :].astype(np.uint32)
+    # segmentations with one layer have no layer axis and no layer in the header
+    return ((int(header.get(flair_segment + "_Layer", 0)), int(header[flair_segment + "_LabelValue"])),
+            (int(header.get(dwi_segment + "_Layer", 0)), int(header[dwi_segment + "_LabelValue"])))
+
+def decode_nrrd_layers(nrrd_path: str, segments: list[tuple[int, int]], chunk_size: int = 1 << 24) -> tuple[dict, list[np.ndarray]]:
+    """
+    Decodes uint8 masks of the requested (layer, label value) segments from a segmentation nrrd file.
+    Layers are the first (fastest varying) axis of the data, so the data are decompressed in chunks
+    and only the requested layers of each chunk are compared with the label values.
+    The whole multi-layer array is never held in memory. Encodings other than raw and gzip
+    and detached data files are decoded by pynrrd.
+
+    Parameters:
+        nrrd_path (str): The file path to the nrrd file.
+        segments (list[tuple[int, int]]): (layer, label value) of the requested masks.
+        chunk_size (int, optional): Size of decompressed chunks in bytes. Defaults to 16 MB.
+
+    Returns:
+        tuple[dict, list[np.ndarray]]: The nrrd header and masks with the spatial shape in uint8.
+    """
+    with open(nrrd_path, "rb") as f:
+        header = nrrd.read_header(f)
+        n_layers = int(header["sizes"][0]) if header["dimension"] == 4 else 1
+        shape = tuple(int(s) for s in header["sizes"][-3:])
+        masks = [np.empty(int(np.prod(shape)), dtype=np.uint8) for _ in segments]
+
+        encoding = header["encoding"]
+        streamable = (header.get("type") in NRRD_TYPES and encoding in ("raw", "gzip", "gz")
+                      and "data file" not in header and "datafile" not in header
+                      and not header.get("line skip") and not header.get("byte skip"))
+        if not streamable:
+            data = nrrd.read_data(header, f, nrrd_path).reshape((n_layers,) + shape, order="F")
+            for mask, (layer, value) in zip(masks, segments):
+                mask[:] = np.equal(data[layer], value).ravel(order="F")
+            return header, [mask.reshape(shape, order="F") for mask in masks]
+
+        dtype = np.dtype(NRRD_TYPES[header["type"]]).newbyteorder("<" if header.get("endian", "little") == "little" else ">")
+        record = n_layers * dtype.itemsize
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding in ("gzip", "gz") else None
+
+        position = 0
+        rest = b""
+        for chunk in _read_nrrd_chunks(f, decompressor, chunk_size):
+            chunk = rest + chunk
+
+            # only whole voxels (all layers of one voxel) are decoded, the rest waits for the next chunk
+            n_voxels = min(len(chunk) // record, len(masks[0]) - position)
+            if n_voxels > 0:
+                voxels = np.frombuffer(chunk, dtype=dtype, count=n_voxels * n_layers).reshape(n_voxels, n_layers)
+                for mask, (layer, value) in zip(masks, segments):
+                    np.equal(voxels[:, layer], value, out=mask[position:position + n_voxels].view(bool))
+            position += n_voxels
+            rest = chunk[n_voxels * record:]
+            if position == len(masks[0]):
+                break
+
+    assert position == len(masks[0]), f"{nrrd_path}: Data are truncated, {position} of {len(masks[0])} voxels decoded"
+    return header, [mask.reshape(shape, order="F") for mask in masks]
+
+def _read_nrrd_chunks(f, decompressor, chunk_size: int):
+    """
+    Yields chunks of decoded nrrd data of at most `chunk_size` bytes, the decompressed data are never larger than one chunk.
+    """
+    while True:
+        if decompressor is None:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+            continue
+
+        compressed = decompressor.unconsumed_tail or f.read(chunk_size)
+        if not compressed or decompressor.eof:
+            yield decompressor.flush()
+            return
+        yield decompressor.decompress(compressed, chunk_size)
+
+def file_sha1(path: str) -> str:
+    """
+    Computes SHA-1 of the file contents.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_nrrd(nrrd_path: str) -> list[ants.ants_image.ANTsImage]:
+    """
+    Load an nrrd file from Motol dataset and extract FLAIR and DWI segmentations. 
+    Check that there is exactly one FLAIR and one DWI segmentation in the header.
+    Create ANTs images from the extracted masks. 
+
+    Only the FLAIR and DWI layers are decoded (see `decode_nrrd_layers`) directly to uint8 masks.
+    Decoded masks are cached in the process by SHA-1 of the file, so reading the same file again
+    (e.g. in statistics and in `Subject.load_data`) does not decode it twice.
+    Returned images are shared, thus they must not be modified.
+
+    Parameters:
+        nrrd_path (str): The file path to the nrrd file.
+
+    Returns:
+        list (ants.ants_image.ANTsImage): Two ANTs images (uint8) representing the FLAIR and DWI segmentations.
+    """
+    return _load_nrrd(nrrd_path, file_sha1(nrrd_path))
+
+@functools.lru_cache(maxsize=4)
+def _load_nrrd(nrrd_path: str, sha1: str) -> tuple[ants.ants_image.ANTsImage, ants.ants_image.ANTsImage]:
+    """
+    Decodes the nrrd file, see `load_nrrd`.
+    """
+    # parse segments from the header first, then decode only their layers
+    with open(nrrd_path, "rb") as f:
+        header = nrrd.read_header(f)
+    assert header["space"] == "left-posterior-superior", f"Space should be 'left-posterior-superior', but it is {header['space']}"
+    flair_segment, dwi_segment = nrrd_segments(header, nrrd_path)
+    header, (flair_mask, dwi_mask) = decode_nrrd_layers(nrrd_path, [flair_segment, dwi_segment])
 
     affine = np.zeros((4,4))
-    affine[:3, :3] = header["space directions"][1:].T
+    affine[:3, :3] = np.asarray(header["space directions"][-3:], dtype=np.float64).T
     affine[3, 3] = 1
     affine[:3, 3] = header["space origin"]
 
@@ -95,31 +290,160 @@ def load_nrrd(nrrd_path: str) -> list[ants.ants_image.ANTsImage]:
     direction = affine[:3, :3] / spacing
 
     # create ANTs images
-    ants_flair = ants.from_numpy(flair_mask, origin=origin.tolist(), direction=direction.tolist(), spacing=spacing.tolist())
-    ants_dwi = ants.from_numpy(dwi_mask, origin=origin.tolist(), direction=direction.tolist(), spacing=spacing.tolist())
+    ants_flair = ants.from_numpy(np.ascontiguousarray(flair_mask), origin=origin.tolist(), direction=direction.tolist(), spacing=spacing.tolist())
+    ants_dwi = ants.from_numpy(np.ascontiguousarray(dwi_mask), origin=origin.tolist(), direction=direction.tolist(), spacing=spacing.tolist())
 
     return ants_flair, ants_dwi
 
-def invert_SyN_registration(image: ants.ants_image.ANTsImage, warp_file: str, affine_file: str) -> ants.ants_image.ANTsImage:
+def inverse_warp_file(warp_file: str) -> str:
+    """
+    Returns the path of the inverse displacement field saved next to the forward warp.
+
+    Parameters:
+        warp_file (str): The transformation warp file.
+
+    Returns:
+        str: The inverse warp file.
+    """
+    return os.path.join(os.path.dirname(warp_file), "inverse_warp.nii.gz")
+
+def compute_inverse_warp(warp_file: str, output_file: str) -> ants.ants_image.ANTsImage:
+    """
+    Computes the inverse of a displacement field by fixed point iteration (ants.invert_displacement_field)
+    initialized by the negated field and saves it. It is used for transforms registered before
+    the inverse warp from SyN registration has been saved.
+
+    Parameters:
+        warp_file (str): The transformation warp file.
+        output_file (str): The output inverse warp file.
+
+    Returns:
+        ants.ants_image.ANTsImage: The inverse displacement field.
+    """
+    warp = ants.image_read(warp_file)
+    inverse = ants.invert_displacement_field(warp, warp.apply(lambda x: -x))
+
+    # write to temporary file first, so other processes never read a partially written file
+    tmp_file = f"{output_file[:-len('.nii.gz')]}.tmp{os.getpid()}.nii.gz"
+    ants.image_write(inverse, tmp_file)
+    os.replace(tmp_file, output_file)
+    return inverse
+
+@functools.lru_cache(maxsize=16)
+def _load_inverse_transforms(warp_file: str, affine_file: str, modification_time: float) -> tuple[ants.ANTsTransform, ants.ANTsTransform]:
+    """
+    Loads (or computes and saves) the inverse warp and inverse affine transform.
+    Modification time of the forward warp is part of the cache key, so changed transforms are loaded again.
+    An existing inverse warp is used only if it is not older than the forward warp, otherwise it is computed again.
+    """
+    inverse_file = inverse_warp_file(warp_file)
+    if os.path.exists(inverse_file) and os.path.getmtime(inverse_file) >= modification_time:
+        inverse_warp = ants.image_read(inverse_file)
+    else:
+        inverse_warp = compute_inverse_warp(warp_file, inverse_file)
+
+    warptx = ants.transform_from_displacement_field(inverse_warp)
+    affinetx = ants.read_transform(affine_file).invert()
+    return warptx, affinetx
+
+def invert_SyN_registration(image: ants.ants_image.ANTsImage, warp_file: str, affine_file: str,
+                            reference: ants.ants_image.ANTsImage = None) -> ants.ants_image.ANTsImage:
     """
     Inverts the SyN registration for the given image using the provided warp and affine files.
 
+    The inverse displacement field saved by SyN registration (`inverse_warp.nii.gz` next to the warp file) is used.
+    If it does not exist, it is computed once and saved. Inverse transforms are cached in the process,
+    so repeated calls for the same subject do not read the transforms again.
+
     Parameters:
         image (ants.ants_image.ANTsImage): Image to invert the registration for.
         warp_file (str): The transformation warp file.
         affine_file (str): The affine transformation file.
+        reference (ants.ants_image.ANTsImage, optional): The reference space of the output. Defaults to the space of the image.
 
     Returns:
         ants.ants_image.ANTsImage: Applied inversion transformation of SyN to the image.
     """
-    warp = ants.image_read(warp_file).apply(lambda x: -x)
-    warptx = ants.transform_from_displacement_field(warp)
-    affinetx = ants.read_transform(affine_file).invert()
-    
+    warptx, affinetx = _load_inverse_transforms(warp_file, affine_file, os.path.getmtime(warp_file))
+
     inverted = warptx.apply_to_image(image)
-    inverted = affinetx.apply_to_image(inverted)
+    inverted = affinetx.apply_to_image(inverted, reference)
     return inverted
 
+@functools.lru_cache(maxsize=4)
+def load_template(template_file: str) -> ants.ants_image.ANTsImage:
+    """
+    Loads a template image. The image is read only once per process and shared by all callers,
+    thus it must not be modified.
+
+    Parameters:
+        template_file (str): The path to the template image.
+
+    Returns:
+        ants.ants_image.ANTsImage: The template image.
+    """
+    return ants.image_read(template_file)
+
+def compose_transforms(reference: ants.ants_image.ANTsImage, transform_files: list[str]) -> ants.ANTsTransform:
+    """
+    Composes transformations into a single displacement field transform defined on the reference grid.
+    Applying the composed transform resamples an image only once instead of once per transformation.
+
+    Parameters:
+        reference (ants.ants_image.ANTsImage): The reference space of the composed transform.
+        transform_files (list[str]): The transformation files in the order used by `ants.apply_transforms`,
+            e.g. [warp, affine] from SyN registration.
+
+    Returns:
+        ants.ANTsTransform: The composed displacement field transform.
+    """
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        field_file = ants.apply_transforms(reference, reference, transformlist=transform_files,
+                                           compose=os.path.join(tmp_folder, "composed_"))
+        field = ants.image_read(field_file)
+    return ants.transform_from_displacement_field(field)
+
+def bounding_box(mask: ants.ants_image.ANTsImage, margin: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the bounding box of non-zero voxels of the mask enlarged by the margin and limited to the image.
+
+    Parameters:
+        mask (ants.ants_image.ANTsImage): The mask.
+        margin (int, optional): Margin in voxels. Defaults to 0.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Lower (inclusive) and upper (exclusive) voxel indices. The whole image if the mask is empty.
+    """
+    data = mask.numpy()
+    shape = np.array(data.shape)
+    if not data.any():
+        return np.zeros_like(shape), shape
+    # project the mask to each axis instead of listing all non-zero voxels
+    lower, upper = [], []
+    for axis in range(data.ndim):
+        nonzero = np.flatnonzero(data.any(axis=tuple(a for a in range(data.ndim) if a != axis)))
+        lower.append(nonzero[0])
+        upper.append(nonzero[-1] + 1)
+    return np.maximum(np.array(lower) - margin, 0), np.minimum(np.array(upper) + margin, shape)
+
+def crop_to_bounding_box(image: ants.ants_image.ANTsImage, lower: np.ndarray, upper: np.ndarray) -> ants.ants_image.ANTsImage:
+    """
+    Crops the image to the voxel bounding box. The origin is moved to the first cropped voxel,
+    so the cropped image stays in the same physical space.
+
+    Parameters:
+        image (ants.ants_image.ANTsImage): The image.
+        lower (np.ndarray): Lower (inclusive) voxel indices.
+        upper (np.ndarray): Upper (exclusive) voxel indices.
+
+    Returns:
+        ants.ants_image.ANTsImage: The cropped image with the same pixel type.
+    """
+    region = tuple(slice(int(l), int(u)) for l, u in zip(lower, upper))
+    origin = ants.transform_index_to_physical_point(image, [int(l) for l in lower])
+    return ants.from_numpy(np.ascontiguousarray(image.numpy()[region]), origin=list(origin),
+                           spacing=list(image.spacing), direction=image.direction)
+
 def apply_transform_to_label(label: ants.ants_image.ANTsImage, transform: ants.ANTsTransform, reference: ants.ants_image.ANTsImage = None) -> ants.ants_image.ANTsImage:
     """
     Apply a transformation to the input label image.
@@ -130,11 +454,9 @@ def apply_transform_to_label(label: ants.ants_image.ANTsImage, transform: ants.A
         reference (ants.ants_image.ANTsImage, optional): The reference space for transformation. Defaults to None.
 
     Returns:
-        ants.ants_image.ANTsImage: The transformed label image as uint32 in reference space.
+        ants.ants_image.ANTsImage: The transformed label image as uint8 in reference space.
     """
-    # interpolation="genericLabel" or "genericlabel" throws: ITK ERROR: ResampleImageFilter(0x4572160): Interpolator not set
-    transformed = transform.apply_to_image(label.astype("float32"), reference, interpolation="linear")
-    return transformed.new_image_like(transformed.numpy().round().astype(np.uint32))
+    return apply_transform_to_labels([label], transform, reference)[0]
 
 def resample_label_to_target(label: ants.ants_image.ANTsImage, target_image: ants.ants_image.ANTsImage) -> ants.ants_image.ANTsImage:
     """
@@ -147,6 +469,96 @@ def resample_label_to_target(label: ants.ants_image.ANTsImage, target_image: ant
     Returns:
         ants.ants_image.ANTsImage: The resampled label image.
     """
-    # interpolation="genericlabel" gives output with floating point which results in smaller label
-    resampled = ants.resample_image_to_target(label.astype("float32"), target_image, interpolation="linear")
-    return resampled.new_image_like(resampled.numpy().round().astype(np.uint32))
\ No newline at end of file
+    return resample_labels_to_target([label], target_image)[0]
+
+def apply_transform_to_labels(labels: list[ants.ants_image.ANTsImage], transform: ants.ANTsTransform,
+                              reference: ants.ants_image.ANTsImage = None, interpolation: str = "linear",
+                              dtype: np.dtype = LABEL_DTYPE) -> list[ants.ants_image.ANTsImage]:
+    """
+    Apply a transformation to several binary masks which share the same grid.
+
+    With "linear" interpolation each mask is interpolated and rounded (it is equivalent to `apply_transform_to_label`).
+    With "nearestNeighbor" interpolation the masks are packed as bits of one image, which is resampled in a single pass.
+
+    Parameters:
+        labels (list[ants.ants_image.ANTsImage]): The input masks with the same shape, spacing, origin and direction.
+        transform (ants.ANTsTransform): The transformation to apply.
+        reference (ants.ants_image.ANTsImage, optional): The reference space for transformation. Defaults to None.
+        interpolation (str, optional): "linear" or "nearestNeighbor". Defaults to "linear".
+        dtype (np.dtype, optional): The data type of the output masks. Defaults to LABEL_DTYPE (uint8).
+
+    Returns:
+        list[ants.ants_image.ANTsImage]: The transformed masks in reference space.
+    """
+    _check_same_grid(labels)
+    if interpolation == "nearestNeighbor":
+        # interpolation="genericLabel" or "genericlabel" throws: ITK ERROR: ResampleImageFilter(0x4572160): Interpolator not set
+        packed = transform.apply_to_image(_pack_labels(labels), reference, interpolation="nearestneighbor")
+        return _unpack_labels(packed, len(labels), dtype)
+
+    assert interpolation == "linear", f"Unsupported interpolation: {interpolation}"
+    transformed = [transform.apply_to_image(label.astype("float32"), reference, interpolation="linear") for label in labels]
+    return [_round_label(label, dtype) for label in transformed]
+
+def resample_labels_to_target(labels: list[ants.ants_image.ANTsImage], target_image: ants.ants_image.ANTsImage,
+                              interpolation: str = "linear", dtype: np.dtype = LABEL_DTYPE) -> list[ants.ants_image.ANTsImage]:
+    """
+    Resamples several binary masks which share the same grid to the target image.
+
+    With "linear" interpolation each mask is interpolated and rounded (it is equivalent to `resample_label_to_target`).
+    With "nearestNeighbor" interpolation the masks are packed as bits of one image, which is resampled in a single pass.
+    With "genericLabel" interpolation each mask is resampled with ANTs label interpolator.
+
+    Parameters:
+        labels (list[ants.ants_image.ANTsImage]): The input masks with the same shape, spacing, origin and direction.
+        target_image (ants.ants_image.ANTsImage): The target image.
+        interpolation (str, optional): "linear", "nearestNeighbor" or "genericLabel". Defaults to "linear".
+        dtype (np.dtype, optional): The data type of the output masks. Defaults to LABEL_DTYPE (uint8).
+
+    Returns:
+        list[ants.ants_image.ANTsImage]: The resampled masks.
+    """
+    _check_same_grid(labels)
+    if interpolation == "nearestNeighbor":
+        packed = ants.resample_image_to_target(_pack_labels(labels), target_image, interp_type="nearestNeighbor")
+        return _unpack_labels(packed, len(labels), dtype)
+
+    # interpolation="genericlabel" gives output with floating point which results in smaller label, thus linear is default
+    assert interpolation in ("linear", "genericLabel"), f"Unsupported interpolation: {interpolation}"
+    resampled = [ants.resample_image_to_target(label.astype("float32"), target_image, interp_type=interpolation) for label in labels]
+    return [_round_label(label, dtype) for label in resampled]
+
+def _check_same_grid(labels: list[ants.ants_image.ANTsImage]):
+    """
+    Checks that all labels have the same shape, spacing, origin and direction.
+    """
+    for label in labels[1:]:
+        assert label.shape == labels[0].shape, f"Shape mismatch: {label.shape} != {labels[0].shape}"
+        assert np.allclose(label.spacing, labels[0].spacing), f"Spacing mismatch: {label.spacing} != {labels[0].spacing}"
+        assert np.allclose(label.origin, labels[0].origin), f"Origin mismatch: {label.origin} != {labels[0].origin}"
+        assert np.allclose(label.direction, labels[0].direction), f"Direction mismatch: {label.direction} != {labels[0].direction}"
+
+def _round_label(label: ants.ants_image.ANTsImage, dtype: np.dtype) -> ants.ants_image.ANTsImage:
+    """
+    Rounds interpolated float label in place and casts it to the given data type.
+    """
+    data = label.numpy()
+    np.rint(data, out=data)
+    return label.new_image_like(data.astype(dtype))
+
+def _pack_labels(labels: list[ants.ants_image.ANTsImage]) -> ants.ants_image.ANTsImage:
+    """
+    Packs binary masks into bits of one float32 image (float32 represents exactly up to 24 bits).
+    """
+    assert len(labels) <= 24, f"At most 24 labels can be packed, got {len(labels)}"
+    packed = np.zeros(labels[0].shape, dtype=np.float32)
+    for bit, label in enumerate(labels):
+        packed[label.numpy() != 0] += 1 << bit
+    return labels[0].new_image_like(packed)
+
+def _unpack_labels(packed: ants.ants_image.ANTsImage, n_labels: int, dtype: np.dtype) -> list[ants.ants_image.ANTsImage]:
+    """
+    Unpacks binary masks from bits of the packed image.
+    """
+    data = packed.numpy().round().astype(np.uint32)
+    return [packed.new_image_like(((data >> bit) & 1).astype(dtype)) for bit in range(n_labels)]
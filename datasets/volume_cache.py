@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import ants
+
+import datasets.sparse_mask as sparse_mask
+
+class VolumeCache():
+    """
+    On-disk cache of ANTs images. Each entry is a folder with uncompressed NIfTI images and a manifest.
+    Binary masks listed in `sparse_images` (labels, BET masks) are stored as run-length `.npz` files (`sparse_mask.SparseMask`).
+    Entries are addressed by a key computed from fingerprints of the source files and from the options
+    which were used to compute the images, so any change of the sources results in a new entry.
+    When the cache exceeds `max_size_gb`, the least recently used entries are removed.
+    """
+    def __init__(self, cache_dir: str = "datasets/cache/", max_size_gb: float = 50.0, hash_contents: bool = False,
+                 sparse_images: tuple[str] = ("label", "BETmask")):
+        """
+        Parameters:
+            cache_dir (str, optional): Folder with the cache entries. Defaults to "datasets/cache/".
+            max_size_gb (float, optional): Maximal size of the cache in GB. Defaults to 50.
+            hash_contents (bool, optional): Whether to fingerprint source files by SHA-1 of their contents.
+                Otherwise, the size and modification time are used. Defaults to False.
+            sparse_images (tuple[str], optional): Names of binary images stored as sparse masks. Defaults to ("label", "BETmask").
+        """
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        self.hash_contents = hash_contents
+        self.sparse_images = sparse_images
+
+    def file_fingerprint(self, path: str) -> list:
+        """
+        Computes fingerprint of a source file.
+
+        Parameters:
+            path (str): Path to the file.
+
+        Returns:
+            list: Absolute path with SHA-1 of the contents or with size and modification time.
+        """
+        if self.hash_contents:
+            sha1 = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(chunk)
+            return [os.path.abspath(path), sha1.hexdigest()]
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+    def make_key(self, files: list[str], options: dict) -> str:
+        """
+        Computes key of the cache entry.
+
+        Parameters:
+            files (list[str]): Source files of the entry.
+            options (dict): Options which influence the content of the entry (must be JSON serializable).
+
+        Returns:
+            str: The key.
+        """
+        fingerprint = {
+            "files": [self.file_fingerprint(file) for file in files],
+            "options": options
+        }
+        return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str, as_sparse: bool = False) -> dict[str, ants.ants_image.ANTsImage] | None:
+        """
+        Loads images of the cache entry and marks the entry as recently used.
+
+        Parameters:
+            key (str): Key of the entry.
+            as_sparse (bool, optional): Whether to return images from `sparse_images` as `sparse_mask.SparseMask`
+                without creating dense images. Defaults to False.
+
+        Returns:
+            dict[str, ants.ants_image.ANTsImage] | None: Images by their names or None if the entry does not exist.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        manifest_file = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            images = {}
+            for name, pixeltype in manifest["images"].items():
+                if name in manifest.get("sparse", []):
+                    mask = sparse_mask.SparseMask.load(os.path.join(entry, f"{name}.npz"))
+                    images[name] = mask if as_sparse else mask.to_ants().clone(pixeltype)
+                else:
+                    images[name] = ants.image_read(os.path.join(entry, f"{name}.nii")).clone(pixeltype)
+            os.utime(manifest_file)
+        except (OSError, ValueError, KeyError):
+            # missing entry or entry removed by another process
+            return None
+        return self._as_sparse(images) if as_sparse else images
+
+    def _as_sparse(self, images: dict[str, ants.ants_image.ANTsImage]) -> dict:
+        """
+        Converts dense images from `sparse_images` (e.g. of entries written before sparse storage) to sparse masks.
+        """
+        return {name: sparse_mask.SparseMask.from_ants(image) if name in self.sparse_images and isinstance(image, ants.ants_image.ANTsImage) else image
+                for name, image in images.items()}
+
+    def put(self, key: str, images: dict[str, ants.ants_image.ANTsImage]):
+        """
+        Saves images as a new cache entry. The entry is written to a temporary folder first,
+        so other processes never see a partially written entry.
+
+        Parameters:
+            key (str): Key of the entry.
+            images (dict[str, ants.ants_image.ANTsImage]): Images by their names.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+        try:
+            for name, image in images.items():
+                if name in self.sparse_images:
+                    sparse_mask.SparseMask.from_ants(image).save(os.path.join(tmp_entry, f"{name}.npz"))
+                else:
+                    ants.image_write(image, os.path.join(tmp_entry, f"{name}.nii"))
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as f:
+                json.dump({"created": time.time(), "images": {name: image.pixeltype for name, image in images.items()},
+                           "sparse": [name for name in images if name in self.sparse_images]}, f)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # entry has been already written by another process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def size(self) -> int:
+        """
+        Returns:
+            int: Size of all cache entries in bytes.
+        """
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is smaller than `max_size_gb`.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        max_size = self.max_size_gb * 1024**3
+        for entry, _, size in entries:
+            if total_size <= max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        """
+        Removes all cache entries.
+        """
+        for entry, _, _ in self._entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def _entries(self) -> list[tuple[str, float, int]]:
+        """
+        Lists the cache entries with their last access time and size in bytes.
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            manifest_file = os.path.join(entry, "manifest.json")
+            try:
+                last_access = os.stat(manifest_file).st_mtime
+                size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+            except OSError:
+                continue
+            entries.append((entry, last_access, size))
+        return entries
+
+class MNILabelStore(VolumeCache):
+    """
+    Persistent store of subject labels and BET masks transformed to the MNI space.
+    Entries are invalidated when any of the subject files or transformations (`flair_brain_to_mni/warp.nii.gz`,
+    `flair_brain_to_mni/affine.mat`, `dwi_to_flair_affine.mat`) or the MNI template change.
+    """
+    def __init__(self, cache_dir: str = "datasets/cache_mni/", max_size_gb: float = float("inf"), hash_contents: bool = False):
+        """
+        Parameters:
+            cache_dir (str, optional): Folder with the stored labels. Defaults to "datasets/cache_mni/".
+            max_size_gb (float, optional): Maximal size of the store in GB. Defaults to unlimited.
+            hash_contents (bool, optional): Whether to fingerprint source files by SHA-1 of their contents. Defaults to False.
+        """
+        super().__init__(cache_dir, max_size_gb, hash_contents)
+
+    def subject_key(self, subject, template_mni: str = "datasets/template_flair_mni.nii.gz", composite: bool = False) -> str:
+        """
+        Computes the key of the subject labels in MNI space from the subject files, transformations, template and options.
+        It can be used as a fingerprint of results computed from the stored labels.
+
+        Parameters:
+            subject (dataset_loaders.Subject): The subject, it must not be loaded.
+            template_mni (str, optional): The path to the MNI template image. Defaults to "datasets/template_flair_mni.nii.gz".
+            composite (bool, optional): Whether to use composed single-pass MNI transformation. Defaults to False.
+
+        Returns:
+            str: The key.
+        """
+        files = [subject.flair, subject.dwi, subject.label, subject.transform_dwi_to_flair, *subject.transform_flair_to_mni, template_mni]
+        if subject.BETmask:
+            files.append(subject.BETmask)
+        return self.make_key(files, {"step": "mni_label", "labeled_modality": subject.labeled_modality, "composite": composite})
+
+    def load(self, subject, template_mni: str = "datasets/template_flair_mni.nii.gz", composite: bool = False,
+             as_sparse: bool = False) -> dict[str, ants.ants_image.ANTsImage]:
+        """
+        Returns the label and BET mask of the subject in MNI space.
+        If they are not stored yet, the subject is loaded, brain extracted, transformed to MNI space
+        and checked for space integrity and empty label.
+
+        Parameters:
+            subject (dataset_loaders.Subject): The subject, it must not be loaded.
+            template_mni (str, optional): The path to the MNI template image. Defaults to "datasets/template_flair_mni.nii.gz".
+            composite (bool, optional): Whether to use composed single-pass MNI transformation. Defaults to False.
+            as_sparse (bool, optional): Whether to return the label and BET mask as `sparse_mask.SparseMask`. Defaults to False.
+
+        Returns:
+            dict[str, ants.ants_image.ANTsImage]: Images with keys "label" and "BETmask".
+        """
+        key = self.subject_key(subject, template_mni, composite)
+
+        images = self.get(key, as_sparse)
+        if images is not None:
+            return images
+
+        subject.load_data()
+        subject.extract_brain()
+        subject.apply_transform_to_mni(template_mni, composite)
+        subject.space_integrity_check()
+        subject.empty_label_check()
+        images = {"label": subject.label, "BETmask": subject.BETmask}
+        subject.free_data()
+
+        self.put(key, images)
+        return self._as_sparse(images) if as_sparse else images
@@ -1,27 +1,277 @@
 import nibabel as nib
 import numpy as np
 import argparse
+import functools
 import os
 
-def ensemble_func(data: np.ndarray) -> np.ndarray:
+import datasets.parallel as parallel
+
+STRATEGIES = ("mean", "majority", "staple")
+
+# number of voxels processed at once by the fusion strategies
+CHUNK_SIZE = 1 << 22
+
+def ensemble_func(data: np.ndarray, strategy: str = "mean", weights: list[float] = None,
+                  threshold: float = 0.5, soft: bool = False) -> np.ndarray:
     """
     This function takes a 3D numpy array with shape (z, y, x) as input, 
     where z is the number of models, and (y, x) is the spatial dimension.
-    It calculates the mean probability across all models, and then 
-    applies a threshold at 0.5 to convert the probabilities to binary 
-    segmentation masks. The resulting binary masks are then returned.
+    It fuses the probabilities of all models (by default it calculates the mean
+    probability across all models), and then applies a threshold at 0.5 to convert
+    the probabilities to binary segmentation masks. The resulting binary masks are then returned.
 
     Parameters:
         data (np.ndarray): A 4D numpy array with shape (z, y, x, c), where z is the number of models.
+            It can be also any iterable of per-model arrays, models are then processed one by one.
+        strategy (str, optional): Fusion strategy, see `fuse`. Defaults to "mean".
+        weights (list[float], optional): Weights of the models. Defaults to equal weights.
+        threshold (float, optional): Threshold of the fused probability. Defaults to 0.5.
+        soft (bool, optional): Whether to return fused probabilities instead of binary masks. Defaults to False.
 
     Returns:
         np.ndarray: A 3D numpy array with shape (y, x) containing binary segmentation masks.
     """
-    data = np.mean(data, axis=0)
-    data = (data >= 0.5).astype(np.uint8)
-    return data
+    return fuse(data, strategy, weights, threshold, soft)
+
+def fuse(models, strategy: str = "mean", weights: list[float] = None, threshold: float = 0.5,
+         soft: bool = False, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+    """
+    Fuses probability maps of several models. Models are consumed one by one and processed in chunks
+    of `chunk_size` voxels, so only the float32 result (and for STAPLE one integer code per voxel) is kept in memory.
+
+    Strategies:
+        "mean": (weighted) mean of probabilities.
+        "majority": (weighted) fraction of models which predict the voxel as lesion (probability >= 0.5).
+        "staple": posterior probability of lesion estimated by binary STAPLE from hard decisions of the models.
+
+    Parameters:
+        models (Iterable[np.ndarray]): Probability maps of the models with the same shape.
+        strategy (str, optional): One of "mean", "majority" and "staple". Defaults to "mean".
+        weights (list[float], optional): Weights of the models for "mean" and "majority", they must be None for "staple". Defaults to equal weights.
+        threshold (float, optional): Threshold of the fused probability. Defaults to 0.5.
+        soft (bool, optional): Whether to return fused probabilities (float32) instead of binary masks (uint8). Defaults to False.
+        chunk_size (int, optional): Number of voxels processed at once. Defaults to CHUNK_SIZE.
+
+    Returns:
+        np.ndarray: Fused probabilities or binary segmentation mask.
+    """
+    assert strategy in STRATEGIES, f"Unknown strategy {strategy}, use one of {STRATEGIES}"
+    assert strategy != "staple" or weights is None, "Weights are not supported by STAPLE, model reliabilities are estimated"
+    if strategy == "staple":
+        fused = _fuse_staple(models, chunk_size)
+    else:
+        fused = _fuse_weighted(models, weights, strategy == "majority", chunk_size)
+
+    if soft:
+        return fused
+    return (fused >= threshold).astype(np.uint8)
+
+def _memory_order(array: np.ndarray) -> str:
+    """
+    Returns memory order of the array ("F" for Fortran-ordered NIfTI data, "C" otherwise).
+    """
+    return "F" if array.flags.f_contiguous and not array.flags.c_contiguous else "C"
+
+def _fuse_weighted(models, weights: list[float], vote: bool, chunk_size: int) -> np.ndarray:
+    """
+    Computes weighted mean of probabilities (or of hard votes) model by model in a float32 accumulator.
+    """
+    fused = None
+    total_weight = 0.0
+    for i, model in enumerate(models):
+        model = np.asanyarray(model)
+        weight = 1.0 if weights is None else float(weights[i])
+        if fused is None:
+            order = _memory_order(model)
+            fused = np.zeros(model.shape, dtype=np.float32, order=order)
+            fused_flat = fused.ravel(order=order)
+        assert model.shape == fused.shape, f"Shape mismatch: {model.shape} != {fused.shape}"
+
+        model_flat = model.ravel(order=order)
+        for start in range(0, model_flat.size, chunk_size):
+            chunk = model_flat[start:start+chunk_size]
+            if vote:
+                chunk = chunk >= 0.5
+            fused_flat[start:start+chunk_size] += weight * chunk
+        total_weight += weight
+
+    assert fused is not None, "No models to fuse"
+    assert weights is None or len(weights) == i + 1, f"Number of weights {len(weights)} != number of models {i + 1}"
+    fused /= total_weight
+    return fused
+
+def _fuse_staple(models, chunk_size: int, max_iterations: int = 100, tolerance: float = 1e-6) -> np.ndarray:
+    """
+    Binary STAPLE fusion. Hard decisions of the models (probability >= 0.5) are packed into bits of one
+    integer code per voxel. Voxels with the same code have the same posterior, so the EM iterations run
+    only over the distinct codes weighted by their counts instead of over all voxels.
+    """
+    code = None
+    for i, model in enumerate(models):
+        assert i < 24, "STAPLE supports at most 24 models"
+        model = np.asanyarray(model)
+        if code is None:
+            order = _memory_order(model)
+            code = np.zeros(model.shape, dtype=np.uint32, order=order)
+            code_flat = code.ravel(order=order)
+        assert model.shape == code.shape, f"Shape mismatch: {model.shape} != {code.shape}"
+
+        model_flat = model.ravel(order=order)
+        for start in range(0, model_flat.size, chunk_size):
+            code_flat[start:start+chunk_size] |= (model_flat[start:start+chunk_size] >= 0.5).astype(np.uint32) << i
+    assert code is not None, "No models to fuse"
+    n_models = i + 1
+
+    # distinct decision patterns and their voxel counts
+    if n_models <= 16:
+        counts = np.bincount(code_flat, minlength=1 << n_models)
+        patterns = np.flatnonzero(counts)
+        counts = counts[patterns]
+    else:
+        patterns, counts = np.unique(code_flat, return_counts=True)
+    decisions = ((patterns[:, None] >> np.arange(n_models)) & 1).astype(np.float64)
+
+    posterior = staple(decisions, counts, max_iterations, tolerance).astype(np.float32)
+    fused = np.empty(code.shape, dtype=np.float32, order=order)
+    fused_flat = fused.ravel(order=order)
+    for start in range(0, code_flat.size, chunk_size):
+        fused_flat[start:start+chunk_size] = posterior[np.searchsorted(patterns, code_flat[start:start+chunk_size])]
+    return fused
+
+def staple(decisions: np.ndarray, counts: np.ndarray, max_iterations: int = 100, tolerance: float = 1e-6) -> np.ndarray:
+    """
+    Binary STAPLE (Warfield et al., 2004) with a fixed global prior. Estimates sensitivity and specificity
+    of each model with expectation-maximization and returns posterior probability of lesion.
+
+    Parameters:
+        decisions (np.ndarray): Hard decisions with shape (n_patterns, n_models).
+        counts (np.ndarray): Number of voxels with each decision pattern.
+        max_iterations (int, optional): Maximal number of EM iterations. Defaults to 100.
+        tolerance (float, optional): Convergence tolerance of sensitivities and specificities. Defaults to 1e-6.
+
+    Returns:
+        np.ndarray: Posterior probability of lesion for each decision pattern.
+    """
+    eps = 1e-7
+    prior = (counts @ decisions).sum() / (counts.sum() * decisions.shape[1])
+    if prior <= 0 or prior >= 1:
+        return decisions.mean(axis=1)
+
+    sensitivity = np.full(decisions.shape[1], 0.99)
+    specificity = np.full(decisions.shape[1], 0.99)
+    for _ in range(max_iterations):
+        # E-step in log space
+        log_lesion = np.log(prior) + decisions @ np.log(sensitivity) + (1 - decisions) @ np.log(1 - sensitivity)
+        log_background = np.log(1 - prior) + (1 - decisions) @ np.log(specificity) + decisions @ np.log(1 - specificity)
+        posterior = 1 / (1 + np.exp(log_background - log_lesion))
+
+        # M-step
+        lesion_weight = posterior * counts
+        background_weight = (1 - posterior) * counts
+        new_sensitivity = np.clip((lesion_weight @ decisions) / max(lesion_weight.sum(), eps), eps, 1 - eps)
+        new_specificity = np.clip((background_weight @ (1 - decisions)) / max(background_weight.sum(), eps), eps, 1 - eps)
+
+        converged = max(np.abs(new_sensitivity - sensitivity).max(), np.abs(new_specificity - specificity).max()) < tolerance
+        sensitivity, specificity = new_sensitivity, new_specificity
+        if converged:
+            break
+    return posterior
+
+def iter_nifti_probabilities(files: list[str]):
+    """
+    Reads probability maps saved in NIfTI files one model at a time. Each file is read exactly once.
+    Uncompressed `.nii` files without intensity scaling are returned as memory maps, so they are
+    read chunk by chunk during fusion. Compressed files are decoded as float32.
+
+    Parameters:
+        files (list[str]): NIfTI files with probability maps of the same case from different models.
+
+    Returns:
+        Iterator[np.ndarray]: Probability maps of the models.
+    """
+    for file in files:
+        image = nib.load(file)
+        if file.endswith(".nii"):
+            yield np.asanyarray(image.dataobj)
+        else:
+            yield image.get_fdata(dtype=np.float32)
+
+def iter_nnunet_probabilities(files: list[str]):
+    """
+    Reads foreground probabilities saved by nnUNet (`.npz` with key "probabilities") one model at a time.
+    Each file is read exactly once and only the foreground class is kept.
+
+    Parameters:
+        files (list[str]): nnUNet `.npz` files of the same case from different models.
+
+    Returns:
+        Iterator[np.ndarray]: Foreground probabilities of the models.
+    """
+    for file in files:
+        with np.load(file) as npz:
+            yield npz["probabilities"][1]
+
+def ensemble_case_nifti(filename: str, input_folders: list[str], output_folder: str, suffix: str, fusion: dict = None):
+    """
+    Ensembles one case with NIfTI probability maps and saves the segmentation.
+
+    Parameters:
+        filename (str): File name of the case in each input folder.
+        input_folders (list[str]): A list of paths to the input folders.
+        output_folder (str): The path to the output folder.
+        suffix (str): Suffix of the probability map, which is replaced by ".nii.gz" in the output file name.
+        fusion (dict, optional): Keyword arguments of `fuse` (strategy, weights, threshold, soft). Defaults to mean with threshold 0.5.
+    """
+    files = [os.path.join(folder, filename) for folder in input_folders]
+    affine = nib.load(files[0]).affine
+    data = fuse(iter_nifti_probabilities(files), **(fusion or {}))
+
+    new_nifti = nib.Nifti1Image(data, affine)
+    nib.save(new_nifti, os.path.join(output_folder, str(filename).replace(suffix, ".nii.gz")))
+
+def ensemble_case_nnUNet(filename: str, input_folders: list[str], output_folder: str, fusion: dict = None):
+    """
+    Ensembles one case with nnUNet probabilities and saves the segmentation.
 
-def ensemble_3DUNet(input_folders: list[str], output_folder: str):
+    Parameters:
+        filename (str): The `.npz` file name of the case in each input folder.
+        input_folders (list[str]): A list of paths to the input folders.
+        output_folder (str): The path to the output folder.
+        fusion (dict, optional): Keyword arguments of `fuse` (strategy, weights, threshold, soft). Defaults to mean with threshold 0.5.
+    """
+    data = fuse(iter_nnunet_probabilities([os.path.join(folder, filename) for folder in input_folders]), **(fusion or {}))
+    metadata = np.load(os.path.join(input_folders[0], str(filename).replace(".npz", ".pkl")), allow_pickle=True)
+
+    # prepare affine
+    affine = np.zeros((4,4))
+    affine[3, 3] = 1
+    affine[:3, :3] = np.array(metadata["sitk_stuff"]["direction"]).reshape(3,3)
+    affine[:3, 3] = metadata["sitk_stuff"]["origin"]
+    affine[0,:]=-affine[0,:]
+    affine[1,:]=-affine[1,:]
+
+    data = np.swapaxes(data, 0, 2)
+
+    new_nifti = nib.Nifti1Image(data, affine)
+    nib.save(new_nifti, os.path.join(output_folder, str(filename).replace(".npz", ".nii.gz")))
+
+def run_cases(ensemble_case, filenames: list[str], output_folder: str, n_workers: int):
+    """
+    Runs ensembling of cases in a pool of worker processes and reports saved and failed cases.
+
+    Parameters:
+        ensemble_case (Callable): Module level function which ensembles one case given its file name.
+        filenames (list[str]): File names of the cases.
+        output_folder (str): The path to the output folder.
+        n_workers (int): Number of worker processes.
+    """
+    for result in parallel.imap_jobs(ensemble_case, filenames, n_workers, itk_threads=1, ordered=False):
+        if result.ok:
+            print(f"Saved {result.item} to {output_folder}")
+        else:
+            print(f"Failed {result.item}:\n{result.error}")
+
+def ensemble_3DUNet(input_folders: list[str], output_folder: str, n_workers: int = 1, fusion: dict = None):
     """
     This function takes a list of folders as input, where each folder contains
     the predictions of a different model. The function then loads the data
@@ -31,17 +281,14 @@ def ensemble_3DUNet(input_folders: list[str], output_folder: str):
     Parameters:
         input_folders (list[str]): A list of paths to the input folders.
         output_folder (str): The path to the output folder.
+        n_workers (int, optional): Number of cases processed in parallel. Defaults to 1.
+        fusion (dict, optional): Keyword arguments of `fuse` (strategy, weights, threshold, soft). Defaults to mean with threshold 0.5.
     """
-    for filename in os.listdir(input_folders[0]):
-        if not filename.endswith("_probabilities.nii.gz"):
-            continue
-        data = np.array([nib.load(os.path.join(folder, filename)).get_fdata() for folder in input_folders])
-        data = ensemble_func(data)
-        new_nifti = nib.Nifti1Image(data, nib.load(os.path.join(input_folders[0], filename)).affine)
-        nib.save(new_nifti, os.path.join(output_folder, str(filename).replace("_probabilities.nii.gz", ".nii.gz")))
-        print(f"Saved {filename} to {output_folder}")
+    filenames = [filename for filename in os.listdir(input_folders[0]) if filename.endswith("_probabilities.nii.gz")]
+    ensemble_case = functools.partial(ensemble_case_nifti, input_folders=input_folders, output_folder=output_folder, suffix="_probabilities.nii.gz", fusion=fusion)
+    run_cases(ensemble_case, filenames, output_folder, n_workers)
 
-def ensemble_nnUNet(input_folders: list[str], output_folder: str):
+def ensemble_nnUNet(input_folders: list[str], output_folder: str, n_workers: int = 1, fusion: dict = None):
     """
     This function takes a list of folders as input, where each folder contains
     the predictions of a different model. The function then loads the data
@@ -51,32 +298,15 @@ def ensemble_nnUNet(input_folders: list[str], output_folder: str):
     Parameters:
         input_folders (list[str]): A list of paths to the input folders.
         output_folder (str): The path to the output folder.
+        n_workers (int, optional): Number of cases processed in parallel. Defaults to 1.
+        fusion (dict, optional): Keyword arguments of `fuse` (strategy, weights, threshold, soft). Defaults to mean with threshold 0.5.
     """
-    for filename in os.listdir(input_folders[0]):
-        # only consider .npz files
-        if not filename.endswith(".npz"):
-            continue
-
-        # load input data from all input folders
-        data = [np.load(os.path.join(folder, filename))["probabilities"][1] for folder in input_folders]
-        metadata = np.load(os.path.join(input_folders[0], str(filename).replace(".npz", ".pkl")), allow_pickle=True)
+    # only consider .npz files
+    filenames = [filename for filename in os.listdir(input_folders[0]) if filename.endswith(".npz")]
+    ensemble_case = functools.partial(ensemble_case_nnUNet, input_folders=input_folders, output_folder=output_folder, fusion=fusion)
+    run_cases(ensemble_case, filenames, output_folder, n_workers)
 
-        # prepare affine
-        affine = np.zeros((4,4))
-        affine[3, 3] = 1
-        affine[:3, :3] = np.array(metadata["sitk_stuff"]["direction"]).reshape(3,3)
-        affine[:3, 3] = metadata["sitk_stuff"]["origin"]
-        affine[0,:]=-affine[0,:]
-        affine[1,:]=-affine[1,:]
-        
-        data = ensemble_func(data)
-        data = np.swapaxes(data, 0, 2)
-
-        new_nifti = nib.Nifti1Image(data, affine)
-        nib.save(new_nifti, os.path.join(output_folder, str(filename).replace(".npz", ".nii.gz")))
-        print(f"Saved {filename} to {output_folder}")
-
-def ensemble_deepmedic(input_folders: list[str], output_folder: str):
+def ensemble_deepmedic(input_folders: list[str], output_folder: str, n_workers: int = 1, fusion: dict = None):
     """
     This function takes a list of folders as input, where each folder contains
     the predictions of a different model. The function then loads the data
@@ -86,20 +316,13 @@ def ensemble_deepmedic(input_folders: list[str], output_folder: str):
     Parameters:
         input_folders (list[str]): A list of paths to the input folders.
         output_folder (str): The path to the output folder.
+        n_workers (int, optional): Number of cases processed in parallel. Defaults to 1.
+        fusion (dict, optional): Keyword arguments of `fuse` (strategy, weights, threshold, soft). Defaults to mean with threshold 0.5.
     """
-    for filename in os.listdir(input_folders[0]):
-        # only consider ProbMapClass1.nii.gz files
-        if not filename.endswith("_ProbMapClass1.nii.gz"):
-            continue
-
-        # load input data from all input folders
-        data = [nib.load(os.path.join(folder, filename)).get_fdata() for folder in input_folders]
-        
-        data = ensemble_func(data)
-
-        new_nifti = nib.Nifti1Image(data, nib.load(os.path.join(input_folders[0], filename)).affine)
-        nib.save(new_nifti, os.path.join(output_folder, str(filename).replace("_ProbMapClass1.nii.gz", ".nii.gz")))
-        print(f"Saved {filename} to {output_folder}")
+    # only consider ProbMapClass1.nii.gz files
+    filenames = [filename for filename in os.listdir(input_folders[0]) if filename.endswith("_ProbMapClass1.nii.gz")]
+    ensemble_case = functools.partial(ensemble_case_nifti, input_folders=input_folders, output_folder=output_folder, suffix="_ProbMapClass1.nii.gz", fusion=fusion)
+    run_cases(ensemble_case, filenames, output_folder, n_workers)
 
 if __name__ == "__main__":
     
@@ -107,11 +330,20 @@ if __name__ == "__main__":
     args.add_argument("mode", type=str, choices=["nnUNet", "deepmedic", "3DUNet"])
     args.add_argument("output_folder", type=str)
     args.add_argument("input_folders", type=str, nargs="+")
+    args.add_argument("--workers", type=int, default=1, help="Number of cases processed in parallel")
+    args.add_argument("--strategy", type=str, default="mean", choices=STRATEGIES, help="Fusion strategy")
+    args.add_argument("--weights", type=float, nargs="+", default=None, help="Weights of the models (in the order of input folders) for mean and majority strategies")
+    args.add_argument("--threshold", type=float, default=0.5, help="Threshold of the fused probability")
+    args.add_argument("--soft", action="store_true", help="Save fused probabilities instead of binary segmentations")
     args = args.parse_args()
 
+    assert args.weights is None or len(args.weights) == len(args.input_folders), "Number of weights must be equal to number of input folders"
+    assert args.weights is None or args.strategy != "staple", "--weights cannot be used with --strategy staple"
+    fusion = {"strategy": args.strategy, "weights": args.weights, "threshold": args.threshold, "soft": args.soft}
+
     if args.mode == "nnUNet":
-        ensemble_nnUNet(args.input_folders, args.output_folder)
+        ensemble_nnUNet(args.input_folders, args.output_folder, args.workers, fusion)
     elif args.mode == "deepmedic":
-        ensemble_deepmedic(args.input_folders, args.output_folder)
+        ensemble_deepmedic(args.input_folders, args.output_folder, args.workers, fusion)
     #elif args.mode == "3DUNet":
-    #    ensemble_3DUNet(args.input_folders, args.output_folder)
+    #    ensemble_3DUNet(args.input_folders, args.output_folder, args.workers, fusion)
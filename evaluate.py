@@ -1,104 +1,76 @@
-import pandas as pd
 import numpy as np
 import ants
 import argparse
-
-from torchmetrics.classification import MulticlassStatScores, MulticlassF1Score
-import torch
+import functools
 
 import datasets.utils as utils
 import datasets.dataset_loaders as dataset_loaders
+import evaluation
 
 def load_label(subject: dataset_loaders.Subject):
     transform = ants.read_transform(subject.transform_dwi_to_flair)
-    BETmask = ants.image_read(subject.BETmask).astype("uint32")
+    BETmask = utils.as_label(ants.image_read(subject.BETmask))
 
     label_flair, label_dwi = utils.load_nrrd(subject.label)
 
-    # resample flair label to BETmask
+    # resample flair and dwi labels (they share the nrrd grid) to BETmask
     if label_flair.shape != BETmask.shape:
-        label_flair = utils.resample_label_to_target(label_flair, BETmask.astype("float32"))
-
-    # resample dwi label to flair
-    if label_dwi.shape != BETmask.shape:
-        label_dwi = utils.resample_label_to_target(label_dwi, BETmask.astype("float32"))
+        label_flair, label_dwi = utils.resample_labels_to_target([label_flair, label_dwi], BETmask.astype("float32"))
     
     label_dwi = utils.apply_transform_to_label(label_dwi, transform, BETmask.astype("float32"))
 
-    label_union = np.logical_or(label_flair.numpy(), label_dwi.numpy()).astype(np.uint32)
+    label_union = np.logical_or(label_flair.numpy(), label_dwi.numpy()).astype(utils.LABEL_DTYPE)
     label = label_flair.new_image_like(label_union)
     return label, label_dwi, label_flair, BETmask
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_folder", type=str, help="Folder with predictions, each segmentation should have format {case}_Anat_{date}.nii.gz")
-    parser.add_argument("output_file", type=str, help="Output file name (csv)")
-    parser.add_argument("--mni", action="store_true", help="Predictions are in MNI space")
-    args = parser.parse_args()
-
-    # ignore index 2 (outside BET mask) - it is important for corect Stat scores (true positives in ml, etc.)
-    stats = MulticlassStatScores(num_classes=2, average="none", ignore_index=2)
-    dice = MulticlassF1Score(num_classes=2, average="none", ignore_index=2)
-
-    gt_dataset = dataset_loaders.ISLES2022()
-    df = pd.DataFrame()
-    N = len(gt_dataset)
-    for i, subj in enumerate(gt_dataset):
-        print(f"Processing {subj.name} ({i+1}/{N})...")
-        case = {}
-
-        # load ground truth labels
-        label, gt_dwi, gt_flair, BETmask = load_label(subj)
-
-        # load prediction
-        pred_label = ants.image_read(f"{args.input_folder}/{subj.name}.nii.gz")
-        
-        # transform from MNI space
-        if args.mni:
-            pred_label = utils.invert_SyN_registration(pred_label.astype("float32"), subj.transform_flair_to_mni[0], subj.transform_flair_to_mni[1])
-            pred_label = pred_label.new_image_like(pred_label.numpy().round().astype(np.uint32))
+def evaluate_subject(subj: dataset_loaders.Subject, input_folder: str, mni: bool = False) -> dict:
+    """
+    Evaluates prediction of one subject against the union, FLAIR and DWI ground truth inside the BET mask.
 
-        pred_label = utils.resample_label_to_target(pred_label, label.astype("float32"))
-        assert label.shape == pred_label.shape, f"Shape mismatch: {label.shape} != {pred_label.shape}"
-        assert label.spacing == pred_label.spacing, f"Spacing mismatch: {label.spacing} != {pred_label.spacing}"
+    Parameters:
+        subj (dataset_loaders.Subject): The subject to evaluate.
+        input_folder (str): Folder with predictions.
+        mni (bool, optional): Predictions are in MNI space and they are transformed back to the subject space. Defaults to False.
 
-        # transfrorm to tensor
-        gt_label = label.numpy().astype(np.uint8)
-        gt_label[BETmask.numpy() == 0] = 2
-        gt_label = torch.from_numpy(gt_label)
+    Returns:
+        dict: Evaluation metrics, see `evaluation.case_metrics`, and Dice coefficients for FLAIR and DWI labels.
+    """
+    # load ground truth labels
+    label, gt_dwi, gt_flair, BETmask = load_label(subj)
 
-        gt_flair = gt_flair.numpy().astype(np.uint8)
-        gt_flair[BETmask.numpy() == 0] = 2
-        gt_flair = torch.from_numpy(gt_flair)
+    # load prediction
+    pred_label = evaluation.read_prediction(input_folder, subj.name)
 
-        gt_dwi = gt_dwi.numpy().astype(np.uint8)
-        gt_dwi[BETmask.numpy() == 0] = 2
-        gt_dwi = torch.from_numpy(gt_dwi)
+    # transform from MNI space
+    if mni:
+        pred_label = utils.invert_SyN_registration(pred_label.astype("float32"), subj.transform_flair_to_mni[0], subj.transform_flair_to_mni[1])
+        pred_label = pred_label.new_image_like(pred_label.numpy().round().astype(utils.LABEL_DTYPE))
 
-        pred_label = pred_label.numpy().astype(np.uint8)
-        pred_label[BETmask.numpy() == 0] = 2
-        pred_label = torch.from_numpy(pred_label)
+    pred_label = utils.resample_label_to_target(pred_label, label.astype("float32"))
+    assert label.shape == pred_label.shape, f"Shape mismatch: {label.shape} != {pred_label.shape}"
+    assert label.spacing == pred_label.spacing, f"Spacing mismatch: {label.spacing} != {pred_label.spacing}"
 
-        tp, fp, tn, fn, support = utils.voxel_count_to_volume_ml(stats(pred_label, gt_label).numpy()[1], label.spacing)
-        dc = dice(pred_label, gt_label).numpy()[1]
-        case["tp"] = tp
-        case["fp"] = fp
-        case["tn"] = tn
-        case["fn"] = fn
-        case["dc"] = dc
-        
-        n_pred = (pred_label==1).sum().numpy()
-        n_gt = (gt_label==1).sum().numpy()
-        pred_volume = utils.voxel_count_to_volume_ml(n_pred, label.spacing)
-        gt_volume = utils.voxel_count_to_volume_ml(n_gt, label.spacing)
-        case["pred_volume"] = pred_volume
-        case["gt_volume"] = gt_volume
+    # voxels outside BET mask are ignored - it is important for corect stat scores (true positives in ml, etc.)
+    # counts for union, FLAIR and DWI labels are computed in one pass
+    counts = evaluation.confusion_counts_multi(pred_label.numpy(), [label.numpy(), gt_flair.numpy(), gt_dwi.numpy()], BETmask.numpy())
+    case = evaluation.metrics_from_counts(*counts[0], label.spacing)
 
-        dc_flair = dice(pred_label, gt_flair).numpy()[1]
-        dc_dwi = dice(pred_label, gt_dwi).numpy()[1]
-        case["dc_flair"] = dc_flair
-        case["dc_dwi"] = dc_dwi
+    tp, fp, _, fn = counts[1]
+    case["dc_flair"] = evaluation.dice_from_counts(tp, fp, fn)
+    tp, fp, _, fn = counts[2]
+    case["dc_dwi"] = evaluation.dice_from_counts(tp, fp, fn)
+    return case
 
-        df = pd.concat([df, pd.DataFrame(case, index=[subj.name])])
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_folder", type=str, help="Folder with predictions, each segmentation should have format {case}_Anat_{date}.nii.gz (or sparse {case}_Anat_{date}.npz)")
+    parser.add_argument("output_file", type=str, help="Output file name (csv)")
+    parser.add_argument("--mni", action="store_true", help="Predictions are in MNI space")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--itk-threads", type=int, default=None, help="Number of ITK threads per worker (default: CPUs / workers)")
+    parser.add_argument("--no-resume", action="store_true", help="Evaluate all subjects again instead of skipping subjects already saved in the output file")
+    args = parser.parse_args()
 
-    df.to_csv(args.output_file)
+    gt_dataset = dataset_loaders.ISLES2022()
+    evaluate = functools.partial(evaluate_subject, input_folder=args.input_folder, mni=args.mni)
+    evaluation.evaluate_dataset(gt_dataset, evaluate, args.output_file, args.workers, args.itk_threads, resume=not args.no_resume)
@@ -1,82 +1,78 @@
-import pandas as pd
 import numpy as np
 import ants
 import argparse
-
-from torchmetrics.classification import MulticlassStatScores, MulticlassF1Score
-import torch
+import functools
 
 import datasets.utils as utils
 import datasets.dataset_loaders as dataset_loaders
+import datasets.volume_cache as volume_cache
+import evaluation
 
-def load_data(subject):
-    flair = ants.image_read(subject.flair)
-    transform = ants.read_transform(subject.transform_dwi_to_flair)
+def load_data(subject: dataset_loaders.Subject) -> tuple[ants.ants_image.ANTsImage, ants.ants_image.ANTsImage]:
+    """
+    Loads the label in FLAIR space and the BET mask (non-zero FLAIR voxels) by `Subject.load_data`,
+    so with the subject cache they are read from `datasets/cache/` instead of being transformed again.
 
-    label = ants.image_read(subject.label).astype("uint32")
-    if subject.labeled_modality == "dwi":
-        label = utils.apply_transform_to_label(label, transform, flair)
+    Parameters:
+        subject (dataset_loaders.Subject): The subject, it must not be loaded.
 
-    BETmask = flair.new_image_like((flair.numpy() != 0).astype("uint32"))
+    Returns:
+        tuple[ants.ants_image.ANTsImage, ants.ants_image.ANTsImage]: The label and the BET mask.
+    """
+    subject.load_data()
+    label, BETmask = subject.label, subject.BETmask
+    subject.free_data()
     return label, BETmask
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_folder", type=str, help="Folder with predictions, each segmentation should have format {case}_Anat_{date}.nii.gz")
-    parser.add_argument("output_file", type=str, help="Output file name (csv)")
-    parser.add_argument("--mni", action="store_true", help="Predictions are in MNI space")
-    args = parser.parse_args()
+def evaluate_subject(subj: dataset_loaders.Subject, input_folder: str, mni: bool = False, mni_space: bool = False) -> dict:
+    """
+    Evaluates prediction of one subject against the ground truth inside the BET mask.
 
-    # ignore index 2 (outside BET mask) - it is important for corect Stat scores (true positives in ml, etc.)
-    stats = MulticlassStatScores(num_classes=2, average="none", ignore_index=2)
-    dice = MulticlassF1Score(num_classes=2, average="none", ignore_index=2)
+    Parameters:
+        subj (dataset_loaders.Subject): The subject to evaluate.
+        input_folder (str): Folder with predictions.
+        mni (bool, optional): Predictions are in MNI space and they are transformed back to the subject space. Defaults to False.
+        mni_space (bool, optional): Predictions are evaluated in MNI space against stored MNI labels. Defaults to False.
 
-    gt_dataset = dataset_loaders.ISLES2022()
-    df = pd.DataFrame()
-    N = len(gt_dataset)
-    for i, subj in enumerate(gt_dataset):
-        print(f"Processing {subj.name} ({i+1}/{N})...")
-        case = {}
+    Returns:
+        dict: Evaluation metrics, see `evaluation.case_metrics`.
+    """
+    assert not (mni and mni_space), "Predictions are either transformed from MNI space (mni) or evaluated in MNI space (mni_space)"
 
-        # load ground truth labels
+    # load ground truth labels
+    if mni_space:
+        mni_images = volume_cache.MNILabelStore().load(subj)
+        label, BETmask = mni_images["label"], mni_images["BETmask"]
+    else:
         label, BETmask = load_data(subj)
 
-        # load prediction
-        pred_label = ants.image_read(f"{args.input_folder}/{subj.name}.nii.gz")
-        
-        # transform from MNI space
-        if args.mni:
-            pred_label = utils.invert_SyN_registration(pred_label.astype("float32"), subj.transform_flair_to_mni[0], subj.transform_flair_to_mni[1])
-            pred_label = pred_label.new_image_like(pred_label.numpy().round().astype(np.uint32))
+    # load prediction
+    pred_label = evaluation.read_prediction(input_folder, subj.name)
 
-        pred_label = utils.resample_label_to_target(pred_label, label.astype("float32"))
-        assert label.shape == pred_label.shape, f"Shape mismatch: {label.shape} != {pred_label.shape}"
-        assert label.spacing == pred_label.spacing, f"Spacing mismatch: {label.spacing} != {pred_label.spacing}"
+    # transform from MNI space
+    if mni:
+        pred_label = utils.invert_SyN_registration(pred_label.astype("float32"), subj.transform_flair_to_mni[0], subj.transform_flair_to_mni[1])
+        pred_label = pred_label.new_image_like(pred_label.numpy().round().astype(utils.LABEL_DTYPE))
 
-        # transfrorm to tensor
-        gt_label = label.numpy().astype(np.uint8)
-        gt_label[BETmask.numpy() == 0] = 2
-        gt_label = torch.from_numpy(gt_label)
+    pred_label = utils.resample_label_to_target(pred_label, label.astype("float32"))
+    assert label.shape == pred_label.shape, f"Shape mismatch: {label.shape} != {pred_label.shape}"
+    assert label.spacing == pred_label.spacing, f"Spacing mismatch: {label.spacing} != {pred_label.spacing}"
 
-        pred_label = pred_label.numpy().astype(np.uint8)
-        pred_label[BETmask.numpy() == 0] = 2
-        pred_label = torch.from_numpy(pred_label)
+    # voxels outside BET mask are ignored - it is important for corect stat scores (true positives in ml, etc.)
+    return evaluation.case_metrics(pred_label.numpy(), label.numpy(), BETmask.numpy(), label.spacing)
 
-        tp, fp, tn, fn, support = utils.voxel_count_to_volume_ml(stats(pred_label, gt_label).numpy()[1], label.spacing)
-        dc = dice(pred_label, gt_label).numpy()[1]
-        case["tp"] = tp
-        case["fp"] = fp
-        case["tn"] = tn
-        case["fn"] = fn
-        case["dc"] = dc
-        
-        n_pred = (pred_label==1).sum().numpy()
-        n_gt = (gt_label==1).sum().numpy()
-        pred_volume = utils.voxel_count_to_volume_ml(n_pred, label.spacing)
-        gt_volume = utils.voxel_count_to_volume_ml(n_gt, label.spacing)
-        case["pred_volume"] = pred_volume
-        case["gt_volume"] = gt_volume
-        
-        df = pd.concat([df, pd.DataFrame(case, index=[subj.name])])
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_folder", type=str, help="Folder with predictions, each segmentation should have format {case}_Anat_{date}.nii.gz (or sparse {case}_Anat_{date}.npz)")
+    parser.add_argument("output_file", type=str, help="Output file name (csv)")
+    mni_group = parser.add_mutually_exclusive_group()
+    mni_group.add_argument("--mni", action="store_true", help="Predictions are in MNI space")
+    mni_group.add_argument("--mni-space", action="store_true", help="Predictions are in MNI space and they are evaluated in MNI space against stored MNI labels (without inverse transform)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--itk-threads", type=int, default=None, help="Number of ITK threads per worker (default: CPUs / workers)")
+    parser.add_argument("--no-resume", action="store_true", help="Evaluate all subjects again instead of skipping subjects already saved in the output file")
+    args = parser.parse_args()
 
-    df.to_csv(args.output_file)
+    gt_dataset = dataset_loaders.ISLES2022(cache=volume_cache.VolumeCache())
+    evaluate = functools.partial(evaluate_subject, input_folder=args.input_folder, mni=args.mni, mni_space=args.mni_space)
+    evaluation.evaluate_dataset(gt_dataset, evaluate, args.output_file, args.workers, args.itk_threads, resume=not args.no_resume)
@@ -0,0 +1,58 @@
+import numpy as np
+import ants
+import argparse
+import functools
+
+import datasets.utils as utils
+import datasets.dataset_loaders as dataset_loaders
+import evaluate_isles
+import evaluation
+
+def evaluate_subject(subj: dataset_loaders.Subject, input_folder: str, thresholds: np.ndarray, mni: bool = False) -> list[dict]:
+    """
+    Evaluates soft prediction of one subject against the ground truth inside the BET mask for all thresholds.
+    The probability map is read and transformed to the subject space only once.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject to evaluate.
+        input_folder (str): Folder with probability maps (e.g. from `ensemble.py --soft`).
+        thresholds (np.ndarray): Sorted thresholds of the probability.
+        mni (bool, optional): Probability maps are in MNI space and they are transformed back to the subject space. Defaults to False.
+
+    Returns:
+        list[dict]: Evaluation metrics (see `evaluation.case_metrics`) for each threshold.
+    """
+    # load ground truth labels
+    label, BETmask = evaluate_isles.load_data(subj)
+
+    # load probabilities
+    probabilities = ants.image_read(f"{input_folder}/{subj.name}.nii.gz").astype("float32")
+
+    # transform from MNI space
+    if mni:
+        probabilities = utils.invert_SyN_registration(probabilities, subj.transform_flair_to_mni[0], subj.transform_flair_to_mni[1])
+
+    probabilities = ants.resample_image_to_target(probabilities, label.astype("float32"), interp_type="linear")
+    assert label.shape == probabilities.shape, f"Shape mismatch: {label.shape} != {probabilities.shape}"
+
+    counts = evaluation.threshold_sweep_counts(probabilities.numpy(), label.numpy(), BETmask.numpy(), thresholds)
+    rows = []
+    for threshold, (tp, fp, tn, fn) in zip(thresholds, counts):
+        rows.append({"threshold": round(float(threshold), 6), **evaluation.metrics_from_counts(tp, fp, tn, fn, label.spacing)})
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_folder", type=str, help="Folder with probability maps, each map should have format {case}.nii.gz")
+    parser.add_argument("output_file", type=str, help="Output file name (csv), one row for each subject and threshold")
+    parser.add_argument("--mni", action="store_true", help="Probability maps are in MNI space")
+    parser.add_argument("--thresholds", type=int, default=101, help="Number of thresholds evenly spaced between 0 and 1")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--itk-threads", type=int, default=None, help="Number of ITK threads per worker (default: CPUs / workers)")
+    parser.add_argument("--no-resume", action="store_true", help="Evaluate all subjects again instead of skipping subjects already saved in the output file")
+    args = parser.parse_args()
+
+    thresholds = np.linspace(0, 1, args.thresholds)
+    gt_dataset = dataset_loaders.ISLES2022()
+    evaluate = functools.partial(evaluate_subject, input_folder=args.input_folder, thresholds=thresholds, mni=args.mni)
+    evaluation.evaluate_dataset(gt_dataset, evaluate, args.output_file, args.workers, args.itk_threads, resume=not args.no_resume)
@@ -0,0 +1,251 @@
+import os
+import csv
+import numpy as np
+import pandas as pd
+from collections.abc import Callable
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.parallel as parallel
+import datasets.sparse_mask as sparse_mask
+import datasets.utils as utils
+
+def confusion_counts(pred: np.ndarray, gt: np.ndarray, mask: np.ndarray) -> tuple[int, int, int, int]:
+    """
+    Counts true positives, false positives, true negatives and false negatives inside the mask in one pass.
+
+    Parameters:
+        pred (np.ndarray): Binary prediction.
+        gt (np.ndarray): Binary ground truth.
+        mask (np.ndarray): Region where voxels are counted (e.g. BET mask), voxels outside are ignored.
+
+    Returns:
+        tuple[int, int, int, int]: Number of voxels TP, FP, TN, FN.
+    """
+    tp, fp, tn, fn = confusion_counts_multi(pred, [gt], mask)[0]
+    return int(tp), int(fp), int(tn), int(fn)
+
+def confusion_counts_multi(pred: np.ndarray, gts: list[np.ndarray], mask: np.ndarray) -> np.ndarray:
+    """
+    Counts true positives, false positives, true negatives and false negatives of one prediction
+    against several ground truths inside the mask in a single pass over the volume.
+
+    Each voxel is encoded as one byte: bit 0 is the prediction, bit i+1 is the i-th ground truth and the
+    highest used bit marks voxels outside the mask. The codes are counted with `np.bincount`
+    and confusion counts of each ground truth are obtained by summing the histogram over the other bits.
+
+    Parameters:
+        pred (np.ndarray): Binary prediction.
+        gts (list[np.ndarray]): Binary ground truths with the same shape as the prediction (at most 6).
+        mask (np.ndarray): Region where voxels are counted (e.g. BET mask), voxels outside are ignored.
+
+    Returns:
+        np.ndarray: Array with shape (len(gts), 4) with number of voxels TP, FP, TN, FN for each ground truth.
+    """
+    n = len(gts)
+    assert 1 <= n <= 6, f"Between 1 and 6 ground truths are supported, got {n}"
+
+    code = (pred != 0).view(np.uint8)
+    buffer = np.empty_like(code)
+    for i, gt in enumerate(gts):
+        code |= np.left_shift(np.not_equal(gt, 0).view(np.uint8), i + 1, out=buffer)
+    code |= np.left_shift(np.equal(mask, 0).view(np.uint8), n + 1, out=buffer)
+
+    histogram = np.bincount(code.ravel(), minlength=1 << (n + 2))[:1 << (n + 1)]
+    codes = np.arange(1 << (n + 1))
+    pred_bit = (codes & 1) == 1
+
+    counts = np.empty((n, 4), dtype=np.int64)
+    for i in range(n):
+        gt_bit = ((codes >> (i + 1)) & 1) == 1
+        counts[i] = [histogram[pred_bit & gt_bit].sum(), histogram[pred_bit & ~gt_bit].sum(),
+                     histogram[~pred_bit & ~gt_bit].sum(), histogram[~pred_bit & gt_bit].sum()]
+    return counts
+
+def dice_from_counts(tp: int, fp: int, fn: int) -> float:
+    """
+    Computes Dice coefficient from confusion counts. If there are no positive voxels, Dice is 0 (as in torchmetrics F1 score).
+
+    Parameters:
+        tp (int): Number of true positives.
+        fp (int): Number of false positives.
+        fn (int): Number of false negatives.
+
+    Returns:
+        float: The Dice coefficient.
+    """
+    denominator = 2 * tp + fp + fn
+    return 2 * tp / denominator if denominator > 0 else 0.0
+
+def case_metrics(pred: np.ndarray, gt: np.ndarray, mask: np.ndarray, spacing: tuple[float, float, float]) -> dict:
+    """
+    Computes evaluation metrics of one case inside the mask.
+
+    Parameters:
+        pred (np.ndarray): Binary prediction.
+        gt (np.ndarray): Binary ground truth.
+        mask (np.ndarray): Region where metrics are computed (e.g. BET mask).
+        spacing (tuple[float, float, float]): Voxel spacing in mm.
+
+    Returns:
+        dict: TP, FP, TN, FN in ml, Dice coefficient and volumes of prediction and ground truth in ml.
+    """
+    tp, fp, tn, fn = confusion_counts(pred, gt, mask)
+    return metrics_from_counts(tp, fp, tn, fn, spacing)
+
+def metrics_from_counts(tp: int, fp: int, tn: int, fn: int, spacing: tuple[float, float, float]) -> dict:
+    """
+    Converts confusion counts of one case to evaluation metrics.
+
+    Parameters:
+        tp (int): Number of true positives.
+        fp (int): Number of false positives.
+        tn (int): Number of true negatives.
+        fn (int): Number of false negatives.
+        spacing (tuple[float, float, float]): Voxel spacing in mm.
+
+    Returns:
+        dict: TP, FP, TN, FN in ml, Dice coefficient and volumes of prediction and ground truth in ml.
+    """
+    return {
+        "tp": utils.voxel_count_to_volume_ml(tp, spacing),
+        "fp": utils.voxel_count_to_volume_ml(fp, spacing),
+        "tn": utils.voxel_count_to_volume_ml(tn, spacing),
+        "fn": utils.voxel_count_to_volume_ml(fn, spacing),
+        "dc": dice_from_counts(tp, fp, fn),
+        "pred_volume": utils.voxel_count_to_volume_ml(tp + fp, spacing),
+        "gt_volume": utils.voxel_count_to_volume_ml(tp + fn, spacing)
+    }
+
+def threshold_sweep_counts(probabilities: np.ndarray, gt: np.ndarray, mask: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """
+    Counts true positives, false positives, true negatives and false negatives inside the mask for all thresholds at once.
+    Each voxel is assigned the number of thresholds which are lower or equal to its probability,
+    the numbers are counted separately for lesion and background voxels and the cumulative sums of
+    these histograms give counts for every threshold. Thus many thresholds cost about the same as one.
+
+    Parameters:
+        probabilities (np.ndarray): Predicted probabilities.
+        gt (np.ndarray): Binary ground truth.
+        mask (np.ndarray): Region where voxels are counted (e.g. BET mask), voxels outside are ignored.
+        thresholds (np.ndarray): Sorted thresholds, voxel is predicted as lesion if its probability >= threshold.
+
+    Returns:
+        np.ndarray: Array with shape (len(thresholds), 4) with number of voxels TP, FP, TN, FN for each threshold.
+    """
+    inside = mask != 0
+    levels = np.searchsorted(thresholds, probabilities[inside], side="right")
+    lesion = gt[inside] != 0
+
+    n_levels = len(thresholds) + 1
+    lesion_histogram = np.bincount(levels[lesion], minlength=n_levels)
+    background_histogram = np.bincount(levels[~lesion], minlength=n_levels)
+
+    # number of voxels with level >= k + 1, i.e. with probability >= thresholds[k]
+    tp = np.cumsum(lesion_histogram[::-1])[::-1][1:]
+    fp = np.cumsum(background_histogram[::-1])[::-1][1:]
+    fn = lesion_histogram.sum() - tp
+    tn = background_histogram.sum() - fp
+    return np.stack([tp, fp, tn, fn], axis=1)
+
+def read_prediction(input_folder: str, name: str):
+    """
+    Reads the prediction of the case, sparse masks (`{name}.npz`, see `datasets/sparse_mask.py`) are preferred to `{name}.nii.gz`.
+
+    Parameters:
+        input_folder (str): Folder with predictions.
+        name (str): Name of the case.
+
+    Returns:
+        ants.ants_image.ANTsImage: The prediction.
+    """
+    sparse_file = os.path.join(input_folder, f"{name}.npz")
+    if os.path.exists(sparse_file):
+        return sparse_mask.read_image(sparse_file)
+    return sparse_mask.read_image(os.path.join(input_folder, f"{name}.nii.gz"))
+
+def finished_cases(output_file: str) -> set[str]:
+    """
+    Reads names of cases which are already saved in the output csv file. Only rows with all columns of the header
+    are complete. If the run was killed while writing, cases with an incomplete row are removed from the file
+    (it is rewritten atomically), so they are evaluated again and new rows do not continue the truncated line.
+
+    Parameters:
+        output_file (str): The csv file with results, the first column contains case names.
+
+    Returns:
+        set[str]: Names of finished cases.
+    """
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return set()
+    with open(output_file, newline="") as f:
+        content = f.read()
+    rows = list(csv.reader(content.splitlines()))
+    header, rows = rows[0], [row for row in rows[1:] if row]
+    # the last row is incomplete also if its line is not terminated (e.g. the last value is truncated)
+    incomplete = {row[0] for row in rows if len(row) != len(header)}
+    if rows and not content.endswith("\n"):
+        incomplete.add(rows[-1][0])
+
+    if incomplete or not content.endswith("\n"):
+        tmp_file = f"{output_file}.tmp"
+        with open(tmp_file, "w", newline="") as f:
+            csv.writer(f).writerows([header] + [row for row in rows if row[0] not in incomplete])
+        os.replace(tmp_file, output_file)
+    return {row[0] for row in rows if row[0] not in incomplete}
+
+def evaluate_dataset(dataset: list[dataset_loaders.Subject],
+                     evaluate_subject: Callable[[dataset_loaders.Subject], dict],
+                     output_file: str,
+                     n_workers: int = 1,
+                     itk_threads: int = None,
+                     resume: bool = True):
+    """
+    Evaluates subjects in a pool of worker processes and streams results to the csv file as they finish.
+    Rows are written and flushed for each finished subject, so an interrupted run can be resumed
+    and only the missing subjects are evaluated. At the end, rows are sorted in the dataset order.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): Subjects to evaluate.
+        evaluate_subject (Callable): Module level function which returns a dict with metrics of a subject
+            or a list of dicts if there are more rows per subject.
+        output_file (str): The csv file with results, indexed by subject names.
+        n_workers (int, optional): Number of worker processes. Defaults to 1.
+        itk_threads (int, optional): Number of ITK threads per worker. Defaults to CPUs divided by workers.
+        resume (bool, optional): Whether to skip subjects which are already in the output file. Defaults to True.
+    """
+    if not resume and os.path.exists(output_file):
+        os.remove(output_file)
+    done = finished_cases(output_file)
+    todo = [subj for subj in dataset if subj.name not in done]
+    print(f"Evaluating {len(todo)} subjects ({len(done)} already finished)...")
+
+    failures = []
+    header_written = os.path.exists(output_file) and os.path.getsize(output_file) > 0
+    with open(output_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        for i, result in enumerate(parallel.imap_jobs(evaluate_subject, todo, n_workers, itk_threads, ordered=False)):
+            if not result.ok:
+                print(f"Failed {result.item.name} ({i+1}/{len(todo)})")
+                failures.append(result)
+                continue
+
+            rows = result.result if isinstance(result.result, list) else [result.result]
+            if not header_written:
+                writer.writerow([""] + list(rows[0].keys()))
+                header_written = True
+            writer.writerows([[result.item.name] + list(row.values()) for row in rows])
+            f.flush()
+            print(f"Processed {result.item.name} ({i+1}/{len(todo)}) in {result.duration:.1f} s")
+
+    if failures:
+        parallel.write_failures(failures, f"{output_file}.failures.txt")
+        print(f"{len(failures)} subjects failed: {', '.join(f.item.name for f in failures)}")
+
+    # sort rows in the dataset order
+    if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+        df = pd.read_csv(output_file, index_col=0)
+        order = [subj.name for subj in dataset if subj.name in df.index]
+        # write to a temporary file first, so an interrupted sort does not truncate the results
+        tmp_file = f"{output_file}.tmp"
+        df.loc[order].to_csv(tmp_file)
+        os.replace(tmp_file, output_file)
@@ -1,46 +1,143 @@
 import ants
 import os
+import argparse
+import functools
 import multiprocessing
 
 from datasets.utils import *
 import datasets.dataset_loaders
+import datasets.parallel as parallel
+import datasets.compact_dataset as compact_dataset
+
+def preprocess_subject(subj: datasets.dataset_loaders.Subject,
+                       output_folder: str = "nnunet_workspace/nnUNet_raw/",
+                       export_format: str = "nifti") -> dict:
+    """
+    Loads, preprocesses and writes a single subject in nnUNet format and/or to the compact dataset.
+
+    Args:
+        subj (datasets.dataset_loaders.Subject): The subject to be preprocessed.
+        output_folder (str): The path to the output folder where preprocessed data will be saved.
+            Defaults to "nnunet_workspace/nnUNet_raw/".
+        export_format (str): "nifti", "compact" or "both". Defaults to "nifti".
+
+    Returns:
+        dict: Metadata of the subject in the compact dataset, None if it is not exported to the compact dataset.
+    """
+    subj.load_data()
+    subj.extract_brain()
+    subj.apply_transform_to_mni()
+    subj.resample_to_target()
+    subj.space_integrity_check()
+    subj.empty_label_check()
+
+    if export_format in ("nifti", "both"):
+        ants.image_write(subj.flair, f"{output_folder}/Dataset011_StrokesMNI/imagesTr/{subj.name}_0000.nii.gz")
+        ants.image_write(subj.dwi, f"{output_folder}/Dataset011_StrokesMNI/imagesTr/{subj.name}_0001.nii.gz")
+        ants.image_write(subj.label, f"{output_folder}/Dataset011_StrokesMNI/labelsTr/{subj.name}.nii.gz")
+
+    metadata = None
+    if export_format in ("compact", "both"):
+        metadata = compact_dataset.write_subject(f"{output_folder}/Dataset011_StrokesMNI/compact", subj)
+
+    subj.free_data()
+    return metadata
+
+def create_output_folders(dataset: list[datasets.dataset_loaders.Subject],
+                          output_folder: str = "nnunet_workspace/nnUNet_raw/",
+                          export_format: str = "nifti"):
+    """
+    Creates nnUNet folders and/or an empty compact dataset with a slot for each subject.
+
+    Args:
+        dataset (list[datasets.dataset_loaders.Subject]): The list of subjects to be preprocessed.
+        output_folder (str): The path to the output folder where preprocessed data will be saved.
+        export_format (str): "nifti", "compact" or "both".
+    """
+    assert export_format in ("nifti", "compact", "both"), f"Unknown export format: {export_format}"
+    if export_format in ("nifti", "both"):
+        os.makedirs(f"{output_folder}/Dataset011_StrokesMNI/imagesTr", exist_ok=True)
+        os.makedirs(f"{output_folder}/Dataset011_StrokesMNI/labelsTr", exist_ok=True)
+    if export_format in ("compact", "both"):
+        # all subjects are resampled to the same shape by resample_to_target
+        compact_dataset.create(f"{output_folder}/Dataset011_StrokesMNI/compact", [subj.name for subj in dataset], (200, 200, 200))
 
 def preprocessing(dataset: list[datasets.dataset_loaders.Subject],
-                  output_folder: str = "nnunet_workspace/nnUNet_raw/"):
+                  output_folder: str = "nnunet_workspace/nnUNet_raw/",
+                  export_format: str = "nifti"):
     """
     Preprocesses the dataset by creating necessary folders, loading data, and writing images using ANTs.
 
     Args:
         dataset (list[datasets.dataset_loaders.Subject]): The list of subjects to be preprocessed.
-        output_folder (str): The path to the output folder where preprocessed data will be saved. 
+        output_folder (str): The path to the output folder where preprocessed data will be saved.
             Defaults to "nnunet_workspace/nnUNet_raw/".
+        export_format (str): "nifti" (nnUNet format), "compact" (memory-mappable `compact` folder, see
+            `datasets/compact_dataset.py`) or "both". Defaults to "nifti".
     """
-    os.makedirs(f"{output_folder}/Dataset011_StrokesMNI/imagesTr", exist_ok=True)
-    os.makedirs(f"{output_folder}/Dataset011_StrokesMNI/labelsTr", exist_ok=True)
-    
+    create_output_folders(dataset, output_folder, export_format)
+
     N = len(dataset)
+    subjects = []
     for i, subj in enumerate(dataset):
         print(f"Processing {subj.name} ({i+1}/{N})...")
+        subjects.append(preprocess_subject(subj, output_folder, export_format))
 
-        subj.load_data()
-        subj.extract_brain()
-        subj.apply_transform_to_mni()
-        subj.resample_to_target()
-        subj.space_integrity_check()
-        subj.empty_label_check()
+    if export_format in ("compact", "both"):
+        compact_dataset.write_index(f"{output_folder}/Dataset011_StrokesMNI/compact", subjects, normalization=None)
 
-        ants.image_write(subj.flair, f"{output_folder}/Dataset011_StrokesMNI/imagesTr/{subj.name}_0000.nii.gz")
-        ants.image_write(subj.dwi, f"{output_folder}/Dataset011_StrokesMNI/imagesTr/{subj.name}_0001.nii.gz")
-        ants.image_write(subj.label, f"{output_folder}/Dataset011_StrokesMNI/labelsTr/{subj.name}.nii.gz")
-        
-        subj.free_data()
+def preprocessing_parallel(dataset: list[datasets.dataset_loaders.Subject],
+                           output_folder: str = "nnunet_workspace/nnUNet_raw/",
+                           n_workers: int = None,
+                           itk_threads: int = None,
+                           export_format: str = "nifti"):
+    """
+    Preprocesses the dataset in a pool of worker processes, one subject per job.
+    Failed subjects do not stop the run, their tracebacks are saved to `failures.txt` in the dataset folder.
+
+    Args:
+        dataset (list[datasets.dataset_loaders.Subject]): The list of subjects to be preprocessed.
+        output_folder (str): The path to the output folder where preprocessed data will be saved.
+            Defaults to "nnunet_workspace/nnUNet_raw/".
+        n_workers (int, optional): Number of worker processes. Defaults to number of CPUs.
+        itk_threads (int, optional): Number of ITK threads per worker. Defaults to CPUs divided by workers.
+        export_format (str, optional): "nifti", "compact" or "both". Defaults to "nifti".
+    """
+    create_output_folders(dataset, output_folder, export_format)
+
+    N = len(dataset)
+    failures = []
+    subjects = []
+    job = functools.partial(preprocess_subject, output_folder=output_folder, export_format=export_format)
+    for i, result in enumerate(parallel.imap_jobs(job, dataset, n_workers, itk_threads)):
+        status = "done" if result.ok else "FAILED"
+        print(f"Processed {result.item.name} ({i+1}/{N}) in {result.duration:.1f} s: {status}")
+        subjects.append(result.result)
+        if not result.ok:
+            failures.append(result)
+
+    if export_format in ("compact", "both"):
+        compact_dataset.write_index(f"{output_folder}/Dataset011_StrokesMNI/compact", subjects, normalization=None)
+
+    if failures:
+        parallel.write_failures(failures, f"{output_folder}/Dataset011_StrokesMNI/failures.txt")
+        print(f"{len(failures)}/{N} subjects failed: {', '.join(f.item.name for f in failures)}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, with more than 1 worker subjects are processed in parallel")
+    parser.add_argument("--itk-threads", type=int, default=None, help="Number of ITK threads per worker (default: CPUs / workers)")
+    parser.add_argument("--format", type=str, default="nifti", choices=["nifti", "compact", "both"], help="Export format: nnUNet NIfTI files, compact memory-mappable dataset or both")
+    args = parser.parse_args()
+
     # load datasets
     isles2022 = datasets.dataset_loaders.ISLES2022()
 
-    # run preprocessing for each dataset in parallel
-    isles22_p = multiprocessing.Process(target=preprocessing,
-                                        args=[isles2022])
-    
-    isles22_p.start()
+    if args.workers > 1:
+        preprocessing_parallel(isles2022, n_workers=args.workers, itk_threads=args.itk_threads, export_format=args.format)
+    else:
+        # run preprocessing for each dataset in parallel
+        isles22_p = multiprocessing.Process(target=preprocessing,
+                                            args=[isles2022, "nnunet_workspace/nnUNet_raw/", args.format])
+
+        isles22_p.start()
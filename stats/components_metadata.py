@@ -1,134 +1,218 @@
+import os
 import ants
 import cc3d
+import argparse
 import numpy as np
 import pandas as pd
 import datasets.dataset_loaders as dataset_loaders
 import datasets.utils as utils
+import datasets.volume_cache as volume_cache
+
+def component_stats(label: ants.ants_image.ANTsImage, name: str, connectivity: int = 26,
+                    regions: np.ndarray = None, region_names: list[str] = None) -> pd.DataFrame:
+    """
+    Compute connected components of a binary image (label or prediction) and their statistics in one pass:
+    volume, centroid in physical coordinates, bounding box, extent (fraction of the bounding box filled by the component)
+    and optionally the atlas region which contains most of the component.
+
+    Parameters:
+        label (ants.ants_image.ANTsImage): The binary image.
+        name (str): Name of the subject.
+        connectivity (int, optional): The connectivity to use for the connected components. Defaults to 26.
+        regions (np.ndarray, optional): Image of region indices in the grid of the label (e.g. `stats.lesion_atlas.region_image`). Defaults to None.
+        region_names (list[str], optional): Names of the regions by index. Defaults to None.
+
+    Returns:
+        pd.DataFrame: A DataFrame with one row per component with columns 'name', 'volume_ml', 'voxels', 'centroid_x/y/z',
+            'bbox_min_x/y/z', 'bbox_max_x/y/z' (voxel indices, exclusive max), 'extent' and 'region' (if regions are given).
+    """
+    components, N = cc3d.connected_components(label.numpy() != 0, connectivity=connectivity, return_N=True)
+    if N == 0:
+        return pd.DataFrame()
+
+    stats = cc3d.statistics(components)
+    voxels = stats["voxel_counts"][1:]
+    bbox_min = np.array([[s.start for s in bbox] for bbox in stats["bounding_boxes"][1:]])
+    bbox_max = np.array([[s.stop for s in bbox] for bbox in stats["bounding_boxes"][1:]])
+
+    # centroids from voxel indices to physical coordinates
+    centroids = np.asarray(stats["centroids"][1:], dtype=np.float64)
+    centroids = np.asarray(label.origin) + (centroids * np.asarray(label.spacing)) @ np.asarray(label.direction).T
+
+    df = pd.DataFrame({
+        "name": name,
+        "volume_ml": utils.voxel_count_to_volume_ml(voxels, label.spacing),
+        "voxels": voxels,
+        **{f"centroid_{axis}": centroids[:, i] for i, axis in enumerate("xyz")},
+        **{f"bbox_min_{axis}": bbox_min[:, i] for i, axis in enumerate("xyz")},
+        **{f"bbox_max_{axis}": bbox_max[:, i] for i, axis in enumerate("xyz")},
+        "extent": voxels / np.prod(bbox_max - bbox_min, axis=1)
+    })
+
+    if regions is not None:
+        # count (component, region) pairs of lesion voxels only and take the most frequent region of each component
+        lesion = components != 0
+        n_regions = int(regions.max()) + 1
+        pairs = np.bincount(components[lesion].astype(np.int64) * n_regions + regions[lesion], minlength=(N + 1) * n_regions)
+        region = pairs.reshape(N + 1, n_regions)[1:].argmax(axis=1)
+        df["region"] = [region_names[r] for r in region] if region_names is not None else region
+
+    return df
 
 def components(subject: dataset_loaders.Subject, connectivity=26) -> pd.DataFrame:
     """
-    Compute connected components of a label image and compute volume of each component.
+    Compute connected components of a label image and compute volume and other statistics of each component.
 
     Parameters:
         subject (dataset_loaders.Subject): The subject to process.
         connectivity (int, optional): The connectivity to use for the connected components. Defaults to 26.
 
     Returns:
-        pd.DataFrame: A DataFrame with columns 'name' and 'volume_ml', where each row corresponds to a component.
+        pd.DataFrame: A DataFrame with columns 'name' and 'volume_ml' (and statistics from `component_stats`), where each row corresponds to a component.
+    """
+    return component_stats(subject.label, subject.name, connectivity)
+
+def prediction_components(dataset: list[dataset_loaders.Subject], predictions_folder: str, connectivity=26) -> pd.DataFrame:
+    """
+    Compute connected components of predictions saved as `{predictions_folder}/{subject name}.nii.gz`.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): List of subjects.
+        predictions_folder (str): Folder with predictions.
+        connectivity (int, optional): The connectivity to use for the connected components. Defaults to 26.
+
+    Returns:
+        pd.DataFrame: Components of all predictions (see `component_stats`).
+    """
+    tables = []
+    for i, subj in enumerate(dataset):
+        print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
+        prediction = ants.image_read(os.path.join(predictions_folder, f"{subj.name}.nii.gz"))
+        tables.append(component_stats(prediction, subj.name, connectivity))
+    return pd.concat(tables, ignore_index=True)
+
+def header_metadata(subj: dataset_loaders.Subject) -> dict:
+    """
+    Reads shapes, voxel sizes and orientations of FLAIR and DWI from the image headers, voxel data are not decoded.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject, it must not be loaded.
+
+    Returns:
+        dict: Metadata of the subject.
+    """
+    flair = utils.read_header(subj.flair)
+    dwi = utils.read_header(subj.dwi)
+    return {
+        "name": subj.name,
+        "shape_flair": flair["shape"],
+        "shape_dwi": dwi["shape"],
+        "voxel_dim_flair": flair["spacing"],
+        "voxel_dim_dwi": dwi["spacing"],
+        "orientation_flair": flair["orientation"],
+        "orientation_dwi": dwi["orientation"]
+    }
+
+def dice_after_preprocessing(subj: dataset_loaders.Subject) -> float:
+    """
+    Applies brain extraction and resampling to 200x200x200, 1x1x1 to the loaded subject and compares
+    the processed label resampled back to the original grid with the original label.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The loaded subject.
+
+    Returns:
+        float: The Dice coefficient.
     """
-    df_components = pd.DataFrame()
-    components = cc3d.connected_components(subject.label.numpy(), connectivity=26)
-    for component in np.unique(components)[1:]:
-        volume = utils.voxel_count_to_volume_ml(np.count_nonzero(components == component), subject.label.spacing)
-        stats = {
-            "name": subject.name,
-            "volume_ml": volume
-        }
-        df_components = pd.concat([df_components, pd.DataFrame([stats])])
-    return df_components
+    label_before_preprocessing = subj.label
+    subj.extract_brain()
+    subj.resample_to_target()
+
+    processed_img_resampled = utils.resample_label_to_target(subj.label, label_before_preprocessing.astype("float32"))
+    return utils.dice_coefficient(label_before_preprocessing.numpy(), processed_img_resampled.numpy())
 
 def stats_Motol(dataset: list[dataset_loaders.Subject],
                 dataset_name: str):
     """
     Compute statistics for the Motol dataset.
+    Shapes and voxel sizes are read from headers and each image is decoded only once.
 
     Parameters:
         dataset (list[dataset_loaders.Subject]): List of subjects with MRI data.
         dataset_name (str): Name of the dataset.
     """
-    df_cases = pd.DataFrame()
-    df_components = pd.DataFrame()
+    cases = []
+    components_tables = []
 
     for i, subj in enumerate(dataset):
         print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
-        dwi = ants.image_read(subj.dwi)
-        flair = ants.image_read(subj.flair)
+        stats = header_metadata(subj)
+
+        # decoded segmentation is reused by load_data
         label_flair, label_dwi = utils.load_nrrd(subj.label)
-        
         subj.load_data()
         
         # compute components
-        df_components = pd.concat([df_components, components(subj)])
-
-        label_volume = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.label.numpy()), subj.label.spacing)
-        label_flair_volume = utils.voxel_count_to_volume_ml(np.count_nonzero(label_flair.numpy()), label_flair.spacing)
-        label_dwi_volume = utils.voxel_count_to_volume_ml(np.count_nonzero(label_dwi.numpy()), label_dwi.spacing)
-        bet_mask_volume_ml = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.BETmask.numpy()), subj.BETmask.spacing)
-        stats = {
-            "name": subj.name,
-            "shape_flair": flair.shape,
-            "shape_dwi": dwi.shape,
-            "voxel_dim_flair": flair.spacing,
-            "voxel_dim_dwi": dwi.spacing,
-            "lesion_volume_ml": label_volume,
-            "flair_lesion_volume_ml": label_flair_volume,
-            "dwi_lesion_volume_ml": label_dwi_volume,
-            "bet_mask_volume_ml": bet_mask_volume_ml
-        }
-
-        label_before_preprocessing = subj.label
-        subj.extract_brain()
-        subj.resample_to_target()
+        components_tables.append(components(subj))
+
+        stats["lesion_volume_ml"] = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.label.numpy()), subj.label.spacing)
+        stats["flair_lesion_volume_ml"] = utils.voxel_count_to_volume_ml(np.count_nonzero(label_flair.numpy()), label_flair.spacing)
+        stats["dwi_lesion_volume_ml"] = utils.voxel_count_to_volume_ml(np.count_nonzero(label_dwi.numpy()), label_dwi.spacing)
+        stats["bet_mask_volume_ml"] = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.BETmask.numpy()), subj.BETmask.spacing)
 
         # compare label after brain extraction and resampling to 200x200x200, 1x1x1
-        processed_img_resampled = utils.resample_label_to_target(subj.label, label_before_preprocessing.astype("float32"))
-        stats["dice_after_preprocessing"] = utils.dice_coefficient(label_before_preprocessing.numpy(), processed_img_resampled.numpy())
+        stats["dice_after_preprocessing"] = dice_after_preprocessing(subj)
+        cases.append(stats)
 
-        df_cases = pd.concat([df_cases, pd.DataFrame([stats])])
+        subj.free_data()
     
-    df_cases.to_csv(f"results/{dataset_name}_stats.csv", index=False)
-    df_components.to_csv(f"results/{dataset_name}_components.csv", index=False)
+    pd.DataFrame(cases).to_csv(f"results/{dataset_name}_stats.csv", index=False)
+    pd.concat(components_tables, ignore_index=True).to_csv(f"results/{dataset_name}_components.csv", index=False)
 
 def stats_ISLES(dataset: list[dataset_loaders.Subject],
                 dataset_name: str):
     """
     Compute statistics for the ISLES dataset.
+    Shapes and voxel sizes are read from headers and each image is decoded only once: the subject is loaded
+    in native spaces, the lesion volume is computed on the native label and then DWI and label are transformed to FLAIR.
 
     Parameters:
         dataset (list[dataset_loaders.Subject]): List of subjects with MRI data.
         dataset_name (str): Name of the dataset.
     """
-    df_cases = pd.DataFrame()
-    df_components = pd.DataFrame()
+    cases = []
+    components_tables = []
 
     for i, subj in enumerate(dataset):
         print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
-        dwi = ants.image_read(subj.dwi)
-        flair = ants.image_read(subj.flair)
-        label = ants.image_read(subj.label).astype("uint32")
-        subj.load_data()
+        stats = header_metadata(subj)
+
+        subj.load_data(transform_to_flair=False)
+        stats["lesion_volume_ml"] = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.label.numpy()), subj.label.spacing)
+        subj.transform_to_flair()
 
         # compute components
-        df_components = pd.concat([df_components, components(subj)])
-
-        # compute volumes
-        label_volume = utils.voxel_count_to_volume_ml(np.count_nonzero(label.numpy()), label.spacing)
-        bet_mask_volume = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.BETmask.numpy()), subj.BETmask.spacing)
-        stats = {
-            "name": subj.name,
-            "shape_flair": flair.shape,
-            "shape_dwi": dwi.shape,
-            "voxel_dim_flair": flair.spacing,
-            "voxel_dim_dwi": dwi.spacing,
-            "lesion_volume_ml": label_volume,
-            "bet_mask_volume_ml": bet_mask_volume
-        }
-
-        label_before_preprocessing = subj.label
-        subj.extract_brain()
-        subj.resample_to_target()
+        components_tables.append(components(subj))
 
-        # compare label after brain extraction and resampling to 200x200x200, 1x1x1
-        processed_img_resampled = utils.resample_label_to_target(subj.label, label_before_preprocessing.astype("float32"))
-        stats["dice_after_preprocessing"] = utils.dice_coefficient(label_before_preprocessing.numpy(), processed_img_resampled.numpy())
+        stats["bet_mask_volume_ml"] = utils.voxel_count_to_volume_ml(np.count_nonzero(subj.BETmask.numpy()), subj.BETmask.spacing)
 
-        df_cases = pd.concat([df_cases, pd.DataFrame([stats])])
+        # compare label after brain extraction and resampling to 200x200x200, 1x1x1
+        stats["dice_after_preprocessing"] = dice_after_preprocessing(subj)
+        cases.append(stats)
 
         subj.free_data()
 
     # save dataframes
-    df_cases.to_csv(f"results/{dataset_name}_metadata.csv", index=False)
-    df_components.to_csv(f"results/{dataset_name}_components.csv", index=False)
+    pd.DataFrame(cases).to_csv(f"results/{dataset_name}_metadata.csv", index=False)
+    pd.concat(components_tables, ignore_index=True).to_csv(f"results/{dataset_name}_components.csv", index=False)
 
 if __name__ == "__main__":
-    stats_ISLES(dataset_loaders.ISLES2022(), "ISLES2022")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--predictions", type=str, default=None, help="Compute only components of predictions in this folder")
+    parser.add_argument("--output", type=str, default="results/ISLES2022_prediction_components.csv", help="Output csv file of prediction components")
+    args = parser.parse_args()
+
+    if args.predictions:
+        prediction_components(dataset_loaders.ISLES2022(), args.predictions).to_csv(args.output, index=False)
+    else:
+        stats_ISLES(dataset_loaders.ISLES2022(cache=volume_cache.VolumeCache()), "ISLES2022")
@@ -0,0 +1,71 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.utils as utils
+
+def benchmark_subject(subj: dataset_loaders.Subject, template_mni: str) -> dict:
+    """
+    Transforms the subject to MNI space with the two-pass (affine, then warp) and with the composite
+    single-pass transformation and compares wall time and results of both approaches.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject to process.
+        template_mni (str): The path to the MNI template image.
+
+    Returns:
+        dict: Timings in seconds and Dice coefficients of label and BET mask between both approaches.
+    """
+    subj.load_data()
+    subj.extract_brain()
+    loaded = [subj.flair.clone(), subj.dwi.clone(), subj.label.clone(), subj.BETmask.clone()]
+
+    two_pass_time = time.time()
+    subj.apply_transform_to_mni(template_mni, composite=False)
+    two_pass_time = time.time() - two_pass_time
+    two_pass = [subj.flair, subj.dwi, subj.label, subj.BETmask]
+
+    subj.flair, subj.dwi, subj.label, subj.BETmask = loaded
+    composite_time = time.time()
+    subj.apply_transform_to_mni(template_mni, composite=True)
+    composite_time = time.time() - composite_time
+
+    stats = {
+        "name": subj.name,
+        "two_pass_s": two_pass_time,
+        "composite_s": composite_time,
+        "dice_label": utils.dice_coefficient(two_pass[2].numpy(), subj.label.numpy()),
+        "dice_BETmask": utils.dice_coefficient(two_pass[3].numpy(), subj.BETmask.numpy()),
+        "flair_correlation": np.corrcoef(two_pass[0].numpy().ravel(), subj.flair.numpy().ravel())[0, 1],
+        "label_volume_two_pass": np.count_nonzero(two_pass[2].numpy()),
+        "label_volume_composite": np.count_nonzero(subj.label.numpy())
+    }
+    subj.free_data()
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=10, help="Number of subjects to benchmark")
+    parser.add_argument("--template", type=str, default="datasets/template_flair_mni.nii.gz", help="MNI template")
+    parser.add_argument("--output", type=str, default=None, help="Output csv file")
+    args = parser.parse_args()
+
+    # read template once, so the first subject does not include template loading time
+    utils.load_template(args.template)
+
+    dataset = dataset_loaders.ISLES2022()[:args.subjects]
+    rows = []
+    for i, subj in enumerate(dataset):
+        print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
+        rows.append(benchmark_subject(subj, args.template))
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    print(f"\nTwo-pass time: {df['two_pass_s'].sum():.1f} s, composite time: {df['composite_s'].sum():.1f} s "
+          f"(speedup {df['two_pass_s'].sum() / df['composite_s'].sum():.2f}x)")
+    print(f"Mean Dice of labels: {df['dice_label'].mean():.4f}, mean Dice of BET masks: {df['dice_BETmask'].mean():.4f}")
+
+    if args.output:
+        df.to_csv(args.output, index=False)
@@ -0,0 +1,97 @@
+import time
+import argparse
+import numpy as np
+import torch
+from torchmetrics.classification import MulticlassStatScores, MulticlassF1Score
+
+import evaluation
+
+def synthetic_case(shape: tuple[int, int, int], seed: int = 0) -> tuple[np.ndarray, list[np.ndarray], np.ndarray]:
+    """
+    Generates a synthetic case with a spherical brain mask, a prediction and three ground truth lesions
+    (union, FLAIR and DWI) of a few ml as in ISLES 2022.
+
+    Parameters:
+        shape (tuple[int, int, int]): Shape of the volumes.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        tuple[np.ndarray, list[np.ndarray], np.ndarray]: Prediction, ground truths and brain mask (uint32 as in ANTs labels).
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    center = [s / 2 for s in shape]
+
+    def sphere(center, radius):
+        return (sum((g - c) ** 2 for g, c in zip(grid, center)) < radius ** 2).astype(np.uint32)
+
+    mask = sphere(center, min(shape) * 0.45)
+    lesion_center = [c + rng.uniform(-10, 10) for c in center]
+    gt_flair = sphere(lesion_center, 12)
+    gt_dwi = sphere([c + 3 for c in lesion_center], 11)
+    gt_union = np.logical_or(gt_flair, gt_dwi).astype(np.uint32)
+    pred = sphere([c + 2 for c in lesion_center], 12)
+    return pred, [gt_union, gt_flair, gt_dwi], mask
+
+def torchmetrics_counts(pred: np.ndarray, gts: list[np.ndarray], mask: np.ndarray) -> list[tuple]:
+    """
+    Computes confusion counts and Dice as the original evaluation scripts did, with index 2 outside of the BET mask.
+    """
+    stats = MulticlassStatScores(num_classes=2, average="none", ignore_index=2)
+    dice = MulticlassF1Score(num_classes=2, average="none", ignore_index=2)
+
+    pred_t = pred.astype(np.uint8)
+    pred_t[mask == 0] = 2
+    pred_t = torch.from_numpy(pred_t)
+
+    results = []
+    for gt in gts:
+        gt_t = gt.astype(np.uint8)
+        gt_t[mask == 0] = 2
+        gt_t = torch.from_numpy(gt_t)
+        tp, fp, tn, fn, _ = stats(pred_t, gt_t).numpy()[1]
+        results.append((tp, fp, tn, fn, dice(pred_t, gt_t).numpy()[1]))
+    return results
+
+def fused_counts(pred: np.ndarray, gts: list[np.ndarray], mask: np.ndarray) -> list[tuple]:
+    """
+    Computes confusion counts and Dice with the fused single-pass kernel.
+    """
+    counts = evaluation.confusion_counts_multi(pred, gts, mask)
+    return [(tp, fp, tn, fn, evaluation.dice_from_counts(tp, fp, fn)) for tp, fp, tn, fn in counts]
+
+def benchmark(shape: tuple[int, int, int], repetitions: int):
+    """
+    Times both implementations on a synthetic case and checks that they give the same results.
+
+    Parameters:
+        shape (tuple[int, int, int]): Shape of the volumes.
+        repetitions (int): Number of repetitions.
+    """
+    pred, gts, mask = synthetic_case(shape)
+
+    start = time.time()
+    for _ in range(repetitions):
+        reference = torchmetrics_counts(pred, gts, mask)
+    torchmetrics_time = (time.time() - start) / repetitions
+
+    start = time.time()
+    for _ in range(repetitions):
+        fused = fused_counts(pred, gts, mask)
+    fused_time = (time.time() - start) / repetitions
+
+    for ref, res in zip(reference, fused):
+        assert np.array_equal(ref[:4], res[:4]), f"Counts mismatch: {ref[:4]} != {res[:4]}"
+        assert np.isclose(ref[4], res[4], atol=1e-6), f"Dice mismatch: {ref[4]} != {res[4]}"
+
+    print(f"Shape {shape}: torchmetrics {torchmetrics_time:.3f} s, fused {fused_time:.3f} s "
+          f"(speedup {torchmetrics_time / fused_time:.1f}x), {len(gts)} ground truths")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repetitions", type=int, default=5, help="Number of repetitions")
+    args = parser.parse_args()
+
+    # preprocessed shape and native resolution of ISLES 2022 FLAIR
+    benchmark((200, 200, 200), args.repetitions)
+    benchmark((281, 352, 352), args.repetitions)
@@ -0,0 +1,107 @@
+import os
+import time
+import resource
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.utils as utils
+
+def preprocess(subj: dataset_loaders.Subject, crop_to_brain: bool, output_dir: str) -> dict:
+    """
+    Loads the subject and resamples it to 200x200x200 as in nnUNet preprocessing. It is run in a fresh process,
+    so the peak resident memory of the process belongs only to this subject and loading mode. Preprocessed volumes
+    are saved to files, so only scalars are sent back to the parent process.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject, it must not be loaded.
+        crop_to_brain (bool): Whether to use crop-first loading.
+        output_dir (str): Folder where preprocessed FLAIR and label are saved as `flair.npy` and `label.npy`.
+
+    Returns:
+        dict: Wall time of loading and of the whole preprocessing, peak RSS in MB and the loaded shape.
+    """
+    start = time.time()
+    subj.load_data(crop_to_brain=crop_to_brain)
+    load_time = time.time() - start
+    loaded_shape = subj.flair.shape
+
+    subj.extract_brain()
+    subj.resample_to_target()
+    total_time = time.time() - start
+
+    result = {
+        "load_s": load_time,
+        "total_s": total_time,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "loaded_shape": loaded_shape
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "flair.npy"), subj.flair.numpy())
+    np.save(os.path.join(output_dir, "label.npy"), subj.label.numpy())
+    subj.free_data()
+    return result
+
+def benchmark_subject(subj: dataset_loaders.Subject) -> dict:
+    """
+    Compares the current loading order with crop-first loading on one subject.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject to process.
+
+    Returns:
+        dict: Timings, peak RSS, loaded shapes and agreement of the preprocessed FLAIR and label.
+    """
+    results = {}
+    # spawned processes do not inherit memory of the parent, so their peak RSS belongs only to one run
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for crop_to_brain in (False, True):
+            # one process per run, because peak RSS of a process cannot be reset
+            with context.Pool(1) as pool:
+                results[crop_to_brain] = pool.apply(preprocess, (subj, crop_to_brain, os.path.join(tmp_dir, str(crop_to_brain))))
+
+        full, cropped = [{name: np.load(os.path.join(tmp_dir, str(crop_to_brain), f"{name}.npy")) for name in ("flair", "label")}
+                         for crop_to_brain in (False, True)]
+        flair_max_abs_diff = float(np.abs(full["flair"] - cropped["flair"]).max())
+        dice_label = utils.dice_coefficient(full["label"], cropped["label"])
+
+    full, cropped = results[False], results[True]
+    return {
+        "name": subj.name,
+        "full_shape": full["loaded_shape"],
+        "cropped_shape": cropped["loaded_shape"],
+        "full_load_s": full["load_s"],
+        "crop_first_load_s": cropped["load_s"],
+        "full_total_s": full["total_s"],
+        "crop_first_total_s": cropped["total_s"],
+        "full_peak_rss_mb": full["peak_rss_mb"],
+        "crop_first_peak_rss_mb": cropped["peak_rss_mb"],
+        "flair_max_abs_diff": flair_max_abs_diff,
+        "dice_label": dice_label
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=10, help="Number of subjects to benchmark")
+    parser.add_argument("--output", type=str, default=None, help="Output csv file")
+    args = parser.parse_args()
+
+    dataset = dataset_loaders.ISLES2022()[:args.subjects]
+    rows = []
+    for i, subj in enumerate(dataset):
+        print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
+        rows.append(benchmark_subject(subj))
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    print(f"\nLoading: {df['full_load_s'].sum():.1f} s -> {df['crop_first_load_s'].sum():.1f} s, "
+          f"preprocessing: {df['full_total_s'].sum():.1f} s -> {df['crop_first_total_s'].sum():.1f} s, "
+          f"mean peak RSS: {df['full_peak_rss_mb'].mean():.0f} MB -> {df['crop_first_peak_rss_mb'].mean():.0f} MB")
+    print(f"Mean Dice of labels: {df['dice_label'].mean():.4f}, max FLAIR difference: {df['flair_max_abs_diff'].max():.4g}")
+
+    if args.output:
+        df.to_csv(args.output, index=False)
@@ -1,68 +1,137 @@
 import ants
+import argparse
 import numpy as np
 import pandas as pd
 
 import datasets.dataset_loaders as dataset_loaders
+import datasets.volume_cache as volume_cache
+import datasets.utils as utils
+
+# labels of the MNI Structural Atlas (see atlases/README.md), 0 is outside of the atlas regions
+MNI_STRUCTURAL_LABELS = ["Background", "Caudate", "Cerebellum", "Frontal Lobe", "Insula", "Occipital Lobe",
+                         "Parietal Lobe", "Putamen", "Temporal Lobe", "Thalamus"]
+
+ATLASES = {
+    "mni": "atlases/MNI Structural Atlas/MNI-maxprob-thr0-1mm.nii.gz",
+    "cerebra": "atlases/mni_icbm152_nlin_sym_09c_CerebrA_nifti/mni_icbm152_CerebrA_tal_nlin_sym_09c.nii"
+}
+
+def mni_structural_regions() -> pd.DataFrame:
+    """
+    Returns:
+        pd.DataFrame: Regions of the MNI Structural Atlas. Labels are not lateralized, so each label
+            is split by the midline to the left and right region.
+    """
+    return pd.DataFrame({
+        "Label": np.repeat(np.arange(len(MNI_STRUCTURAL_LABELS)), 2),
+        "Hemisphere": ["left", "right"] * len(MNI_STRUCTURAL_LABELS),
+        "Name": np.repeat(MNI_STRUCTURAL_LABELS, 2)
+    })
+
+def cerebra_regions(label_details: str = "atlases/mni_icbm152_nlin_sym_09c_CerebrA_nifti/CerebrA_LabelDetails.csv") -> pd.DataFrame:
+    """
+    Reads regions of the CerebrA atlas. Each region has its own label in each hemisphere,
+    voxels outside of the regions (label 0) are split by the midline.
+
+    Parameters:
+        label_details (str, optional): The csv file with label names and right and left hemisphere labels.
+
+    Returns:
+        pd.DataFrame: Regions of the CerebrA atlas.
+    """
+    details = pd.read_csv(label_details)
+    right = pd.DataFrame({"Label": details["RH Label"], "Hemisphere": "right", "Name": details["Label Name"]})
+    left = pd.DataFrame({"Label": details["LH Labels"], "Hemisphere": "left", "Name": details["Label Name"]})
+    background = pd.DataFrame({"Label": [0, 0], "Hemisphere": ["left", "right"], "Name": "Background"})
+    return pd.concat([background, right, left]).sort_values(["Label", "Hemisphere"]).reset_index(drop=True)
+
+def region_image(atlas: ants.ants_image.ANTsImage, template: ants.ants_image.ANTsImage, regions: pd.DataFrame) -> np.ndarray:
+    """
+    Computes the combined hemisphere and region image, each voxel contains the row index of its region in `regions`.
+    Voxels with labels which are not in `regions` get index len(regions).
+
+    Parameters:
+        atlas (ants.ants_image.ANTsImage): Atlas image with region labels.
+        template (ants.ants_image.ANTsImage): Template image, the atlas is resampled to its grid.
+        regions (pd.DataFrame): Regions with columns "Label" and "Hemisphere". If a label has both
+            the left and the right region, the label is split by the midline.
+
+    Returns:
+        np.ndarray: The region image in the template grid.
+    """
+    # resample atlas to the template shape
+    atlas = ants.resample_image_to_target(atlas, template, interp_type="genericLabel")
+    atlas_np = atlas.numpy().astype(np.int64)
+
+    center_index = ants.transform_physical_point_to_index(atlas, [0, 0, 0])
+    right_hemisphere = (np.arange(atlas_np.shape[0]) >= round(center_index[0]))[:, None, None]
+
+    # lookup table from (label, hemisphere) to the region index
+    max_label = max(atlas_np.max(), regions["Label"].max())
+    lookup = np.full((max_label + 1, 2), len(regions), dtype=np.int64)
+    label_counts = regions["Label"].value_counts()
+    for index, (label, hemisphere) in enumerate(zip(regions["Label"], regions["Hemisphere"])):
+        if label_counts[label] > 1:
+            lookup[label, int(hemisphere == "right")] = index
+        else:
+            lookup[label, :] = index
+
+    return lookup[atlas_np, right_hemisphere.astype(np.int64)]
 
 def generate_stat_lobes(dataset: list[dataset_loaders.Subject],
                         dataset_name: str,
                         template: ants.ants_image.ANTsImage,
-                        atlas: ants.ants_image.ANTsImage, 
-                        results_df: pd.DataFrame) -> None:
+                        atlas: ants.ants_image.ANTsImage,
+                        regions: pd.DataFrame = None,
+                        mni_store: volume_cache.MNILabelStore = None) -> pd.DataFrame:
     """
-    Compute lesion volume for each lobe for each subject in the dataset.
+    Compute lesion volume for each atlas region (lobe) in each hemisphere for each subject in the dataset.
+    Volumes of all regions are counted in one `np.bincount` over the lesion voxels (read from the sparse label),
+    so the cost does not depend on the number of atlas labels.
 
     Parameters:
         dataset (list[dataset_loaders.Subject]): List of subjects with MRI data.
         dataset_name (str): Name of the dataset.
         template (ants.ants_image.ANTsImage): Template image for registration to MNI space.
         atlas (ants.ants_image.ANTsImage): Atlas image with lobe labels.
-        results_df (pandas.DataFrame): DataFrame where the results will be stored.
-    """
-    # resample atlas to the template shape
-    atlas = ants.resample_image_to_target(atlas, template, interpolation="genericLabel")
-    atlas_np = atlas.numpy().astype(int)
-    
-    center_index = ants.transform_physical_point_to_index(atlas, [0, 0, 0])
-    
-    left_hemisphere_mask = np.zeros_like(atlas_np)
-    left_hemisphere_mask[:round(center_index[0]), :, :] = 1
+        regions (pd.DataFrame, optional): Regions of the atlas (see `mni_structural_regions` and `cerebra_regions`).
+            Defaults to the MNI Structural Atlas regions.
+        mni_store (volume_cache.MNILabelStore, optional): Store of labels in MNI space. Defaults to "datasets/cache_mni/".
 
-    right_hemisphere_mask = np.zeros_like(atlas_np)
-    right_hemisphere_mask[round(center_index[0]):, :, :] = 1
+    Returns:
+        pd.DataFrame: Lesion volumes with columns Dataset, Subject, Hemisphere, Lobe (atlas label), Volume [ml] and Region (name).
+    """
+    mni_store = mni_store or volume_cache.MNILabelStore()
+    regions = regions if regions is not None else mni_structural_regions()
+    regions_np = region_image(atlas, template, regions)
 
+    volumes = []
     for i, subj in enumerate(dataset):
         print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
-        subj.load_data()
-
-        subj.extract_brain()
-        subj.apply_transform_to_mni()
-        subj.space_integrity_check()
-        subj.empty_label_check()
-
-        lesion_np = subj.label.numpy()
-
-        for lobe in range(atlas_np.max()+1):
-            lobe_mask = atlas_np == lobe
-            left_lobe_mask = np.logical_and(lobe_mask, left_hemisphere_mask)
-            right_lobe_mask = np.logical_and(lobe_mask, right_hemisphere_mask)
-
-            left_lobe_lesion = lesion_np[left_lobe_mask].sum() * np.prod(subj.label.spacing) / 1000
-            right_lobe_lesion = lesion_np[right_lobe_mask].sum() * np.prod(subj.label.spacing) / 1000
-
-            results_df.loc[len(results_df)] = [dataset_name, subj.name, 'left', lobe, left_lobe_lesion]
-            results_df.loc[len(results_df)] = [dataset_name, subj.name, 'right', lobe, right_lobe_lesion]
-
-        subj.free_data()
+        label = mni_store.load(subj, as_sparse=True)["label"]
+        counts = np.bincount(regions_np.reshape(-1)[label.indices()], minlength=len(regions) + 1)[:len(regions)]
+        volumes.append(utils.voxel_count_to_volume_ml(counts, label.spacing))
+
+    return pd.DataFrame({
+        "Dataset": dataset_name,
+        "Subject": np.repeat([subj.name for subj in dataset], len(regions)),
+        "Hemisphere": np.tile(regions["Hemisphere"], len(dataset)),
+        "Lobe": np.tile(regions["Label"], len(dataset)),
+        "Volume [ml]": np.concatenate(volumes) if volumes else [],
+        "Region": np.tile(regions["Name"], len(dataset))
+    })
 
 if __name__ == "__main__":
-    template = ants.image_read("datasets/template_flair_mni.nii.gz")
-    atlas = ants.image_read("atlases/MNI Structural Atlas/MNI-maxprob-thr0-1mm.nii.gz")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--atlas", type=str, default="mni", choices=list(ATLASES), help="Atlas of regions")
+    parser.add_argument("--output", type=str, default="results/stat_lobes_predict.csv", help="Output csv file")
+    args = parser.parse_args()
 
-    results_df = pd.DataFrame(columns=['Dataset', 'Subject', 'Hemisphere', 'Lobe', 'Volume [ml]'])
-
-    dataset = dataset_loaders.ISLES2022()
-    generate_stat_lobes(dataset, "ISLES2022", template, atlas, results_df)
+    template = ants.image_read("datasets/template_flair_mni.nii.gz")
+    atlas = ants.image_read(ATLASES[args.atlas])
+    regions = cerebra_regions() if args.atlas == "cerebra" else mni_structural_regions()
 
-    results_df.to_csv("results/stat_lobes_predict.csv", index=False)
+    dataset = dataset_loaders.ISLES2022(cache=volume_cache.VolumeCache())
+    results_df = generate_stat_lobes(dataset, "ISLES2022", template, atlas, regions)
 
+    results_df.to_csv(args.output, index=False)
@@ -1,40 +1,280 @@
+import os
 import ants
+import argparse
+import functools
 import numpy as np
-import multiprocessing
 
 import datasets.dataset_loaders as dataset_loaders
+import datasets.parallel as parallel
+import datasets.volume_cache as volume_cache
 
-def generate_stat_map(dataset: dataset_loaders.Subject, template: ants.ants_image.ANTsImage, output_file: str) -> None:
+class LesionMapAccumulator():
+    """
+    Mergeable accumulator of lesion maps in MNI space. For each subject it keeps only the flat indices
+    of its lesion voxels (lesions are a few ml, so the subject takes tens of kB) and the map of lesion counts
+    in uint16. Subjects can be added and removed incrementally, accumulators computed by different workers
+    (shards) can be merged and maps of any subset of subjects are computed from the stored indices
+    without loading the labels again. Each subject keeps the fingerprint of its label in MNI space
+    (`MNILabelStore.subject_key`), so subjects whose files, transformations or template changed are added again.
+    """
+    def __init__(self, template: ants.ants_image.ANTsImage):
+        """
+        Parameters:
+            template (ants.ants_image.ANTsImage): Template image in MNI space, maps are created in its grid.
+        """
+        self.template = template
+        self.subjects = {}
+        self.keys = {}
+        self.counts = np.zeros(template.shape, dtype=np.uint16)
+
+    def add(self, name: str, lesion_indices: np.ndarray, key: str = None):
+        """
+        Adds a subject to the map. If the subject is already added, it is replaced.
+
+        Parameters:
+            name (str): Name of the subject.
+            lesion_indices (np.ndarray): Flat indices of lesion voxels in the template grid (see `lesion_indices`).
+            key (str, optional): Fingerprint of the label (see `MNILabelStore.subject_key`). Defaults to None (unknown).
+        """
+        if name in self.subjects:
+            self.remove(name)
+        self.subjects[name] = np.asarray(lesion_indices, dtype=np.uint32)
+        self.keys[name] = key
+        self.counts.reshape(-1)[self.subjects[name]] += 1
+
+    def remove(self, name: str):
+        """
+        Removes a subject from the map.
+
+        Parameters:
+            name (str): Name of the subject.
+        """
+        self.counts.reshape(-1)[self.subjects.pop(name)] -= 1
+        self.keys.pop(name, None)
+
+    def merge(self, other: "LesionMapAccumulator"):
+        """
+        Adds all subjects of other accumulator (e.g. a shard computed by another worker).
+
+        Parameters:
+            other (LesionMapAccumulator): The accumulator with the same template grid.
+        """
+        assert self.counts.shape == other.counts.shape, f"Shape mismatch: {self.counts.shape}, {other.counts.shape}"
+        for name, indices in other.subjects.items():
+            self.add(name, indices, other.keys.get(name))
+
+    def lesion_volumes(self) -> dict[str, float]:
+        """
+        Returns:
+            dict[str, float]: Lesion volume in ml of each subject.
+        """
+        voxel_volume = np.prod(self.template.spacing) / 1000
+        return {name: len(indices) * voxel_volume for name, indices in self.subjects.items()}
+
+    def count_map(self, names: list[str] = None) -> ants.ants_image.ANTsImage:
+        """
+        Computes the map with the number of subjects with lesion in each voxel.
+
+        Parameters:
+            names (list[str], optional): Subset of subjects. Defaults to all subjects.
+
+        Returns:
+            ants.ants_image.ANTsImage: The count map.
+        """
+        return ants.new_image_like(self.template, self._counts(names).astype(np.float32))
+
+    def probability_map(self, names: list[str] = None) -> ants.ants_image.ANTsImage:
+        """
+        Computes the map with the fraction of subjects with lesion in each voxel.
+
+        Parameters:
+            names (list[str], optional): Subset of subjects. Defaults to all subjects.
+
+        Returns:
+            ants.ants_image.ANTsImage: The probability map.
+        """
+        n_subjects = len(self.subjects) if names is None else len(names)
+        return ants.new_image_like(self.template, self._counts(names).astype(np.float32) / max(1, n_subjects))
+
+    def _counts(self, names: list[str] = None) -> np.ndarray:
+        """
+        Counts lesions of the subset of subjects from their indices, all subjects are read from the accumulated counts.
+        """
+        if names is None:
+            return self.counts
+        indices = [self.subjects[name] for name in names]
+        return np.bincount(np.concatenate(indices) if indices else np.zeros(0, dtype=np.uint32),
+                           minlength=self.counts.size).reshape(self.counts.shape)
+
+    def volume_tertiles(self) -> list[list[str]]:
+        """
+        Splits subjects into three groups by lesion volume (small, medium and large lesions).
+
+        Returns:
+            list[list[str]]: Names of subjects in each tertile.
+        """
+        volumes = self.lesion_volumes()
+        names = sorted(volumes, key=volumes.get)
+        return [list(group) for group in np.array_split(np.array(names, dtype=object), 3)]
+
+    def save(self, output_file: str):
+        """
+        Saves the accumulator to a `.npz` file.
+
+        Parameters:
+            output_file (str): The output file.
+        """
+        names = list(self.subjects)
+        indices = [self.subjects[name] for name in names]
+        tmp_file = f"{output_file}.tmp.npz"
+        np.savez(tmp_file, names=np.array(names, dtype=str), shape=np.array(self.counts.shape),
+                 keys=np.array([self.keys.get(name) or "" for name in names], dtype=str),
+                 offsets=np.cumsum([0] + [len(i) for i in indices]),
+                 indices=np.concatenate(indices) if indices else np.zeros(0, dtype=np.uint32))
+        os.replace(tmp_file, output_file)
+
+    @classmethod
+    def load(cls, input_file: str, template: ants.ants_image.ANTsImage) -> "LesionMapAccumulator":
+        """
+        Loads the accumulator saved by `save`.
+
+        Parameters:
+            input_file (str): The `.npz` file.
+            template (ants.ants_image.ANTsImage): Template image in MNI space.
+
+        Returns:
+            LesionMapAccumulator: The accumulator.
+        """
+        accumulator = cls(template)
+        data = np.load(input_file)
+        assert tuple(data["shape"]) == template.shape, f"Shape mismatch: {tuple(data['shape'])}, template: {template.shape}"
+        offsets = data["offsets"]
+        # accumulators saved without fingerprints have unknown keys, so their subjects are added again
+        keys = data["keys"] if "keys" in data else [""] * len(data["names"])
+        for i, name in enumerate(data["names"]):
+            accumulator.add(str(name), data["indices"][offsets[i]:offsets[i + 1]], str(keys[i]) or None)
+        return accumulator
+
+def lesion_indices(subj: dataset_loaders.Subject, mni_store: volume_cache.MNILabelStore,
+                   template_mni: str = "datasets/template_flair_mni.nii.gz") -> np.ndarray:
+    """
+    Reads the sparse label of the subject in MNI space and returns flat indices of its lesion voxels.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject.
+        mni_store (volume_cache.MNILabelStore): Store of labels in MNI space.
+        template_mni (str, optional): The path to the MNI template image. Defaults to "datasets/template_flair_mni.nii.gz".
+
+    Returns:
+        np.ndarray: Flat indices of lesion voxels (uint32).
+    """
+    label = mni_store.load(subj, template_mni, as_sparse=True)["label"]
+    return label.indices().astype(np.uint32)
+
+def subject_key(subj: dataset_loaders.Subject, mni_store: volume_cache.MNILabelStore, template_mni: str) -> str:
+    """
+    Returns the fingerprint of the subject label in MNI space, None if any of its files is missing (the subject then fails in `lesion_indices`).
+    """
+    try:
+        return mni_store.subject_key(subj, template_mni)
+    except OSError:
+        return None
+
+def update_accumulator(accumulator: LesionMapAccumulator,
+                       dataset: list[dataset_loaders.Subject],
+                       mni_store: volume_cache.MNILabelStore = None,
+                       n_workers: int = 1,
+                       template_mni: str = "datasets/template_flair_mni.nii.gz") -> LesionMapAccumulator:
+    """
+    Synchronizes the accumulator with the dataset: subjects which are not in the dataset are removed
+    and only subjects which are not in the accumulator yet or whose fingerprint (`MNILabelStore.subject_key`)
+    changed are loaded and added.
+
+    Parameters:
+        accumulator (LesionMapAccumulator): The accumulator.
+        dataset (list[dataset_loaders.Subject]): The subjects which should be in the map.
+        mni_store (volume_cache.MNILabelStore, optional): Store of labels in MNI space. Defaults to "datasets/cache_mni/".
+        n_workers (int, optional): Number of worker processes. Defaults to 1.
+        template_mni (str, optional): The path to the MNI template image. Defaults to "datasets/template_flair_mni.nii.gz".
+
+    Returns:
+        LesionMapAccumulator: The updated accumulator.
+    """
+    mni_store = mni_store or volume_cache.MNILabelStore()
+    names = {subj.name for subj in dataset}
+    for name in [name for name in accumulator.subjects if name not in names]:
+        accumulator.remove(name)
+
+    keys = {subj.name: subject_key(subj, mni_store, template_mni) for subj in dataset}
+    todo = [subj for subj in dataset if accumulator.keys.get(subj.name) != keys[subj.name]]
+    print(f"Adding {len(todo)} subjects ({len(dataset) - len(todo)} up to date in the map)...")
+    job = functools.partial(lesion_indices, mni_store=mni_store, template_mni=template_mni)
+    for i, result in enumerate(parallel.imap_jobs(job, todo, n_workers)):
+        if result.ok:
+            accumulator.add(result.item.name, result.result, keys[result.item.name])
+        elif result.item.name in accumulator.subjects:
+            # stale lesions must not stay in the map
+            accumulator.remove(result.item.name)
+        print(f"Processed {result.item.name} ({i+1}/{len(todo)}): {'done' if result.ok else 'FAILED'}")
+        if not result.ok:
+            print(result.error)
+    return accumulator
+
+def generate_stat_map(dataset: dataset_loaders.Subject, template: ants.ants_image.ANTsImage, output_file: str,
+                      mni_store: volume_cache.MNILabelStore = None, accumulator_file: str = None,
+                      n_workers: int = 1, tertiles: bool = False, template_mni: str = "datasets/template_flair_mni.nii.gz") -> None:
     """
     Computes a statistical map of the lesion probability given a dataset of subjects.
-    
+    With `accumulator_file`, lesions of already processed subjects are read from it and only new or changed subjects are loaded.
+
     Parameters:
         dataset (list[dataset_loaders.Subject]): The list of subjects to be used for the statistical map.
         template (ants.ants_image.ANTsImage): The template image for registration to MNI space.
-        output_file (str): The path where the computed statistical map will be saved.
-    
+        output_file (str): The path where the map with the number of lesions in each voxel will be saved.
+        mni_store (volume_cache.MNILabelStore, optional): Store of labels in MNI space. Defaults to "datasets/cache_mni/".
+        accumulator_file (str, optional): The `.npz` file with the accumulated lesions. Defaults to None.
+        n_workers (int, optional): Number of worker processes. Defaults to 1.
+        tertiles (bool, optional): Whether to save also maps of subjects by lesion volume tertiles
+            (`{output_file}_tertile1.nii.gz`, ...). Defaults to False.
+        template_mni (str, optional): The path to the template image, it is a part of the subject fingerprints. Defaults to "datasets/template_flair_mni.nii.gz".
+
     Returns:
         None
     """
-    stat_map = np.zeros(template.shape)
-
-    for i, subj in enumerate(dataset):
-        print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
-        subj.load_data()
+    if accumulator_file and os.path.exists(accumulator_file):
+        accumulator = LesionMapAccumulator.load(accumulator_file, template)
+    else:
+        accumulator = LesionMapAccumulator(template)
 
-        subj.extract_brain()
-        subj.apply_transform_to_mni()
-        subj.space_integrity_check()
-        subj.empty_label_check()
+    update_accumulator(accumulator, dataset, mni_store, n_workers, template_mni)
+    if accumulator_file:
+        accumulator.save(accumulator_file)
 
-        stat_map += subj.label.numpy()
-
-        subj.free_data()
-    ants.image_write(ants.new_image_like(template, stat_map), output_file)
+    ants.image_write(accumulator.count_map(), output_file)
+    if tertiles:
+        output_name = output_file.removesuffix(".nii.gz")
+        for i, names in enumerate(accumulator.volume_tertiles()):
+            ants.image_write(accumulator.count_map(names), f"{output_name}_tertile{i+1}.nii.gz")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="results/stat_map_ISLES22.nii.gz", help="Output lesion map")
+    parser.add_argument("--accumulator", type=str, default="results/stat_map_ISLES22.npz", help="File with accumulated lesions, only new or changed subjects are processed")
+    parser.add_argument("--merge", type=str, nargs="*", default=[], help="Accumulator files (shards) which are merged into the map")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--tertiles", action="store_true", help="Save also maps of lesion volume tertiles")
+    args = parser.parse_args()
+
     template = ants.image_read("datasets/template_flair_mni.nii.gz")
 
-    dataset = dataset_loaders.ISLES2022()
-    p = multiprocessing.Process(target=generate_stat_map, args=[dataset, template, "results/stat_map_ISLES22.nii.gz"])
-    p.start()
\ No newline at end of file
+    if args.merge:
+        # merge shards computed separately (e.g. on different nodes) without loading any label
+        accumulator = LesionMapAccumulator(template)
+        for shard in args.merge:
+            accumulator.merge(LesionMapAccumulator.load(shard, template))
+        accumulator.save(args.accumulator)
+        ants.image_write(accumulator.count_map(), args.output)
+    else:
+        dataset = dataset_loaders.ISLES2022(cache=volume_cache.VolumeCache())
+        generate_stat_map(dataset, template, args.output, accumulator_file=args.accumulator,
+                          n_workers=args.workers, tertiles=args.tertiles)
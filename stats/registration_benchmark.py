@@ -0,0 +1,93 @@
+import os
+import time
+import argparse
+import multiprocessing
+import ants
+import pandas as pd
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.generate_transforms as generate_transforms
+from stats.registration_similarity import compute_similarity
+
+def measure(fixed: ants.ants_image.ANTsImage, moving: ants.ants_image.ANTsImage, preset: dict, queue: multiprocessing.Queue) -> tuple[float, float, float]:
+    """
+    Registers the moving image to the fixed image with the given preset and measures registration quality
+    with the same metrics as `registration_similarity.py`.
+
+    Parameters:
+        fixed (ants.ants_image.ANTsImage): The fixed image for registration.
+        moving (ants.ants_image.ANTsImage): The moving image for registration.
+        preset (dict): Keyword arguments of ants.registration.
+        queue (multiprocessing.Queue): Queue for the similarity computed in another process.
+
+    Returns:
+        tuple[float, float, float]: Wall time in seconds, mutual information and similarity of the registered images.
+    """
+    start = time.time()
+    mytx = ants.registration(fixed=fixed, moving=moving, **preset)
+    duration = time.time() - start
+
+    warped = mytx["warpedmovout"]
+    mutual_information = ants.metrics.image_mutual_information(fixed, warped)
+
+    # compute similarity in another process because of memory leak in ANTs
+    p = multiprocessing.Process(target=compute_similarity, args=(fixed, warped, queue))
+    p.start()
+    p.join()
+    similarity = queue.get()
+
+    # remove temporary transforms
+    for file in set(mytx["fwdtransforms"] + mytx["invtransforms"]):
+        if os.path.exists(file):
+            os.remove(file)
+    return duration, mutual_information, similarity
+
+def benchmark(dataset: list[dataset_loaders.Subject], template_mni: str, syn_presets: list[str], rigid_presets: list[str]) -> pd.DataFrame:
+    """
+    Runs each registration preset for each subject and reports wall time and quality metrics.
+    Existing transforms of the subjects are not modified.
+
+    Parameters:
+        dataset (list[dataset_loaders.Subject]): Subjects to register.
+        template_mni (str): The path to the MNI template.
+        syn_presets (list[str]): Names of SyN presets (FLAIR to MNI).
+        rigid_presets (list[str]): Names of Rigid presets (DWI to FLAIR).
+
+    Returns:
+        pd.DataFrame: One row for each subject, registration type and preset.
+    """
+    template = ants.image_read(template_mni)
+    queue = multiprocessing.Queue()
+    results_df = pd.DataFrame(columns=['Subject', 'Type', 'Preset', 'Time [s]', 'Mutual Information', 'Similarity'])
+
+    for i, subj in enumerate(dataset):
+        print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
+        subj.load_data(load_label=False, transform_to_flair=False)
+        flair_masked = ants.mask_image(subj.flair, subj.BETmask.astype("float32"))
+
+        for preset in syn_presets:
+            duration, mutual_information, similarity = measure(template, flair_masked, generate_transforms.SYN_PRESETS[preset], queue)
+            results_df.loc[len(results_df)] = [subj.name, 'FLAIR-MNI', preset, duration, mutual_information, similarity]
+
+        for preset in rigid_presets:
+            duration, mutual_information, similarity = measure(subj.flair, subj.dwi, generate_transforms.RIGID_PRESETS[preset], queue)
+            results_df.loc[len(results_df)] = [subj.name, 'DWI-FLAIR', preset, duration, mutual_information, similarity]
+
+        subj.free_data()
+    return results_df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=5, help="Number of subjects to benchmark")
+    parser.add_argument("--template", type=str, default="datasets/template_flair_mni.nii.gz", help="MNI template")
+    parser.add_argument("--syn-presets", type=str, nargs="+", default=list(generate_transforms.SYN_PRESETS.keys()), help="SyN presets to benchmark")
+    parser.add_argument("--rigid-presets", type=str, nargs="+", default=list(generate_transforms.RIGID_PRESETS.keys()), help="Rigid presets to benchmark")
+    parser.add_argument("--output", type=str, default="results/registration_benchmark.csv", help="Output csv file")
+    args = parser.parse_args()
+
+    dataset = dataset_loaders.ISLES2022()[:args.subjects]
+    results_df = benchmark(dataset, args.template, args.syn_presets, args.rigid_presets)
+    results_df.to_csv(args.output, index=False)
+
+    summary = results_df.groupby(['Type', 'Preset'])[['Time [s]', 'Mutual Information', 'Similarity']].mean()
+    print(summary.to_string())
@@ -0,0 +1,98 @@
+import os
+import time
+import ants
+import cc3d
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.sparse_mask as sparse_mask
+import datasets.utils as utils
+
+def timed(func, repeats: int = 5):
+    """
+    Returns the result of the function and its minimal wall time over repeats.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+def benchmark_subject(subj: dataset_loaders.Subject) -> dict:
+    """
+    Compares dense and sparse (`sparse_mask.SparseMask`) counting, union, Dice and connected components on the label
+    of the subject and on the label shifted by two voxels, which plays the role of an imperfect prediction.
+
+    Parameters:
+        subj (dataset_loaders.Subject): The subject, it must not be loaded.
+
+    Returns:
+        dict: Timings in ms, number of runs, stored sizes and agreement of dense and sparse results.
+    """
+    label_image = utils.as_label(ants.image_read(subj.label))
+    label = label_image.numpy()
+    pred = np.roll(label, 2, axis=0)
+
+    sparse_label, convert_time = timed(lambda: sparse_mask.SparseMask.from_numpy(label, label_image.spacing, label_image.origin, label_image.direction))
+    sparse_pred = sparse_mask.SparseMask.from_numpy(pred)
+
+    dense_count, dense_count_time = timed(lambda: np.count_nonzero(label))
+    sparse_count, sparse_count_time = timed(sparse_label.count)
+    dense_union, dense_union_time = timed(lambda: np.logical_or(label, pred))
+    sparse_union, sparse_union_time = timed(lambda: sparse_label | sparse_pred)
+    dense_dice, dense_dice_time = timed(lambda: utils.dice_coefficient(label, pred))
+    sparse_dice, sparse_dice_time = timed(lambda: sparse_label.dice(sparse_pred))
+    (_, dense_n), dense_cc_time = timed(lambda: cc3d.connected_components(label != 0, connectivity=26, return_N=True))
+    sparse_components, sparse_cc_time = timed(lambda: sparse_label.components(26))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ants.image_write(label_image, os.path.join(tmp_dir, "label.nii.gz"))
+        sparse_label.save(os.path.join(tmp_dir, "label.npz"))
+        nifti_size = os.path.getsize(os.path.join(tmp_dir, "label.nii.gz"))
+        sparse_size = os.path.getsize(os.path.join(tmp_dir, "label.npz"))
+
+    return {
+        "name": subj.name,
+        "voxels": label.size,
+        "lesion_voxels": dense_count,
+        "runs": len(sparse_label.starts),
+        "convert_ms": convert_time * 1000,
+        "dense_count_ms": dense_count_time * 1000,
+        "sparse_count_ms": sparse_count_time * 1000,
+        "dense_union_ms": dense_union_time * 1000,
+        "sparse_union_ms": sparse_union_time * 1000,
+        "dense_dice_ms": dense_dice_time * 1000,
+        "sparse_dice_ms": sparse_dice_time * 1000,
+        "dense_components_ms": dense_cc_time * 1000,
+        "sparse_components_ms": sparse_cc_time * 1000,
+        "nifti_kb": nifti_size / 1024,
+        "sparse_kb": sparse_size / 1024,
+        "same_results": bool(dense_count == sparse_count and np.count_nonzero(dense_union) == sparse_union.count()
+                             and np.isclose(dense_dice, sparse_dice) and dense_n == len(sparse_components))
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=20, help="Number of subjects to benchmark")
+    parser.add_argument("--output", type=str, default=None, help="Output csv file")
+    args = parser.parse_args()
+
+    dataset = dataset_loaders.ISLES2022()[:args.subjects]
+    rows = []
+    for i, subj in enumerate(dataset):
+        print(f"Processing {i+1}/{len(dataset)}: {subj.name}...")
+        rows.append(benchmark_subject(subj))
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    for operation in ["count", "union", "dice", "components"]:
+        print(f"{operation}: dense {df[f'dense_{operation}_ms'].sum():.1f} ms, sparse {df[f'sparse_{operation}_ms'].sum():.1f} ms")
+    print(f"conversion to sparse: {df['convert_ms'].sum():.1f} ms, stored size: {df['nifti_kb'].sum():.0f} kB (NIfTI) -> {df['sparse_kb'].sum():.0f} kB (sparse)")
+    print(f"Same results for all subjects: {df['same_results'].all()}")
+
+    if args.output:
+        df.to_csv(args.output, index=False)
@@ -0,0 +1,89 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+import datasets.dataset_loaders as dataset_loaders
+import datasets.training_dataset as training_dataset
+
+class OnTheFlyDataset(torch.utils.data.Dataset):
+    """
+    Baseline dataset which loads and preprocesses the subject with `Subject.load_data` for every sample.
+    """
+    def __init__(self, dataset: list[dataset_loaders.Subject], patch_size: tuple[int, int, int] = (96, 96, 96)):
+        self.dataset = dataset
+        self.patch_size = patch_size
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, i: int) -> dict:
+        images, label, _ = training_dataset.preprocess_for_training(self.dataset[i])
+        start = np.random.randint(0, np.array(label.shape) - np.array(self.patch_size) + 1)
+        region = tuple(slice(s, s + p) for s, p in zip(start, self.patch_size))
+        return {
+            "image": torch.from_numpy(images[(slice(None),) + region].astype(np.float32)),
+            "label": torch.from_numpy(label[region][None].copy())
+        }
+
+def throughput(dataset: torch.utils.data.Dataset, batch_size: int, num_workers: int, n_batches: int) -> float:
+    """
+    Measures the number of samples per second which the DataLoader produces.
+
+    Parameters:
+        dataset (torch.utils.data.Dataset): The dataset.
+        batch_size (int): Batch size.
+        num_workers (int): Number of DataLoader workers.
+        n_batches (int): Number of measured batches (the first batch is not measured, it includes worker startup).
+
+    Returns:
+        float: Samples per second.
+    """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                         persistent_workers=num_workers > 0)
+    iterator = iter(loader)
+    next(iterator)
+    samples = 0
+    start = time.time()
+    while samples < n_batches * batch_size:
+        batch = next(iterator, None)
+        if batch is None:
+            # start next epoch
+            iterator = iter(loader)
+            continue
+        samples += len(batch["image"])
+    return samples / (time.time() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pool", type=str, default="datasets/pool/", help="Pool created by datasets/training_dataset.py")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4, 8], help="Numbers of DataLoader workers")
+    parser.add_argument("--batch-size", type=int, default=2, help="Batch size")
+    parser.add_argument("--batches", type=int, default=50, help="Number of measured batches")
+    parser.add_argument("--patch-size", type=int, default=96, help="Size of cubic patches")
+    parser.add_argument("--baseline-batches", type=int, default=5, help="Number of measured batches of the on-the-fly baseline (0 to skip it)")
+    parser.add_argument("--output", type=str, default=None, help="Output csv file")
+    args = parser.parse_args()
+
+    patch_size = (args.patch_size,) * 3
+    datasets = {
+        "pool (memmap)": training_dataset.VolumePoolDataset(args.pool, patch_size, samples_per_volume=4),
+        "pool (shared memory)": training_dataset.VolumePoolDataset(args.pool, patch_size, samples_per_volume=4, in_memory=True)
+    }
+    if args.baseline_batches > 0:
+        datasets["on-the-fly load_data"] = OnTheFlyDataset(dataset_loaders.ISLES2022(), patch_size)
+
+    rows = []
+    for name, dataset in datasets.items():
+        n_batches = args.baseline_batches if isinstance(dataset, OnTheFlyDataset) else args.batches
+        for num_workers in args.workers:
+            samples_per_second = throughput(dataset, args.batch_size, num_workers, n_batches)
+            print(f"{name}, {num_workers} workers: {samples_per_second:.1f} samples/s")
+            rows.append({"dataset": name, "workers": num_workers, "samples_per_s": samples_per_second})
+
+    df = pd.DataFrame(rows)
+    print(df.pivot(index="workers", columns="dataset", values="samples_per_s").to_string())
+
+    if args.output:
+        df.to_csv(args.output, index=False)
@@ -5,6 +5,7 @@ import matplotlib
 import matplotlib.patches as mpatches
 import datasets.dataset_loaders as dataset_loaders
 import datasets.utils as utils
+import datasets.volume_cache as volume_cache
 import argparse
 import os
 
@@ -43,7 +44,7 @@ def plot_label(label: ants.ants_image.ANTsImage, slice: int, ax: plt.Axes):
 
 def plot_sheet():
     # load dataset
-    dataset = dataset_loaders.ISLES2022()
+    dataset = dataset_loaders.ISLES2022(cache=cache)
     dataset = [subj for subj in dataset if subj.name in args.images]
 
     # calculate number of rows and columns
@@ -79,7 +80,7 @@ def plot_sheet():
             pred = utils.invert_SyN_registration(pred.astype("float32"),
                                                  subj.transform_flair_to_mni[0], 
                                                  subj.transform_flair_to_mni[1])
-            pred = pred.new_image_like(pred.numpy().round().astype(np.uint32))
+            pred = pred.new_image_like(pred.numpy().round().astype(utils.LABEL_DTYPE))
 
         # merge expert and prediction
         new_label = np.zeros(subj.label.shape)
@@ -112,7 +113,7 @@ def plot_sheet():
 
 def plot_four():
     # load dataset
-    dataset = dataset_loaders.ISLES2022()
+    dataset = dataset_loaders.ISLES2022(cache=cache)
 
     for i, subj in enumerate(dataset):
         print(f"Plotting {i+1}/{len(dataset)}: {subj.name}")
@@ -132,7 +133,7 @@ def plot_four():
             pred = utils.invert_SyN_registration(pred.astype("float32"),
                                                  subj.transform_flair_to_mni[0], 
                                                  subj.transform_flair_to_mni[1])
-            pred = pred.new_image_like(pred.numpy().round().astype(np.uint32))
+            pred = pred.new_image_like(pred.numpy().round().astype(utils.LABEL_DTYPE))
 
         # merge expert and prediction
         new_label = np.zeros(subj.label.shape)
@@ -174,8 +175,11 @@ if __name__ == "__main__":
     args.add_argument("pred_folder", help="folder with predictions")
     args.add_argument("output", help="output file or folder")
     args.add_argument("images", nargs='*', help="images to plot")
+    args.add_argument("--cache-dir", default=None, help="folder for caching of loaded subjects")
     args = args.parse_args()
 
+    cache = volume_cache.VolumeCache(args.cache_dir) if args.cache_dir else None
+
     if args.mode == "sheet":
         plot_sheet()
     elif args.mode == "four":